@@ -0,0 +1,83 @@
+# throughput and peak memory of the accounting stages on synthetic histories
+# usage: python -m benchmarks.bench_accounting [sizes] [memory] [exact]
+#   sizes: comma separated row counts, e.g. 1k,100k,1m (default 1k,100k)
+#   memory: also run each stage under tracemalloc for its peak memory (several times slower)
+#   exact: book integer base units instead of float amounts
+import sys
+import time
+import tracemalloc
+from tests.synthetic import make_tx_df, make_tokens, make_prices_df
+from sources.accounting import init_output_columns, iter_tx_rows, classify_tx, apply_tx
+from sources.classes import Portfolio, BaseToken
+from sources.utils import merge_tx_df_with_prices
+
+# merge_tx_df_with_prices should price 500k rows well under a second, reported for 100k rows and more
+PRICING_ROWS_PER_SECOND = 500_000
+
+def parse_size(size):
+    units = {"k": 1000, "m": 1000_000}
+    size = size.strip().lower()
+    return int(float(size[:-1]) * units[size[-1]]) if size[-1] in units else int(size)
+
+def replay(tx_df, exact=False):
+    # process_tx over a frame from init_output_columns, with per-tx classification and lot accounting timed separately
+    portfolio = Portfolio(exact=exact)
+    timings = {"classification": 0., "accounting": 0.}
+    start = time.perf_counter()
+    for tx_rows in iter_tx_rows(tx_df):
+        t0 = time.perf_counter()
+        tx_data, category2rows = classify_tx(tx_rows, portfolio, tx_df)
+        t1 = time.perf_counter()
+        apply_tx(tx_rows, tx_data, category2rows, portfolio, tx_df)
+        timings["classification"] += t1 - t0
+        timings["accounting"] += time.perf_counter() - t1
+    timings["grouping"] = time.perf_counter() - start - timings["classification"] - timings["accounting"]
+    return portfolio, timings
+
+def count_lots(token):
+    if type(token) == BaseToken:
+        return len(token.buys)
+    return sum([count_lots(x) for x in token.deposits.values()])
+
+def peak_memory(f):
+    tracemalloc.start()
+    f()
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return peak
+
+def main(sizes, memory, exact=False):
+    tokens, prices_df = make_tokens(), make_prices_df()
+    for num_rows in sizes:
+        tx_df = make_tx_df(num_rows)
+
+        start = time.perf_counter()
+        tx_df_priced = merge_tx_df_with_prices(tx_df, tokens, prices_df)
+        timings = {"pricing": time.perf_counter() - start}
+        # the frame-level classification (classify_frame) is part of init_output_columns
+        start = time.perf_counter()
+        tx_df_classified = init_output_columns(tx_df_priced)
+        timings["classification"] = time.perf_counter() - start
+        portfolio, replay_timings = replay(tx_df_classified, exact)
+        timings["classification"] += replay_timings.pop("classification")
+        timings.update(replay_timings)
+
+        peaks = {}
+        if memory:
+            peaks["pricing"] = peak_memory(lambda: merge_tx_df_with_prices(tx_df, tokens, prices_df))
+            peaks["classification"] = peak_memory(lambda: init_output_columns(tx_df_priced))
+            peaks["accounting"] = peak_memory(lambda: replay(tx_df_classified, exact))
+
+        num_lots = sum([count_lots(x) for x in portfolio.spot.values()]) + sum([count_lots(x) for x in portfolio.deposits.values()])
+        print(f"rows: {len(tx_df)} transactions: {tx_df['Hash'].nunique()} lots at the end: {num_lots}")
+        for stage, seconds in timings.items():
+            print(f"  {stage:<15} {seconds:8.3f}s {len(tx_df) / seconds:12.0f} rows/s")
+        if num_rows >= 100_000:
+            met = len(tx_df) / timings["pricing"] >= PRICING_ROWS_PER_SECOND
+            print(f"  pricing target of {PRICING_ROWS_PER_SECOND} rows/s {'met' if met else 'missed'}")
+        for stage, peak in peaks.items():
+            print(f"  {stage:<15} peak {peak / 1e6:.1f}MB")
+
+if __name__ == "__main__":
+    sizes = [parse_size(x) for x in (sys.argv[1] if len(sys.argv) > 1 else "1k,100k").split(",")]
+    main(sizes, "memory" in sys.argv[2:], "exact" in sys.argv[2:])
@@ -0,0 +1,56 @@
+# compares the columnar store with the previous one-pickle-per-query cache
+# usage: python -m benchmarks.bench_cache [num_rows]
+import os
+import sys
+import time
+import tempfile
+import numpy as np
+import pandas as pd
+from sources.store import ColumnarStore
+
+def make_etherscan_df(num_rows, seed=0):
+    # same layout as an etherscan erc20 list: every value is a string
+    rng = np.random.default_rng(seed)
+    blocks = np.sort(rng.integers(10_000_000, 15_000_000, num_rows))
+    return pd.DataFrame({
+        "blockNumber": blocks.astype(str),
+        "timeStamp": (1_600_000_000 + (blocks - 10_000_000) * 13).astype(str),
+        "hash": ["0x%064x" % x for x in rng.integers(0, 2**62, num_rows)],
+        "from": ["0x%040x" % x for x in rng.integers(0, 2**16, num_rows)],
+        "to": ["0x%040x" % x for x in rng.integers(0, 2**16, num_rows)],
+        "value": rng.integers(0, 10**15, num_rows).astype(str),
+        "tokenName": rng.choice(["USD Coin", "Dai Stablecoin", "Convex Token", "Curve DAO Token"], num_rows),
+        "tokenSymbol": rng.choice(["USDC", "DAI", "CVX", "CRV"], num_rows),
+        "tokenDecimal": rng.choice(["6", "18"], num_rows),
+        "gasPrice": rng.integers(10**9, 10**11, num_rows).astype(str),
+        "gasUsed": rng.integers(21000, 500000, num_rows).astype(str),
+    })
+
+def timed(f):
+    start = time.perf_counter()
+    result = f()
+    return result, time.perf_counter() - start
+
+def main(num_rows):
+    df = make_etherscan_df(num_rows)
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        pickle_path = os.path.join(tmp_dir, "erc20_df.pickle")
+        _, pickle_write = timed(lambda: df.to_pickle(pickle_path))
+        _, pickle_read = timed(lambda: pd.read_pickle(pickle_path))
+
+        store = ColumnarStore(os.path.join(tmp_dir, "store"))
+        key = ("etherscan", "0xabc", "erc20")
+        _, store_write = timed(lambda: store.write(key, df, block_end=int(df["blockNumber"].iloc[-1])))
+        loaded, store_read = timed(lambda: store.load(key))
+        assert loaded.equals(df)
+
+        # a daily refresh: the pickle cache re-downloads and rewrites everything, the store appends the new rows
+        new_rows = make_etherscan_df(max(num_rows // 1000, 1), seed=1)
+        _, store_append = timed(lambda: store.append(key, new_rows, block_end=int(new_rows["blockNumber"].iloc[-1])))
+
+        print(f"rows: {num_rows}")
+        print(f"pickle: write {pickle_write:.3f}s read {pickle_read:.3f}s size {os.path.getsize(pickle_path) / 1e6:.1f}MB")
+        print(f"store:  write {store_write:.3f}s read {store_read:.3f}s size {sum(os.path.getsize(x) for x in store.parts(key)) / 1e6:.1f}MB append {store_append:.3f}s")
+
+if __name__ == "__main__":
+    main(int(sys.argv[1]) if len(sys.argv) > 1 else 200_000)
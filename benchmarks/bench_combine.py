@@ -0,0 +1,32 @@
+# combine_etherscan_dfs on synthetic explorer lists, against the previous row-wise preprocessing
+# usage: python -m benchmarks.bench_combine [sizes] [compare]
+#   sizes: comma separated row counts, e.g. 100k,1m (default 1m)
+#   compare: also time the row-wise version (about 100 times slower)
+import sys
+import time
+import sources.io_utils as io_utils
+from tests.synthetic import make_etherscan_dfs
+from tests.combine_rowwise import combine_etherscan_dfs_rowwise, copy_dfs, ADDRESS
+from benchmarks.bench_accounting import parse_size
+
+def main(sizes, compare):
+    versions = {"vectorized": io_utils.combine_etherscan_dfs}
+    if compare:
+        versions["row-wise"] = combine_etherscan_dfs_rowwise
+    for num_rows in sizes:
+        etherscan_dfs = make_etherscan_dfs(num_rows, ADDRESS)
+        # methods are decoded offline with the signature table in both versions, compiled before the first timing
+        io_utils.get_signature_table()
+
+        print(f"rows: {sum([len(x) for x in etherscan_dfs.values()])}")
+        for name, combine in versions.items():
+            for platform in ["ethereum", "arbitrum"]:
+                dfs = copy_dfs(etherscan_dfs)
+                start = time.perf_counter()
+                tx_df = combine(dfs, ADDRESS, platform, offline=True)
+                seconds = time.perf_counter() - start
+                print(f"  {name:<11} {platform:<9} {seconds:8.3f}s {len(tx_df) / seconds:12.0f} rows/s")
+
+if __name__ == "__main__":
+    sizes = [parse_size(x) for x in (sys.argv[1] if len(sys.argv) > 1 else "1m").split(",")]
+    main(sizes, len(sys.argv) > 2 and sys.argv[2] == "compare")
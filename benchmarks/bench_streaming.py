@@ -0,0 +1,39 @@
+# peak memory and time of compute_portfolio_and_gains on a whole frame vs the chunked pipeline
+# usage: python -m benchmarks.bench_streaming [num_rows] [chunksize]
+import os
+import sys
+import time
+import tempfile
+import tracemalloc
+import pandas as pd
+from sources.accounting import compute_portfolio_and_gains, compute_portfolio_and_gains_chunked, read_tx_chunks
+from sources.store import ColumnarStore
+from tests.synthetic import make_priced_tx_df
+
+def measure(f):
+    tracemalloc.start()
+    start = time.perf_counter()
+    result = f()
+    duration = time.perf_counter() - start
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return result, duration, peak
+
+def main(num_rows, chunksize):
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        filepath = os.path.join(tmp_dir, "tx.parquet")
+        make_priced_tx_df(num_rows).to_parquet(filepath)
+
+        full, full_time, full_peak = measure(lambda: compute_portfolio_and_gains(pd.read_parquet(filepath)))
+
+        store = ColumnarStore(os.path.join(tmp_dir, "store"))
+        write_chunk = lambda chunk: store.append(("gains",), chunk)
+        chunked, chunked_time, chunked_peak = measure(lambda: compute_portfolio_and_gains_chunked(read_tx_chunks(filepath, chunksize), write_chunk))
+
+        assert str(full[0]) == str(chunked)
+        print(f"rows: {num_rows} chunksize: {chunksize}")
+        print(f"full:    {full_time:.2f}s peak {full_peak / 1e6:.1f}MB")
+        print(f"chunked: {chunked_time:.2f}s peak {chunked_peak / 1e6:.1f}MB")
+
+if __name__ == "__main__":
+    main(int(sys.argv[1]) if len(sys.argv) > 1 else 5000, int(sys.argv[2]) if len(sys.argv) > 2 else 1000)
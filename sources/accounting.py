@@ -1,13 +1,16 @@
+import copy
+import time
+import pickle
 import numpy as np
 import pandas as pd
-from sources.classes import RowType, TxType, Portfolio, TxData, BaseToken, LiquidDepositToken
-from sources.utils import is_in, is_out, is_nft, is_nft_in, is_nft_out, get_token_id, dict_union_sum
+import pyarrow.parquet as pq
+from sources.classes import RowType, TxType, Portfolio, TxData, BaseToken, LiquidDepositToken, CostBasisMethod, add_leaf_amounts
+from sources.utils import add_row_flags, get_row_flags, get_token_id, get_token_id2cg_id
+from sources.prices import day_ordinals_to_strings
+from sources import instrumentation
 
 INITIAL_DEPOSIT_WALLET = "to_set (0x...)"
 
-def classify_rows(tx_rows, txdata, portfolio):
-    return {i: classify_row(row, txdata, portfolio) for i, row in tx_rows.iterrows()}
-
 def classify_row(row, txdata, portfolio):
 
     error_type = None
@@ -16,18 +19,18 @@ def classify_row(row, txdata, portfolio):
         
         return RowType.NO_TRANSFER
     
-    elif is_nft(row):
+    elif row.IsNft:
         
-        if is_nft_in(row):
+        if row.IsIn:
             return RowType.TRANSFER_NFT_IN
-        elif is_nft_out(row):
+        elif row.IsOut:
             return RowType.TRANSFER_NFT_OUT
         else:
             error_type = "nft error"
     
     elif txdata.tx_type == TxType.TRANSFER_IN:
         
-        assert is_in(row)
+        assert row.IsIn
         if INITIAL_DEPOSIT_WALLET == row.From.lower():
             return RowType.INITIAL_DEPOSIT
         elif any([x in row.From.lower() for x in ["bridge"]]):
@@ -37,7 +40,7 @@ def classify_row(row, txdata, portfolio):
         
     elif txdata.tx_type == TxType.TRANSFER_OUT:
         
-        assert is_out(row)
+        assert row.IsOut
         if any([x in row.To.lower() for x in ["bridge"]]):
             return RowType.TRANSFER_INTERNAL_OUT
         else:
@@ -45,7 +48,7 @@ def classify_row(row, txdata, portfolio):
         
     elif txdata.tx_type == TxType.CONTRACT_DEPOSIT:
         
-        assert is_out(row)
+        assert row.IsOut
         if "bridge" in row.To.lower():
             return RowType.TRANSFER_INTERNAL_OUT
         else:
@@ -53,7 +56,7 @@ def classify_row(row, txdata, portfolio):
         
     elif txdata.tx_type == TxType.CONTRACT_WITHDRAW:
         
-        assert is_in(row)
+        assert row.IsIn
         if txdata.method and "reward" in txdata.method.lower():
             return RowType.TRANSFER_PAYMENT_IN
         else:
@@ -70,24 +73,24 @@ def classify_row(row, txdata, portfolio):
         
     elif txdata.tx_type == TxType.SWAP:
         assert row["ValueEuro"] > 0
-        if is_in(row):
+        if row.IsIn:
             return RowType.SWAP_IN
-        elif is_out(row):
+        elif row.IsOut:
             return RowType.SWAP_OUT
         else:
             error_type = "swap error"
     elif txdata.tx_type == TxType.LIQUID_DEPOSIT:
-        if is_in(row):
+        if row.IsIn:
             return RowType.LIQUID_DEPOSIT_IN
-        elif is_out(row):
+        elif row.IsOut:
             return RowType.LIQUID_DEPOSIT_OUT
         else:
             error_type = "liquid deposit error"
         
     elif txdata.tx_type == TxType.LIQUID_WITHDRAW:
-        if is_in(row):
+        if row.IsIn:
             return RowType.LIQUID_WITHDRAW_IN
-        elif is_out(row):
+        elif row.IsOut:
             return RowType.LIQUID_WITHDRAW_OUT
         else:
             error_type = "liquid withdraw error"
@@ -98,172 +101,553 @@ def classify_row(row, txdata, portfolio):
     print("row error", error_type, row.Hash)
     return RowType.ERROR
 
-def compute_portfolio_and_gains(tx_df):
-    portfolio = Portfolio()
+# Classification rules, evaluated for the whole frame at once by classify_frame. Each rule is (category, condition),
+# the first rule whose condition holds wins (np.select). TX_RULES see one row per transaction with the counts of
+# TxData and its lowercase method, ROW_RULES see one row per row with its flags, lowercase From, To and method, and
+# the TxType of its transaction. A category of None leaves the decision to the replay (TxData.resolve_tx_type,
+# classify_row): rules that depend on the portfolio, and cases that are reported as errors there.
+# Protocol-specific rules are inserted before the generic ones, e.g.
+#   TX_RULES.insert(0, (TxType.SWAP, lambda tx: tx.method == "multicall"))
+
+TX_RULES = [
+    (TxType.FEE_ONLY,          lambda tx: (tx.num_in == 0) & (tx.num_out == 0)),
+    (TxType.TRANSFER_IN,       lambda tx: tx.method.isnull() & (tx.num_out == 0)),
+    (None,                     lambda tx: tx.method.isnull() & (tx.num_in == 0)), # tokens out without a method
+    (TxType.TRANSFER_OUT,      lambda tx: (tx.num_in == 0) & (tx.method == "transfer")),
+    (TxType.CONTRACT_DEPOSIT,  lambda tx: tx.num_in == 0),
+    (TxType.TRANSFER_IN,       lambda tx: (tx.num_out == 0) & (tx.method == "transfer")),
+    (TxType.CONTRACT_WITHDRAW, lambda tx: tx.num_out == 0),
+    (None,                     lambda tx: (tx.num_priced_in == 1) & (tx.num_priced_out > 1)), # swap for multiple priced tokens
+    (TxType.SWAP,              lambda tx: (tx.num_priced_in == 1) & (tx.num_priced_out > 0)),
+    (TxType.LIQUID_WITHDRAW,   lambda tx: (tx.num_out == 1) & (tx.num_unpriced_out == 1) & ((tx.num_in > 1) | (tx.num_priced_in > 0))),
+    (None,                     lambda tx: (tx.num_out == 1) & (tx.num_unpriced_out == 1) & (tx.num_in == 1) & (tx.num_unpriced_in == 1)), # deposit or withdrawal, by the portfolio
+    (TxType.LIQUID_DEPOSIT,    lambda tx: (tx.num_in == 1) & (tx.num_unpriced_in == 1) & (tx.num_out > 0)),
+    (TxType.ERROR,             lambda tx: np.ones(len(tx), dtype=bool)),
+]
+
+ROW_RULES = [
+    (RowType.NO_TRANSFER,           lambda row: row.Amount == 0),
+    (RowType.TRANSFER_NFT_IN,       lambda row: row.IsNft & row.IsIn),
+    (RowType.TRANSFER_NFT_OUT,      lambda row: row.IsNft & row.IsOut),
+    (None,                          lambda row: row.IsNft),
+    (RowType.INITIAL_DEPOSIT,       lambda row: (row.TxType == TxType.TRANSFER_IN) & row.IsIn & (row.From == INITIAL_DEPOSIT_WALLET)),
+    (RowType.TRANSFER_INTERNAL_IN,  lambda row: (row.TxType == TxType.TRANSFER_IN) & row.IsIn & row.From.str.contains("bridge", regex=False, na=False)),
+    (RowType.TRANSFER_PAYMENT_IN,   lambda row: (row.TxType == TxType.TRANSFER_IN) & row.IsIn),
+    (RowType.TRANSFER_INTERNAL_OUT, lambda row: row.TxType.isin([TxType.TRANSFER_OUT, TxType.CONTRACT_DEPOSIT]) & row.IsOut & row.To.str.contains("bridge", regex=False, na=False)),
+    (RowType.TRANSFER_PAYMENT_OUT,  lambda row: (row.TxType == TxType.TRANSFER_OUT) & row.IsOut),
+    (RowType.CONTRACT_DEPOSIT_OUT,  lambda row: (row.TxType == TxType.CONTRACT_DEPOSIT) & row.IsOut),
+    (RowType.TRANSFER_PAYMENT_IN,   lambda row: (row.TxType == TxType.CONTRACT_WITHDRAW) & row.IsIn & row.method.str.contains("reward", regex=False, na=False)),
+    (RowType.SWAP_IN,               lambda row: (row.TxType == TxType.SWAP) & (row.ValueEuro > 0) & row.IsIn),
+    (RowType.SWAP_OUT,              lambda row: (row.TxType == TxType.SWAP) & (row.ValueEuro > 0) & row.IsOut),
+    (RowType.LIQUID_DEPOSIT_IN,     lambda row: (row.TxType == TxType.LIQUID_DEPOSIT) & row.IsIn),
+    (RowType.LIQUID_DEPOSIT_OUT,    lambda row: (row.TxType == TxType.LIQUID_DEPOSIT) & row.IsOut),
+    (RowType.LIQUID_WITHDRAW_IN,    lambda row: (row.TxType == TxType.LIQUID_WITHDRAW) & row.IsIn),
+    (RowType.LIQUID_WITHDRAW_OUT,   lambda row: (row.TxType == TxType.LIQUID_WITHDRAW) & row.IsOut),
+]
+
+TX_TYPE_NAMES = np.array([None] + [x.name for x in TxType], dtype=object)
+ROW_TYPE_NAMES = np.array([None] + [x.name for x in RowType], dtype=object)
+
+def select_rules(rules, features):
+    # enum value of the first matching rule for each row of features, 0 where none matches or the rule gives None
+    conditions = [np.asarray(condition(features), dtype=bool) for _, condition in rules]
+    return np.select(conditions, [0 if category is None else int(category) for category, _ in rules], 0)
+
+def tx_features(tx_df):
+    # the counts, method, contract and platform of TxData (get_method, get_contract_id, get_platform) and the lowercase
+    # method, one row per transaction in order of first appearance
+    codes, _ = pd.factorize(tx_df["Hash"])
+    flags = get_row_flags(tx_df)
+    txs = pd.DataFrame({
+        "num_priced_in": flags["IsPriced"] & flags["IsIn"],
+        "num_priced_out": flags["IsPriced"] & flags["IsOut"],
+        "num_unpriced_in": flags["IsUnpriced"] & flags["IsIn"],
+        "num_unpriced_out": flags["IsUnpriced"] & flags["IsOut"],
+    }).groupby(codes).sum()
+    txs["num_in"] = txs["num_priced_in"] + txs["num_unpriced_in"]
+    txs["num_out"] = txs["num_priced_out"] + txs["num_unpriced_out"]
+
+    methods = pd.Series(tx_df["Method"].to_numpy(dtype=object))
+    has_method = methods.notnull()
+    platforms = pd.Series(tx_df["Platform"].to_numpy(dtype=object)).groupby(codes)
+    txs["platform"] = platforms.first()
+    is_bitstamp = (txs["platform"] == "bitstamp").to_numpy()
+    txs["Method"] = methods.groupby(codes).first().reindex(txs.index).astype(object)
+    txs["Method"] = txs["Method"].where(txs["Method"].notnull(), None)
+    txs["method"] = txs["Method"].str.lower()
+    contracts = pd.Series(tx_df["To"].to_numpy(dtype=object)).where(has_method).groupby(codes).first().reindex(txs.index)
+    txs["contract_id"] = np.where(is_bitstamp, "bitstamp", contracts.where(contracts.notnull(), None).to_numpy(dtype=object))
+
+    num_methods = np.where(is_bitstamp, methods.groupby(codes).nunique(), has_method.groupby(codes).sum())
+    hashes = pd.Series(tx_df["Hash"].to_numpy(dtype=object)).groupby(codes).first()
+    if (platforms.nunique() > 1).any():
+        raise Exception(f"multiple platforms for transaction {hashes[(platforms.nunique() > 1).to_numpy()].iloc[0]}")
+    if (num_methods > 1).any():
+        raise Exception(f"multiple methods for transaction {hashes[num_methods > 1].iloc[0]}")
+    return codes, txs
+
+def row_features(tx_df, tx_types, methods):
+    flags = get_row_flags(tx_df)
+    rows = pd.DataFrame(flags)
+    rows["Amount"] = tx_df["Amount"].to_numpy()
+    rows["ValueEuro"] = tx_df["ValueEuro"].to_numpy()
+    rows["From"] = pd.Series(tx_df["From"].to_numpy(dtype=object)).str.lower()
+    rows["To"] = pd.Series(tx_df["To"].to_numpy(dtype=object)).str.lower()
+    rows["method"] = pd.Series(methods, dtype=object)
+    rows["TxType"] = tx_types
+    return rows
+
+def classify_frame(tx_df, features=None):
+    # TxCategory and RowCategory of every row from TX_RULES and ROW_RULES, None where the replay decides.
+    # features: tx_features(tx_df) if already computed
+    codes, txs = tx_features(tx_df) if features is None else features
+    tx_types = select_rules(TX_RULES, txs)[codes]
+    row_types = select_rules(ROW_RULES, row_features(tx_df, tx_types, txs["method"].to_numpy()[codes]))
+    instrumentation.count("rows_left_to_replay", int(np.count_nonzero((tx_types == 0) | (row_types == 0))))
+    return TX_TYPE_NAMES[tx_types], ROW_TYPE_NAMES[row_types]
+
+@instrumentation.timed()
+def compute_portfolio_and_gains(tx_df, engine="grouped", method=None, jurisdiction=None, checkpoint=None, history=None, exact=False):
+    # with a checkpoint, starts from its portfolio and only processes (and returns) the rows after it.
+    # a HoldingsHistory passed as history records the daily holdings changes of the replay.
+    # exact books integer base units, from the Units, Decimals and TxnFee(Wei) columns
+    if checkpoint is None:
+        portfolio = Portfolio(method, jurisdiction, exact)
+    else:
+        portfolio = copy.deepcopy(checkpoint.portfolio)
+        tx_df = tx_df[checkpoint.is_new(tx_df)]
+    tx_df = init_output_columns(tx_df)
+
+    for tx_rows in iter_tx_rows(tx_df, engine):
+        if history is not None:
+            history.before_tx(tx_rows, portfolio)
+        process_tx(tx_rows, portfolio, tx_df)
+
+    if history is not None:
+        history.close(portfolio)
+    return portfolio, tx_df
+
+@instrumentation.timed()
+def compute_portfolio_and_gains_by_method(tx_df, methods=tuple(CostBasisMethod), engine="grouped", exact=False):
+    # replays the ledger once, classifying each transaction once and booking it in one portfolio per method
+    tx_df = init_output_columns(tx_df)
+    results = {CostBasisMethod(method): (Portfolio(method, exact=exact), tx_df.copy()) for method in methods}
+    first_portfolio, first_df = list(results.values())[0]
+
+    for tx_rows in iter_tx_rows(tx_df, engine):
+        tx_data, category2rows = classify_tx(tx_rows, first_portfolio, first_df)
+        for portfolio, method_df in results.values():
+            apply_tx(tx_rows, tx_data, category2rows, portfolio, method_df)
+
+    for portfolio, method_df in results.values():
+        method_df["RowCategory"] = first_df["RowCategory"]
+        method_df["TxCategory"] = first_df["TxCategory"]
+
+    return results
+
+@instrumentation.timed()
+def compute_portfolio_and_gains_chunked(chunks, write_chunk, engine="grouped", method=None, jurisdiction=None, checkpoint=None, history=None, exact=False):
+    # streaming version of compute_portfolio_and_gains: chunks is an iterable of time-ordered frames, each processed
+    # chunk is passed to write_chunk and dropped, only the portfolio is kept between chunks
+    if checkpoint is None:
+        portfolio = Portfolio(method, jurisdiction, exact)
+    else:
+        portfolio = copy.deepcopy(checkpoint.portfolio)
+
+    for chunk in iter_tx_chunks(chunks):
+        if checkpoint is not None:
+            chunk = chunk[checkpoint.is_new(chunk)]
+        chunk = init_output_columns(chunk)
+        for tx_rows in iter_tx_rows(chunk, engine):
+            if history is not None:
+                history.before_tx(tx_rows, portfolio)
+            process_tx(tx_rows, portfolio, chunk)
+        write_chunk(chunk)
+
+    if history is not None:
+        history.close(portfolio)
+    return portfolio
+
+def iter_tx_chunks(chunks):
+    # rows at the last timestamp of a chunk are held back and prepended to the next one, so that the rows of a
+    # transaction are never split. rows are numbered continuously across chunks
+    carry = None
+    offset = 0
+    for chunk in chunks:
+        if carry is not None:
+            chunk = pd.concat([carry, chunk], ignore_index=True)
+        if len(chunk) == 0:
+            continue
+
+        timestamps = pd.to_numeric(chunk["TimeStamp"])
+        is_last = (timestamps == timestamps.iloc[-1]).to_numpy()
+        carry = chunk[is_last]
+        chunk = chunk[~is_last]
+
+        if len(chunk) > 0:
+            chunk.index = pd.RangeIndex(offset, offset + len(chunk))
+            offset += len(chunk)
+            yield chunk
+
+    if carry is not None and len(carry) > 0:
+        carry.index = pd.RangeIndex(offset, offset + len(carry))
+        yield carry
+
+def read_tx_chunks(filepath, chunksize=100000):
+    # time-ordered csv or parquet export read chunksize rows at a time
+    if filepath.endswith(".parquet"):
+        for batch in pq.ParquetFile(filepath).iter_batches(batch_size=chunksize):
+            yield batch.to_pandas()
+    else:
+        # base units are read as strings, they may exceed int64
+        for chunk in pd.read_csv(filepath, chunksize=chunksize, dtype={"Units": str, "TxnFee(Wei)": str}):
+            yield chunk
+
+class Checkpoint:
+    # portfolio state after processing all transactions up to last_timestamp,
+    # last_hashes are the transactions processed at last_timestamp
+    def __init__(self, portfolio, last_timestamp, last_hashes):
+        self.portfolio = portfolio
+        self.last_timestamp = last_timestamp
+        self.last_hashes = set(last_hashes)
+
+    def is_new(self, tx_df):
+        timestamps = pd.to_numeric(tx_df["TimeStamp"])
+        return ((timestamps > self.last_timestamp) | ((timestamps == self.last_timestamp) & ~tx_df["Hash"].isin(self.last_hashes))).to_numpy()
+
+    def save(self, filepath):
+        pickle.dump(self, open(filepath, 'wb'))
+
+    @staticmethod
+    def load(filepath):
+        return pickle.load(open(filepath, 'rb'))
+
+def make_checkpoint(portfolio, tx_df, previous=None):
+    # tx_df are the rows processed into portfolio since previous
+    if len(tx_df) == 0:
+        return copy.deepcopy(previous)
+    
+    timestamps = pd.to_numeric(tx_df["TimeStamp"])
+    last_timestamp = timestamps.max()
+    last_hashes = set(tx_df[timestamps == last_timestamp]["Hash"])
+    if previous is not None and previous.last_timestamp == last_timestamp:
+        last_hashes = last_hashes | previous.last_hashes
+    return Checkpoint(copy.deepcopy(portfolio), last_timestamp, last_hashes)
+
+# the features of tx_features kept on every row of the transaction, TxData reads them from its first row
+TX_COLUMNS = {
+    "TxMethod": "Method",
+    "TxContract": "contract_id",
+    "NumPricedIn": "num_priced_in",
+    "NumPricedOut": "num_priced_out",
+    "NumUnpricedIn": "num_unpriced_in",
+    "NumUnpricedOut": "num_unpriced_out",
+}
+
+def init_output_columns(tx_df):
     tx_df = tx_df.copy()
 
-    txs = tx_df["Hash"].unique()
-    tx_df["RowCategory"] = None
-    tx_df["TxCategory"] = None
     tx_df["Cost"] = 0
     tx_df["Gain/Loss"] = 0
     tx_df["TxnFee(Cost)"] = 0
     tx_df["TxnFee(Gain/Loss)"] = 0
+    add_row_flags(tx_df)
+    codes, txs = tx_features(tx_df)
+    for column, feature in TX_COLUMNS.items():
+        tx_df[column] = txs[feature].to_numpy()[codes]
+    tx_df["TxCategory"], tx_df["RowCategory"] = classify_frame(tx_df, (codes, txs))
+    instrumentation.count("rows_processed", len(tx_df))
+    return tx_df
 
-    for txhash in txs:
-            
-        tx_rows = tx_df[tx_df["Hash"] == txhash]
+def iter_tx_rows(tx_df, engine="grouped"):
+    # "hash_filter" re-filters the whole frame for every hash (reference path, O(hashes x rows))
+    # "grouped" sorts the frame once by order of first appearance of each hash and walks contiguous blocks
+    if engine == "hash_filter":
+        for txhash in tx_df["Hash"].unique():
+            yield tx_df[tx_df["Hash"] == txhash]
+
+    elif engine == "grouped":
+        codes, _ = pd.factorize(tx_df["Hash"])
+        order = np.argsort(codes, kind="stable")
+        offsets = np.concatenate([[0], np.cumsum(np.bincount(codes))])
+        sorted_df = tx_df.iloc[order]
+        for start, end in zip(offsets[:-1], offsets[1:]):
+            yield sorted_df.iloc[start:end]
+
+    else:
+        raise Exception(f"unknown engine {engine}")
 
-        tx_data = TxData(tx_rows, portfolio)
+def process_tx(tx_rows, portfolio, tx_df):
+    start = time.perf_counter() if instrumentation.enabled else None
+    tx_data, category2rows = classify_tx(tx_rows, portfolio, tx_df)
+    apply_tx(tx_rows, tx_data, category2rows, portfolio, tx_df)
+    if start is not None:
+        instrumentation.add_time(f"tx/{tx_data.tx_type.name}", time.perf_counter() - start)
+
+def classify_tx(tx_rows, portfolio, tx_df):
+    # the categories of classify_frame, completed with the portfolio where the rules left them open.
+    # the features of the transaction are read from its first row (TX_COLUMNS)
+    rows = [tx_rows.iloc[position] for position in range(len(tx_rows))]
+    tx_category = rows[0]["TxCategory"]
+    tx_data = TxData(tx_rows, portfolio, rows[0], None if tx_category is None else TxType[tx_category])
+
+    category2rows = {}
+    for i, row in zip(tx_rows.index, rows):
+        if row["RowCategory"] is None:
+            row_type = classify_row(row, tx_data, portfolio)
+            tx_df.at[i, "RowCategory"] = row_type.name
+        else:
+            row_type = RowType[row["RowCategory"]]
+        if tx_category is None:
+            tx_df.at[i, "TxCategory"] = tx_data.tx_type.name
+        category2rows[row_type] = category2rows.get(row_type, []) + [row]
+
+    return tx_data, category2rows
+
+def apply_tx(tx_rows, tx_data, category2rows, portfolio, tx_df):
         
-        row_types = classify_rows(tx_rows, tx_data, portfolio)
+    for i, row in tx_rows.iterrows():
+        fee = None
+        if row.IsOut and row["TxnFee(ETH)"] > 0:
+            fee = portfolio.remove_token("ETH", int(row["TxnFee(Wei)"]) if portfolio.exact else row["TxnFee(ETH)"])
         
-        for i, category in row_types.items():
-            tx_df.at[i, "RowCategory"] = category.name
-            tx_df.at[i, "TxCategory"] = tx_data.tx_type.name
-            
-        category2rows = {}
-        for k, v in row_types.items():
-            category2rows[v] = category2rows.get(v, []) + [tx_rows.loc[k]]
-            
-        for i, row in tx_rows.iterrows():
-            fee = None
-            if is_out(row) and row["TxnFee(ETH)"] > 0:
-                fee = portfolio.remove_token("ETH", row["TxnFee(ETH)"])
-            
-            if fee:
-                tx_df.at[i, "TxnFee(Cost)"] = fee.cost()
-                tx_df.at[i, "TxnFee(Gain/Loss)"] = row["TxnFee(Euro)"] - fee.cost()
+        if fee:
+            tx_df.at[i, "TxnFee(Cost)"] = fee.cost()
+            tx_df.at[i, "TxnFee(Gain/Loss)"] = row["TxnFee(Euro)"] - fee.cost()
 
-        for row in category2rows.get(RowType.INITIAL_DEPOSIT, []):
-            portfolio.add_buy(get_token_id(row), row.Amount, row.TokenPriceEuro)                
+    for row in category2rows.get(RowType.INITIAL_DEPOSIT, []):
+        portfolio.add_buy(get_token_id(row), row_amount(row, portfolio), row_price(row, portfolio))
+        
+    for row in category2rows.get(RowType.TRANSFER_PAYMENT_IN, []):
+        if np.isnan(row.TokenPriceEuro):
+            print(f"received unpriced token {row.TokenSymbol}: {row.Amount}")
+            portfolio.add_buy(get_token_id(row), row_amount(row, portfolio), 0)
+        else:
+            portfolio.add_buy(get_token_id(row), row_amount(row, portfolio), row_price(row, portfolio))
+        tx_df.at[row.name, "Gain/Loss"] = row.ValueEuro
+        
+    for row in category2rows.get(RowType.TRANSFER_PAYMENT_OUT, []):
+        token = portfolio.remove_token(get_token_id(row), row_amount(row, portfolio))
+        tx_df.at[row.name, "Cost"] = token.cost()
+        tx_df.at[row.name, "Gain/Loss"] = row.ValueEuro - token.cost()
+        
+    for row in category2rows.get(RowType.CONTRACT_DEPOSIT_OUT, []):
+        portfolio.deposit(tx_data.contract_id, get_token_id(row), row_amount(row, portfolio))
             
-        for row in category2rows.get(RowType.TRANSFER_PAYMENT_IN, []):
-            if np.isnan(row.TokenPriceEuro):
-                print(f"received unpriced token {row.TokenSymbol}: {row.Amount}")
-                portfolio.add_buy(get_token_id(row), row.Amount, 0)
-            else:
-                portfolio.add_buy(get_token_id(row), row.Amount, row.TokenPriceEuro)
-            tx_df.at[row.name, "Gain/Loss"] = row.ValueEuro
+    for row in category2rows.get(RowType.CONTRACT_WITHDRAW_IN, []):
+        
+        contract_id = row.From
+        token_amount_deposited = portfolio.deposits[contract_id].token_deposit_amount(get_token_id(row))
+        amount = row_amount(row, portfolio)
+        to_withdraw = min(token_amount_deposited, amount)
+        extra_amount = max(amount - token_amount_deposited, 0)
+        
+        removed = portfolio.remove_from_contract(contract_id, get_token_id(row), to_withdraw)
+        portfolio.add_token(removed)
+        
+        if extra_amount > 0:
+            print(f"withdraw more than deposited {tx_data.tx_id} {get_token_id(row)}")
+            portfolio.add_buy(get_token_id(row), extra_amount, row_price(row, portfolio))
+            tx_df.at[row.name, "Gain/Loss"] = extra_amount * row_price(row, portfolio)
             
-        for row in category2rows.get(RowType.TRANSFER_PAYMENT_OUT, []):
-            token = portfolio.remove_token(get_token_id(row), row.Amount)
-            tx_df.at[row.name, "Cost"] = token.cost()
-            tx_df.at[row.name, "Gain/Loss"] = row.ValueEuro - token.cost()
+    if tx_data.tx_type == TxType.SWAP:
+        
+        in_rows = category2rows.get(RowType.SWAP_IN, [])
+        out_rows = category2rows.get(RowType.SWAP_OUT, [])
+        assert(len(in_rows) > 0)
+        assert(len(out_rows) > 0)
+        
+        for row in out_rows:
+            removed = portfolio.remove_token(get_token_id(row), row_amount(row, portfolio))
+            tx_df.at[row.name, "Cost"] = removed.cost()
+            tx_df.at[row.name, "Gain/Loss"] = - removed.cost()
+        
+        for row in in_rows:
+            assert(row.TokenPriceEuro > 0)
+            portfolio.add_buy(get_token_id(row), row_amount(row, portfolio), row_price(row, portfolio))
+            tx_df.at[row.name, "Gain/Loss"] = row.ValueEuro
             
-        for row in category2rows.get(RowType.CONTRACT_DEPOSIT_OUT, []):
-            portfolio.deposit(tx_data.contract_id, get_token_id(row), row.Amount)
+    elif tx_data.tx_type == TxType.LIQUID_DEPOSIT:
+        
+        in_rows = category2rows.get(RowType.LIQUID_DEPOSIT_IN, [])
+        out_rows = category2rows.get(RowType.LIQUID_DEPOSIT_OUT, [])
+        
+        assert(len(in_rows) == 1)
+        assert(len(out_rows) > 0)
+        
+        in_row = in_rows[0]
+        
+        deposits = {}
+        for row in out_rows:
+            removed = portfolio.remove_token(get_token_id(row), row_amount(row, portfolio))
+            assert removed.token_id not in deposits.keys()
+            deposits[removed.token_id] = removed
+        
+        portfolio.liquid_deposit(get_token_id(in_row), row_amount(in_row, portfolio), deposits)
+        
+    elif tx_data.tx_type == TxType.LIQUID_WITHDRAW:
+        
+        in_rows = category2rows.get(RowType.LIQUID_WITHDRAW_IN, [])
+        out_rows = category2rows.get(RowType.LIQUID_WITHDRAW_OUT, [])
+        
+        assert(len(in_rows) > 0)
+        assert(len(out_rows) == 1)
+        
+        out_row = out_rows[0]
+        removed = portfolio.remove_token(get_token_id(out_row), row_amount(out_row, portfolio))
+        
+        for row in in_rows:
+            token_amount_deposited = removed.underlying_token_amount(get_token_id(row))
+            if  token_amount_deposited > 0:
                 
-        for row in category2rows.get(RowType.CONTRACT_WITHDRAW_IN, []):
-            
-            contract_id = row.From
-            token_amount_deposited = portfolio.deposits[contract_id].token_deposit_amount(get_token_id(row))
-            to_withdraw = min(token_amount_deposited, row.Amount)
-            extra_amount = max(row.Amount - token_amount_deposited, 0)
-            
-            removed = portfolio.remove_from_contract(contract_id, get_token_id(row), to_withdraw)
-            portfolio.add_token(removed)
-            
-            if extra_amount > 0:
-                print(f"withdraw more than deposited {tx_data.tx_id} {get_token_id(row)}")
-                portfolio.add_buy(get_token_id(row), extra_amount, row.TokenPriceEuro)
-                tx_df.at[row.name, "Gain/Loss"] = extra_amount * row.TokenPriceEuro
+                amount = row_amount(row, portfolio)
+                to_withdraw = min(token_amount_deposited, amount)
+                extra_amount = max(amount - token_amount_deposited, 0)
                 
-        if tx_data.tx_type == TxType.SWAP:
-            
-            in_rows = category2rows.get(RowType.SWAP_IN, [])
-            out_rows = category2rows.get(RowType.SWAP_OUT, [])
-            assert(len(in_rows) > 0)
-            assert(len(out_rows) > 0)
-            
-            for row in out_rows:
-                removed = portfolio.remove_token(get_token_id(row), row.Amount)
-                tx_df.at[row.name, "Cost"] = removed.cost()
-                tx_df.at[row.name, "Gain/Loss"] = - removed.cost()
-            
-            for row in in_rows:
-                assert(row.TokenPriceEuro > 0)
-                portfolio.add_buy(get_token_id(row), row.Amount, row.TokenPriceEuro)
-                tx_df.at[row.name, "Gain/Loss"] = row.ValueEuro
+                unwrapped = removed.withdraw(get_token_id(row), to_withdraw)
+                portfolio.add_token(unwrapped)
                 
-        elif tx_data.tx_type == TxType.LIQUID_DEPOSIT:
-            
-            in_rows = category2rows.get(RowType.LIQUID_DEPOSIT_IN, [])
-            out_rows = category2rows.get(RowType.LIQUID_DEPOSIT_OUT, [])
-            
-            assert(len(in_rows) == 1)
-            assert(len(out_rows) > 0)
-            
-            in_row = in_rows[0]
-            
-            deposits = {}
-            for row in out_rows:
-                removed = portfolio.remove_token(get_token_id(row), row.Amount)
-                assert removed.token_id not in deposits.keys()
-                deposits[removed.token_id] = removed
-            
-            portfolio.liquid_deposit(get_token_id(in_row), in_row.Amount, deposits)
-            
-        elif tx_data.tx_type == TxType.LIQUID_WITHDRAW:
-            
-            in_rows = category2rows.get(RowType.LIQUID_WITHDRAW_IN, [])
-            out_rows = category2rows.get(RowType.LIQUID_WITHDRAW_OUT, [])
-            
-            assert(len(in_rows) > 0)
-            assert(len(out_rows) == 1)
-            
-            out_row = out_rows[0]
-            removed = portfolio.remove_token(get_token_id(out_row), out_row.Amount)
-            
-            for row in in_rows:
-                token_amount_deposited = removed.underlying_token_amount(get_token_id(row))
-                if  token_amount_deposited > 0:
-                    
-                    to_withdraw = min(token_amount_deposited, row.Amount)
-                    extra_amount = max(row.Amount - token_amount_deposited, 0)
-                    
-                    unwrapped = removed.withdraw(get_token_id(row), to_withdraw)
-                    portfolio.add_token(unwrapped)
-                    
-                    if extra_amount > 0:
-                        assert(row.TokenPriceEuro > 0)
-                        portfolio.add_buy(get_token_id(row), extra_amount, row.TokenPriceEuro)
-                        tx_df.at[row.name, "Gain/Loss"] = extra_amount * row.TokenPriceEuro
+                if extra_amount > 0:
+                    assert(row.TokenPriceEuro > 0)
+                    portfolio.add_buy(get_token_id(row), extra_amount, row_price(row, portfolio))
+                    tx_df.at[row.name, "Gain/Loss"] = extra_amount * row_price(row, portfolio)
+            else:
+                if np.isnan(row.TokenPriceEuro):
+                    print(f"received unpriced token {row.TokenSymbol}: {row.Amount}")
+                    portfolio.add_buy(get_token_id(row), row_amount(row, portfolio), 0)
                 else:
-                    if np.isnan(row.TokenPriceEuro):
-                        print(f"received unpriced token {row.TokenSymbol}: {row.Amount}")
-                        portfolio.add_buy(get_token_id(row), row.Amount, 0)
-                    else:
-                        assert(row.TokenPriceEuro > 0)
-                        portfolio.add_buy(get_token_id(row), row.Amount, row.TokenPriceEuro)
-                        tx_df.at[row.name, "Gain/Loss"] = row.ValueEuro
-                    
-            tx_df.at[out_row.name, "Cost"] = removed.cost()
-            tx_df.at[out_row.name, "Gain/Loss"] = - removed.cost()
+                    assert(row.TokenPriceEuro > 0)
+                    portfolio.add_buy(get_token_id(row), row_amount(row, portfolio), row_price(row, portfolio))
+                    tx_df.at[row.name, "Gain/Loss"] = row.ValueEuro
+                
+        tx_df.at[out_row.name, "Cost"] = removed.cost()
+        tx_df.at[out_row.name, "Gain/Loss"] = - removed.cost()
 
-    return portfolio, tx_df
+def row_amount(row, portfolio):
+    # amount of the row in the units of the portfolio: tokens, or integer base units if exact
+    if portfolio.exact:
+        portfolio.decimals[get_token_id(row)] = int(row.Decimals)
+        return int(row.Units)
+    return row.Amount
+
+def row_price(row, portfolio):
+    # price per unit of row_amount
+    if portfolio.exact:
+        return row.TokenPriceEuro / 10**int(row.Decimals)
+    return row.TokenPriceEuro
 
 def approx_holdings(portfolio):
+    # in units of the tokens, also for exact portfolios
     
     approx_holdings = {}
 
     for token in portfolio.spot.values():
-        approx_holdings = add_base_tokens(token, approx_holdings)
+        add_base_tokens(token, approx_holdings)
 
     for deposit_contract in portfolio.deposits.values():
-        for token in deposit_contract.deposits.values():
-            approx_holdings = add_base_tokens(token, approx_holdings)
+        for token_id, amount in deposit_contract.leaf_base_token_amounts().items():
+            approx_holdings[token_id] = approx_holdings.get(token_id, 0) + amount
 
+    if portfolio.exact:
+        approx_holdings = {token_id: amount / 10**portfolio.decimals[token_id] for token_id, amount in approx_holdings.items()}
     return approx_holdings
 
+def value_portfolio(portfolio, tokens, price_matrix, day_ordinals):
+    # EUR value of approx_holdings at each day (e.g. day_range(date_start, date_end)), indexed by DateString.
+    # tokens without a price count as 0
+    holdings = approx_holdings(portfolio)
+    token_id2cg_id = get_token_id2cg_id(tokens)
+    token_ids = [token_id for token_id in holdings.keys() if token_id != "EUR"]
+
+    columns = price_matrix.token_columns([token_id2cg_id.get(token_id) for token_id in token_ids])
+    holding_amounts = np.array([holdings[token_id] for token_id in token_ids], dtype=float)
+    amounts = np.zeros(len(price_matrix.cg_ids))
+    np.add.at(amounts, columns[columns >= 0], holding_amounts[columns >= 0])
+
+    values = price_matrix.value(amounts, day_ordinals) + holdings.get("EUR", 0)
+    return pd.Series(values, index=day_ordinals_to_strings(day_ordinals))
+
+class HoldingsHistory:
+    # sparse daily changes of approx_holdings and of the portfolio cost basis during a replay. the holdings are
+    # compared once at the end of each day with transactions, and only the tokens whose amount changed are kept
+    def __init__(self):
+        self.first_day = None
+        self.day = None
+        self.last_holdings = {}
+        self.last_cost = 0
+        self.days = []
+        self.token_ids = []
+        self.deltas = []
+        self.cost_days = []
+        self.cost_deltas = []
+
+    def before_tx(self, tx_rows, portfolio):
+        day = int(tx_rows["TimeStamp"].iloc[0]) // 86400
+        if self.day is not None and day != self.day:
+            self.record(self.day, portfolio)
+        if self.first_day is None:
+            self.first_day = day
+        self.day = day
+
+    def close(self, portfolio):
+        if self.day is not None:
+            self.record(self.day, portfolio)
+
+    def record(self, day, portfolio):
+        holdings = approx_holdings(portfolio)
+        for token_id in set(holdings) | set(self.last_holdings):
+            delta = holdings.get(token_id, 0) - self.last_holdings.get(token_id, 0)
+            if delta != 0:
+                self.days.append(day)
+                self.token_ids.append(token_id)
+                self.deltas.append(delta)
+        self.last_holdings = holdings
+
+        cost = portfolio.cost()
+        if cost != self.last_cost:
+            self.cost_days.append(day)
+            self.cost_deltas.append(cost - self.last_cost)
+        self.last_cost = cost
+
+    def holdings(self, day_ordinals):
+        # (days x token_ids) amounts held at the end of each day, by cumulative sum of the deltas
+        token_ids, codes = np.unique(np.array(self.token_ids, dtype=object), return_inverse=True)
+        rows = np.searchsorted(day_ordinals, np.array(self.days, dtype="int64"))
+        in_range = rows < len(day_ordinals)
+        changes = np.zeros((len(day_ordinals), len(token_ids)))
+        np.add.at(changes, (rows[in_range], codes[in_range]), np.array(self.deltas)[in_range])
+        return np.cumsum(changes, axis=0), list(token_ids)
+
+    def cost_basis(self, day_ordinals):
+        rows = np.searchsorted(day_ordinals, np.array(self.cost_days, dtype="int64"))
+        in_range = rows < len(day_ordinals)
+        changes = np.zeros(len(day_ordinals))
+        np.add.at(changes, rows[in_range], np.array(self.cost_deltas)[in_range])
+        return np.cumsum(changes)
+
+    def daily_series(self, tokens, price_matrix, day_ordinals=None):
+        # Value, CostBasis and UnrealizedGain at the end of each day, indexed by DateString. by default from the
+        # first to the last day with transactions. like value_portfolio, EUR counts at 1 and unpriced tokens as 0
+        if day_ordinals is None:
+            day_ordinals = np.arange(self.first_day, self.day + 1) if self.day is not None else np.array([], dtype="int64")
+        day_ordinals = np.asarray(day_ordinals, dtype="int64")
+
+        holdings, token_ids = self.holdings(day_ordinals)
+        token_id2cg_id = get_token_id2cg_id(tokens)
+        columns = price_matrix.token_columns([token_id2cg_id.get(token_id) for token_id in token_ids])
+        prices = np.zeros(holdings.shape)
+        prices[:, columns >= 0] = np.nan_to_num(price_matrix.prices_at(day_ordinals)[:, columns[columns >= 0]])
+        prices[:, np.array(token_ids, dtype=object) == "EUR"] = 1
+
+        values = (holdings * prices).sum(axis=1)
+        cost_basis = self.cost_basis(day_ordinals)
+        return pd.DataFrame({"Value": values, "CostBasis": cost_basis, "UnrealizedGain": values - cost_basis},
+                            index=day_ordinals_to_strings(day_ordinals))
+
 def add_base_tokens(token, d):
-    if type(token) == BaseToken:
-        return dict_union_sum(d, {token.token_id: token.amount()})
-    elif type(token) == LiquidDepositToken:
-        for deposit in token.deposits.values():
-            d = add_base_tokens(deposit, d)
-        return d
+    # adds the leaf amounts of token to d in place
+    if type(token) in [BaseToken, LiquidDepositToken]:
+        return add_leaf_amounts(token, d)
     else:
         print(token)
         raise Exception
-
@@ -0,0 +1,106 @@
+import os
+import time
+import traceback
+import multiprocessing
+from concurrent.futures import ThreadPoolExecutor
+import pandas as pd
+from sources.prices import PriceMatrix
+from sources.utils import merge_tx_df_with_prices
+from sources.accounting import compute_portfolio_and_gains
+import sources.io_utils as io_utils
+
+# Accounting for many wallets. Fetching and method decoding stay in this process (threads), so that all wallets share
+# the http clients and their rate limits. Tokens are matched and prices fetched once for the union of all wallets.
+# Pricing and accounting are pure per wallet and run in a process pool: the price matrix is placed in shared memory
+# and mapped by each worker, the token table is passed once per worker, only the wallet's own frame is pickled per task.
+
+class WalletResult:
+    def __init__(self, address, portfolio=None, tx_df=None, timings=None, error=None):
+        self.address = address
+        self.portfolio = portfolio
+        self.tx_df = tx_df
+        self.timings = timings or {}
+        self.error = error
+
+def load_wallet_tx_df(address, platforms, time_start, time_end, data_dir="./data/", offline=False):
+    platform_dfs = []
+    for platform in platforms:
+        etherscan_dfs = io_utils.get_or_load_etherscan_dfs(time_start, time_end, data_dir, address, explorer=io_utils.get_explorer(platform))
+        platform_dfs.append(io_utils.combine_etherscan_dfs(etherscan_dfs, address, platform=platform, offline=offline))
+    tx_df = pd.concat(platform_dfs, ignore_index=True)
+    tx_df.sort_values("TimeStamp", inplace=True)
+    return tx_df
+
+def load_wallet_tx_dfs(wallets, time_start, time_end, data_dir="./data/", offline=False, max_workers=4):
+    # wallets: list of (address, platforms). returns {address: tx_df} and {address: seconds}
+    def load(wallet):
+        address, platforms = wallet
+        start = time.perf_counter()
+        tx_df = load_wallet_tx_df(address, platforms, time_start, time_end, data_dir, offline)
+        return address, tx_df, time.perf_counter() - start
+
+    with ThreadPoolExecutor(max_workers) as executor:
+        loaded = list(executor.map(load, wallets))
+    return {address: tx_df for address, tx_df, _ in loaded}, {address: seconds for address, _, seconds in loaded}
+
+def get_tokens(tx_dfs):
+    tokens = pd.concat([tx_df[["TokenName", "TokenSymbol"]] for tx_df in tx_dfs], ignore_index=True)
+    return tokens.drop_duplicates().reset_index(drop=True)
+
+worker_state = {}
+
+def init_worker(tokens, price_matrix_spec):
+    worker_state["tokens"] = tokens
+    worker_state["price_matrix"] = PriceMatrix.from_shared_memory(price_matrix_spec)
+
+def account_wallet(address, tx_df, engine="grouped", method=None, jurisdiction=None):
+    timings = {}
+    try:
+        start = time.perf_counter()
+        tx_df_priced = merge_tx_df_with_prices(tx_df, worker_state["tokens"], worker_state["price_matrix"])
+        timings["prices"] = time.perf_counter() - start
+
+        start = time.perf_counter()
+        portfolio, tx_df_gains = compute_portfolio_and_gains(tx_df_priced, engine, method, jurisdiction)
+        timings["accounting"] = time.perf_counter() - start
+    except Exception:
+        # one broken wallet must not abort the batch
+        return WalletResult(address, timings=timings, error=traceback.format_exc())
+
+    return WalletResult(address, portfolio, tx_df_gains, timings)
+
+def account_wallets(tx_dfs, tokens, price_matrix, processes=None, engine="grouped", method=None, jurisdiction=None):
+    # tx_dfs: {address: combined tx_df}. returns {address: WalletResult} in the order of tx_dfs
+    processes = processes or os.cpu_count()
+    shm, spec = price_matrix.to_shared_memory()
+    try:
+        with multiprocessing.Pool(min(processes, max(len(tx_dfs), 1)), initializer=init_worker, initargs=(tokens, spec)) as pool:
+            pending = {address: pool.apply_async(account_wallet, (address, tx_df, engine, method, jurisdiction))
+                       for address, tx_df in tx_dfs.items()}
+            return {address: result.get() for address, result in pending.items()}
+    finally:
+        shm.close()
+        shm.unlink()
+
+def run_batch(wallets, time_start, time_end, data_dir="./data/", processes=None, engine="grouped", method=None, jurisdiction=None, offline=False):
+    # wallets: list of (address, platforms), e.g. [("0xa2e1...", ["ethereum", "arbitrum"])]
+    tx_dfs, fetch_seconds = load_wallet_tx_dfs(wallets, time_start, time_end, data_dir, offline)
+
+    tokens = io_utils.match_tokens_to_coingecko(get_tokens(tx_dfs.values()))
+    cg_ids = tokens[tokens["cg_id"].notnull()]["cg_id"].unique()
+    price_matrix = io_utils.get_price_matrix(cg_ids, time_start, time_end, data_dir + "store/price_matrix", io_utils.get_price_sources(offline))
+
+    results = account_wallets(tx_dfs, tokens, price_matrix, processes, engine, method, jurisdiction)
+    for address, result in results.items():
+        result.timings["fetch"] = fetch_seconds[address]
+    return results
+
+def summarize(results):
+    # one row per wallet: rows, stage timings, error
+    rows = []
+    for address, result in results.items():
+        row = {"address": address, "rows": len(result.tx_df) if result.tx_df is not None else 0}
+        row.update(result.timings)
+        row["error"] = result.error.strip().split("\n")[-1] if result.error else None
+        rows.append(row)
+    return pd.DataFrame(rows)
@@ -1,11 +1,16 @@
 from enum import IntEnum, auto
+from collections import deque
+from fractions import Fraction
+import heapq
 import numpy as np
-from sources.utils import get_platform, is_priced_token_in, is_priced_token_out, is_unpriced_token_in, is_unpriced_token_out
-from sources.utils import get_method, get_contract_id, get_token_id, dict_union_sum
+from sources.utils import get_row_flags, get_token_id
+from sources import instrumentation
 
 EPS = 1e-10
 
 class Buy:
+    __slots__ = ("token_id", "count", "cost_basis")
+
     def __init__(self, token_id: str, count:float, cost_basis:float):
         assert cost_basis >= 0
         assert count > 0
@@ -19,11 +24,139 @@ class Buy:
     def __str__(self):
         return f"token: {self.token_id} amount: {self.count} cost_basis: {self.cost_basis}"
 
+class CostBasisMethod(IntEnum):
+    LIFO = auto()
+    FIFO = auto()
+    HIFO = auto()
+    AVERAGE = auto()
+
+# default method per jurisdiction, check the local rules before relying on it
+JURISDICTION_COST_BASIS = {
+    "DE": CostBasisMethod.FIFO,
+    "US": CostBasisMethod.FIFO,
+    "UK": CostBasisMethod.AVERAGE,
+    "CA": CostBasisMethod.AVERAGE,
+}
+
+def get_cost_basis_method(method=None, jurisdiction=None):
+    if method is not None:
+        return CostBasisMethod(method)
+    elif jurisdiction is not None:
+        return JURISDICTION_COST_BASIS[jurisdiction]
+    else:
+        return CostBasisMethod.LIFO
+
+# Lot containers: push adds a lot, peek returns the lot consumed next by a removal, take drops it, in_order iterates
+# the lots in the order removals consume them.
+
+class LifoLots(list):
+    def push(self, buy):
+        self.append(buy)
+
+    def peek(self):
+        return self[-1]
+
+    def take(self):
+        return self.pop()
+
+    def in_order(self):
+        return reversed(self)
+
+class FifoLots(deque):
+    def push(self, buy):
+        self.append(buy)
+
+    def peek(self):
+        return self[0]
+
+    def take(self):
+        return self.popleft()
+
+    def in_order(self):
+        return iter(self)
+
+class HifoLots:
+    # heap keyed on highest cost basis, oldest lot first among equal cost basis
+    def __init__(self):
+        self.heap = []
+        self.counter = 0
+
+    def push(self, buy):
+        heapq.heappush(self.heap, (-buy.cost_basis, self.counter, buy))
+        self.counter += 1
+
+    def peek(self):
+        return self.heap[0][2]
+
+    def take(self):
+        return heapq.heappop(self.heap)[2]
+
+    def in_order(self):
+        return (entry[2] for entry in sorted(self.heap))
+
+    def __iter__(self):
+        return (entry[2] for entry in self.heap)
+
+    def __len__(self):
+        return len(self.heap)
+
+class AverageLots:
+    # all lots are pooled into a single one at the running average cost basis
+    def __init__(self):
+        self.pool = None
+
+    def push(self, buy):
+        if self.pool is None:
+            self.pool = buy
+        else:
+            count = self.pool.count + buy.count
+            self.pool.cost_basis = (self.pool.count * self.pool.cost_basis + buy.count * buy.cost_basis) / count
+            self.pool.count = count
+
+    def peek(self):
+        if self.pool is None:
+            raise IndexError("no lots")
+        return self.pool
+
+    def take(self):
+        pool = self.peek()
+        self.pool = None
+        return pool
+
+    def __iter__(self):
+        return iter([] if self.pool is None else [self.pool])
+
+    def in_order(self):
+        return iter(self)
+
+    def __len__(self):
+        return 0 if self.pool is None else 1
+
+LOTS_BY_METHOD = {
+    CostBasisMethod.LIFO: LifoLots,
+    CostBasisMethod.FIFO: FifoLots,
+    CostBasisMethod.HIFO: HifoLots,
+    CostBasisMethod.AVERAGE: AverageLots,
+}
+
 class Token:
+    # amounts are floats in units of the token, or ints in base units of the token (wei, 10**-decimals) if exact.
+    # integer amounts make every comparison with EPS exact: a removal ends when nothing is left to remove, and a lot
+    # or deposit is dropped only when it is empty. python ints, as balances in wei exceed int64 above 9.2 tokens
+    exact = False
+
     def __init__(self, token_id: str):
         if token_id is None:
             raise Exception("token_id is None")
         self.token_id = token_id
+
+    def scale_amount(self, amount, scale):
+        # exact amounts stay integers, rounded down. scale is a Fraction for exact tokens, a float would lose the low
+        # digits of amounts above 2**53
+        if self.exact:
+            scale = Fraction(scale)
+            return amount * scale.numerator // scale.denominator
+        return amount * scale
         
     def amount(self):
         # return amount
@@ -56,45 +189,78 @@ class Token:
         
     
 class BaseToken(Token):
+    # buys is the lot ledger, running totals of amount and cost are maintained on every change
     
-    def __init__(self, token_id: str, buy:Buy=None):
+    def __init__(self, token_id: str, buy:Buy=None, method:CostBasisMethod=CostBasisMethod.LIFO, exact:bool=False):
         super().__init__(token_id)
-        self.buys = []
+        self.method = method
+        self.exact = exact
+        self.buys = LOTS_BY_METHOD[method]()
+        self._amount = 0
+        self._cost = 0
         if buy:
-            self.buys.append(buy)
+            self._push(buy)
+
+    def _push(self, buy:Buy):
+        assert type(buy.count) == int or not self.exact
+        self._amount += buy.count
+        self._cost += buy.count * buy.cost_basis
+        self.buys.push(buy)
         
     def add_buy(self, count:float, cost_basis:float):
-        self.buys.append(Buy(self.token_id, count, cost_basis))
+        if instrumentation.enabled:
+            instrumentation.count("lots_created")
+        self._push(Buy(self.token_id, count, cost_basis))
         
     def add_token(self, other_token):
+        # takes over the lots of other_token, which should not be used afterwards
         assert type(other_token) == BaseToken
         assert self.token_id == other_token.token_id
-        self.buys = self.buys + other_token.buys        
+        assert self.method == other_token.method
+        assert self.exact == other_token.exact
+        for buy in other_token.buys:
+            self._push(buy)
         
     def amount(self):
-        return sum([buy.count for buy in self.buys])
+        return self._amount
     
     def cost(self):
-        return sum([buy.count * buy.cost_basis for buy in self.buys])
+        return self._cost
     
     def remove(self, amount):
         amount_to_remove = amount
-        removed_token = BaseToken(self.token_id)
+        removed_token = BaseToken(self.token_id, method=self.method, exact=self.exact)
         
         while amount_to_remove > EPS:
-            # LIFO method
+            # lots are consumed in the order of self.method
             if len(self.buys) == 0:
                 print(f"empty buys, {self}, left to remove: {amount_to_remove}")
-            buy = self.buys.pop()
+            buy = self.buys.peek()
+            old_amount = buy.count
 
             to_remove_from_buy = min(amount_to_remove, buy.count)
             amount_to_remove = amount_to_remove - to_remove_from_buy
             new_amount = buy.count - to_remove_from_buy
             
-            removed_token.add_buy(to_remove_from_buy, buy.cost_basis)
-            
             if new_amount > EPS:
-                self.add_buy(new_amount,  buy.cost_basis)
+                # split the lot in place, only the removed part is a new record
+                removed_token.add_buy(to_remove_from_buy, buy.cost_basis)
+                buy.count = new_amount
+            else:
+                # move the whole lot, dropping dust below EPS
+                if instrumentation.enabled:
+                    instrumentation.count("lots_consumed")
+                self.buys.take()
+                buy.count = to_remove_from_buy
+                removed_token._push(buy)
+                new_amount = 0
+
+            self._amount += new_amount - old_amount
+            self._cost += (new_amount - old_amount) * buy.cost_basis
+
+        if len(self.buys) == 0:
+            self._amount = 0
+            self._cost = 0
                 
         assert(np.abs(removed_token.amount() - amount) < EPS)
         return removed_token
@@ -102,31 +268,73 @@ class BaseToken(Token):
     def remove_ratio(self, remove_ratio):
         assert(remove_ratio <= 1)
         assert(remove_ratio >= 0)
-        return self.remove(self.amount() * remove_ratio)
+        return self.remove(self.scale_amount(self.amount(), remove_ratio))
         
         
 class LiquidDepositToken(Token):
-    def __init__(self, token_id: str, deposit_tokens: dict[str, Token], amount):
+    # a partial removal does not touch the deposits: the removed token and self share them, each through windows.
+    # a window (start, end) is the part of a deposit between start and end as fractions of its amount, in the order its
+    # lots are consumed by removals. end None is the rest of the deposit, which keeps the order of its lots, a removed
+    # part has its lots in the order they were removed, so windows on it apply after the first. shared deposits are never
+    # changed in place, _own_deposits first replaces them by their windows, which removes the lots in the order of their
+    # cost basis method as if each removal had been applied to every deposit.
+    # leaf_base_token_amounts is memoized, every method changing the deposits below this token clears it
+    windows = ()
+    _leaf_amounts = None
+
+    def __init__(self, token_id: str, deposit_tokens: dict[str, Token], amount, exact:bool=False):
         super().__init__(token_id)
         assert type(deposit_tokens) == dict
         self.deposits = deposit_tokens
         self.count = amount
+        self.exact = exact
     
     def amount(self):
         return self.count
+
+    def window_amount(self, amount):
+        # amount of a deposit within self.windows
+        for start, end in self.windows:
+            skipped = self.scale_amount(amount, start)
+            amount = amount - skipped if end is None else self.scale_amount(amount, end) - skipped
+        return amount
     
     def underlying_token_amount(self, token_id):
         if token_id in self.deposits.keys():
-            return self.deposits[token_id].amount()
+            return self.window_amount(self.deposits[token_id].amount())
         else:
             return 0
         
     def cost(self):
+        # the cost of a window depends on the lots in it
+        self._own_deposits()
         return sum([token.cost() for token in self.deposits.values()])
+
+    def _own_deposits(self):
+        if len(self.windows) > 0:
+            self.deposits = {token_id: self._window_copy(token) for token_id, token in self.deposits.items()}
+            self.deposits = {token_id: token for token_id, token in self.deposits.items() if token.amount() > EPS}
+            self.windows = ()
+
+    def _window_copy(self, token):
+        if type(token) == BaseToken:
+            for start, end in self.windows:
+                token = base_token_window(token, start, end)
+            return token
+        else:
+            # nested liquid tokens are copied lazily
+            copied = LiquidDepositToken(token.token_id, token.deposits, self.window_amount(token.count), token.exact)
+            copied.windows = token.windows
+            for start, end in self.windows:
+                copied.windows = append_window(copied.windows, start, end)
+            return copied
     
     def add_token(self, other_token):
         assert type(other_token) == LiquidDepositToken
         assert self.token_id == other_token.token_id
+        assert self.exact == other_token.exact
+        self._own_deposits()
+        other_token._own_deposits()
         
         for key in other_token.deposits.keys():
             if key in self.deposits.keys():
@@ -135,41 +343,91 @@ class LiquidDepositToken(Token):
                 self.deposits[key] = other_token.deposits[key]
                 
         self.count = self.count + other_token.count 
+        self._leaf_amounts = None
         
     def remove_ratio(self, ratio):
-        removed_amount = self.count * ratio
+        assert(ratio <= 1)
+        assert(ratio >= 0)
+        if self.exact:
+            return self.remove(self.scale_amount(self.count, ratio))
+        return self._remove(self.scale_amount(self.count, ratio), ratio)
+
+    def _remove(self, removed_amount, ratio):
+        # O(1), the deposits are not touched
         self.count = self.count - removed_amount
-        
-        return LiquidDepositToken(self.token_id, 
-                                  {deposit.token_id: deposit.remove_ratio(ratio) for deposit in self.deposits.values()}, 
-                                  removed_amount)
+
+        removed = LiquidDepositToken(self.token_id, self.deposits, removed_amount, self.exact)
+        removed.windows = append_window(self.windows, 0, ratio)
+        self.windows = append_window(self.windows, ratio, None)
+        self._leaf_amounts = None
+        return removed
 
     def leaf_base_token_amounts(self):
-        base_tokens = {}
-        for token in self.deposits.values():
-            if type(token) == BaseToken:
-                base_tokens[token.token_id] = base_tokens.get(token.token_id, 0) + token.amount()
-            else:
-                base_tokens = dict_union_sum(base_tokens, token.leaf_base_token_amounts())
-        return base_tokens
+        # cached, must not be modified by the caller
+        if self._leaf_amounts is None:
+            leaf_amounts = sum_leaf_amounts(self.deposits.values())
+            if len(self.windows) > 0:
+                leaf_amounts = {token_id: self.window_amount(amount) for token_id, amount in leaf_amounts.items()}
+            self._leaf_amounts = leaf_amounts
+        return self._leaf_amounts
             
     def remove(self, amount):
-        ratio = amount / self.count
-        return self.remove_ratio(ratio)
+        # exact amounts are removed as given, the windows are exact fractions of the amount
+        if self.exact:
+            return self._remove(amount, Fraction(amount, self.count))
+        return self.remove_ratio(amount / self.count)
     
     def withdraw(self, token_id, amount):
+        self._own_deposits()
+        self._leaf_amounts = None
         return self.deposits[token_id].remove(amount)
 
     def __str__(self):
-        return f"{self.token_id}: {self.amount()} (deposits: " + " ".join([x.__str__() for x in self.deposits.values()]) + ")"
+        windows = f" in {list(self.windows)}" if len(self.windows) > 0 else ""
+        return f"{self.token_id}: {self.amount()} (deposits{windows}: " + " ".join([x.__str__() for x in self.deposits.values()]) + ")"
+
+def append_window(windows, start, end):
+    # a window on the rest of a deposit is a window on the deposit itself
+    if len(windows) > 0 and windows[-1][1] is None:
+        offset = windows[-1][0]
+        return windows[:-1] + ((offset + start * (1 - offset), None if end is None else offset + end * (1 - offset)),)
+    return windows + ((start, end),)
+
+def base_token_window(token, start, end):
+    # copy of the lots of token within the window, token is not changed
+    skip = token.scale_amount(token.amount(), start)
+    take = None if end is None else token.scale_amount(token.amount(), end) - skip
+    lots = []
+    for buy in token.buys.in_order():
+        if take is not None and take <= EPS:
+            break
+        count = buy.count - min(skip, buy.count)
+        skip = skip - (buy.count - count)
+        if take is not None:
+            count = min(count, take)
+            take = take - count
+        if count > EPS:
+            lots.append(Buy(token.token_id, count, buy.cost_basis))
+
+    # the rest keeps the order of the lots, a removed part is pushed in the order it was removed
+    if end is None and token.method == CostBasisMethod.LIFO:
+        lots.reverse()
+    copied = BaseToken(token.token_id, method=token.method, exact=token.exact)
+    for buy in lots:
+        copied._push(buy)
+    return copied
     
     
 class DepositContract:
+    # leaf_base_token_amounts is memoized like on LiquidDepositToken
+    _leaf_amounts = None
+
     def __init__(self, contract_id):
         self.contract_id = contract_id
         self.deposits = {}
         
     def deposit(self, token):
+        self._leaf_amounts = None
         if token.token_id not in self.deposits.keys():
             self.deposits[token.token_id] = token
         else:
@@ -183,6 +441,7 @@ class DepositContract:
             return 0
             
     def withdraw(self, token_id, amount):
+        self._leaf_amounts = None
         removed =  self.deposits[token_id].remove(amount)
         if self.deposits[token_id].amount() < EPS:
             self.deposits.pop(token_id, None)
@@ -199,13 +458,10 @@ class DepositContract:
             return False
 
     def leaf_base_token_amounts(self):
-        base_tokens = {}
-        for token in self.deposits.values():
-            if type(token) == BaseToken:
-                base_tokens[token.token_id] = base_tokens.get(token.token_id, 0) + token.amount()
-            else:
-                base_tokens = dict_union_sum(base_tokens, token.leaf_base_token_amounts())
-        return base_tokens
+        # cached, must not be modified by the caller
+        if self._leaf_amounts is None:
+            self._leaf_amounts = sum_leaf_amounts(self.deposits.values())
+        return self._leaf_amounts
         
     def __repr__(self):
         return self.__str__()
@@ -216,14 +472,35 @@ class DepositContract:
             string += f"{self.deposits[key]} \n"
         return string
     
+def add_leaf_amounts(token, leaf_amounts):
+    # adds the base token amounts held through token to leaf_amounts, in place
+    if type(token) == BaseToken:
+        leaf_amounts[token.token_id] = leaf_amounts.get(token.token_id, 0) + token.amount()
+    else:
+        for token_id, amount in token.leaf_base_token_amounts().items():
+            leaf_amounts[token_id] = leaf_amounts.get(token_id, 0) + amount
+    return leaf_amounts
+
+def sum_leaf_amounts(tokens):
+    leaf_amounts = {}
+    for token in tokens:
+        add_leaf_amounts(token, leaf_amounts)
+    return leaf_amounts
+
 class Portfolio:
-    def __init__(self):
+    # exact: amounts in integer base units (see Token), decimals maps token_id to the decimals of its base unit
+    exact = False
+
+    def __init__(self, method:CostBasisMethod=None, jurisdiction:str=None, exact:bool=False):
         self.spot = {}
         self.deposits = {}
+        self.method = get_cost_basis_method(method, jurisdiction)
+        self.exact = exact
+        self.decimals = {}
         
     def add_buy(self, token_id: str, amount: float, cost_basis: float):
         if token_id not in self.spot.keys():
-            self.spot[token_id] = BaseToken(token_id)
+            self.spot[token_id] = BaseToken(token_id, method=self.method, exact=self.exact)
             
         self.spot[token_id].add_buy(amount, cost_basis)
         
@@ -243,7 +520,7 @@ class Portfolio:
         self.deposits[contract_id].deposit(token_to_deposit)
         
     def liquid_deposit(self, liquid_token_id: str, liquid_token_amount: float, deposits: dict[str, Token]):
-        liquid_token = LiquidDepositToken(liquid_token_id, deposits, liquid_token_amount)
+        liquid_token = LiquidDepositToken(liquid_token_id, deposits, liquid_token_amount, self.exact)
         
         if liquid_token_id in self.spot.keys():
             self.spot[liquid_token_id].add_token(liquid_token)
@@ -331,26 +608,25 @@ class RowType(IntEnum):
     ERROR = auto()
 
 class TxData:
-    
-    def __init__(self, tx_rows, portfolio, verbose = False):
+    # tx: a row of the transaction, with the columns computed for the whole frame (accounting.TX_COLUMNS)
+    # tx_type: the category of TX_RULES (accounting.classify_frame), None for the transactions they leave open
+
+    def __init__(self, tx_rows, portfolio, tx, tx_type=None, verbose = False):
         self.tx_rows = tx_rows
-        self.method = get_method(tx_rows)
-        self.contract_id = get_contract_id(tx_rows)
-        self.platform = get_platform(tx_rows)
-        
-        self.num_priced_tokens_in    = sum(tx_rows.apply(is_priced_token_in, axis = 1))
-        self.num_priced_tokens_out   = sum(tx_rows.apply(is_priced_token_out, axis = 1))
-        self.num_unpriced_tokens_in  = sum(tx_rows.apply(is_unpriced_token_in, axis = 1))
-        self.num_unpriced_tokens_out = sum(tx_rows.apply(is_unpriced_token_out, axis = 1))
+        self.method = tx["TxMethod"]
+        self.contract_id = tx["TxContract"]
+        self.platform = tx["Platform"]
+
+        self.num_priced_tokens_in    = int(tx["NumPricedIn"])
+        self.num_priced_tokens_out   = int(tx["NumPricedOut"])
+        self.num_unpriced_tokens_in  = int(tx["NumUnpricedIn"])
+        self.num_unpriced_tokens_out = int(tx["NumUnpricedOut"])
         
         self.num_in = self.num_priced_tokens_in + self.num_unpriced_tokens_in
         self.num_out = self.num_priced_tokens_out + self.num_unpriced_tokens_out
         
         self.tx_type = None
-        
-        txids = tx_rows["Hash"].unique()
-        assert len(txids) == 1
-        self.tx_id = txids[0]
+        self.tx_id = tx["Hash"]
         
         if (verbose):
             print(f"tx_id: {self.tx_id}")
@@ -363,60 +639,30 @@ class TxData:
             print(f"num_unpriced_tokens_in: {self.num_unpriced_tokens_in}")
             print(f"num_unpriced_tokens_out: {self.num_unpriced_tokens_out}")
         
-        else: 
-            if self.num_in == 0 and self.num_out == 0:
-                
-                self.tx_type = TxType.FEE_ONLY
-                
-            elif self.method is None and self.num_in > 0 and self.num_out == 0:
-                
-                self.tx_type = TxType.TRANSFER_IN
-                    
-            elif self.num_in == 0 and self.num_out > 0:
-                if self.method.lower() == "transfer":
-                    self.tx_type = TxType.TRANSFER_OUT
-                else:
-                    self.tx_type = TxType.CONTRACT_DEPOSIT
-                    
-            elif self.num_in > 0 and self.num_out == 0:
-                
-                if self.method.lower() == "transfer":
-                    self.tx_type = TxType.TRANSFER_IN
-                else:
-                    self.tx_type = TxType.CONTRACT_WITHDRAW
-                
-            elif self.num_priced_tokens_in == 1 and self.num_priced_tokens_out > 0:
-                
-                if self.num_priced_tokens_out > 1:
-                    raise Exception("swap for multiple priced tokens")
-                
-                self.tx_type = TxType.SWAP
-                
-            
-            elif self.num_out == 1 and self.num_unpriced_tokens_out == 1 and (self.num_in > 1 or self.num_priced_tokens_in > 0):
-                
-                self.tx_type = TxType.LIQUID_WITHDRAW
-                
-            elif self.num_out == 1 and self.num_unpriced_tokens_out == 1 and self.num_in == 1 and self.num_unpriced_tokens_in == 1:
-                
-                in_token_id = get_token_id(tx_rows[tx_rows.apply(is_unpriced_token_in, axis = 1)].iloc[0])
-                out_token_id = get_token_id(tx_rows[tx_rows.apply(is_unpriced_token_out, axis = 1)].iloc[0])
-                out_deposits = portfolio.spot[out_token_id].deposits
-                
-                if in_token_id in out_deposits.keys() and out_deposits[in_token_id].amount() > 0:
-                    self.tx_type = TxType.LIQUID_WITHDRAW 
-                else:
-                    self.tx_type = TxType.LIQUID_DEPOSIT 
-                    
-            elif self.num_in == 1 and self.num_unpriced_tokens_in == 1 and self.num_out > 0:
-                
-                self.tx_type = TxType.LIQUID_DEPOSIT
-                
-            else:
-                self.tx_type = TxType.ERROR
-            
+        else:
+            self.tx_type = tx_type if tx_type is not None else self.resolve_tx_type(tx_rows, portfolio)
+
         if (verbose):
             print(f"tx_type: {self.tx_type}")
 
+    def resolve_tx_type(self, tx_rows, portfolio):
+        # the transactions TX_RULES leave open
+        if self.method is None and self.num_in == 0:
+            raise Exception("tokens out without a method")
+
+        elif self.num_priced_tokens_in == 1 and self.num_priced_tokens_out > 1:
+            raise Exception("swap for multiple priced tokens")
+
+        elif self.num_out == 1 and self.num_unpriced_tokens_out == 1 and self.num_in == 1 and self.num_unpriced_tokens_in == 1:
 
+            flags = get_row_flags(tx_rows)
+            in_token_id = get_token_id(tx_rows[flags["IsUnpriced"] & flags["IsIn"]].iloc[0])
+            out_token_id = get_token_id(tx_rows[flags["IsUnpriced"] & flags["IsOut"]].iloc[0])
+            out_token = portfolio.spot[out_token_id]
+
+            if out_token.underlying_token_amount(in_token_id) > 0:
+                return TxType.LIQUID_WITHDRAW
+            else:
+                return TxType.LIQUID_DEPOSIT
 
+        return TxType.ERROR
@@ -0,0 +1,99 @@
+import os
+import json
+import pickle
+import threading
+import pandas as pd
+from pycoingecko import CoinGeckoAPI
+from sources.store import write_atomic
+
+# CoinGecko coin list indexed for token matching: lowercase symbol -> candidate coins, normalized name -> coin ids.
+# The index is compiled once from the coin list (a pickled get_coins_list() at COIN_LIST, fetched if missing) and kept
+# as json. Ambiguous or wrong matches are fixed in USER_OVERRIDES, a csv with the columns TokenSymbol, TokenName and
+# cg_id: an empty TokenName applies to every name of the symbol, an empty cg_id leaves the token unpriced.
+
+COIN_LIST = "./data/cg_tokens.pickle"
+COMPILED_INDEX = "./data/cg_coin_index.json"
+USER_OVERRIDES = "./data/token_overrides.csv"
+
+# (symbol, name or None for any name): cg_id or None
+DEFAULT_OVERRIDES = {("SLP", None): None}
+
+def normalize_name(name):
+    return " ".join(name.lower().split())
+
+class CoinIndex:
+    def __init__(self, symbols, names):
+        self.symbols = symbols
+        self.names = names
+
+    @classmethod
+    def from_coin_list(cls, coin_list):
+        # coin_list: [{"id", "symbol", "name"}], bridged copies (Wormhole) are left out
+        symbols = {}
+        names = {}
+        for coin in coin_list:
+            if "Wormhole" in coin["name"]:
+                continue
+            symbols.setdefault(coin["symbol"].lower(), []).append([coin["id"], coin["name"]])
+            names.setdefault(normalize_name(coin["name"]), []).append(coin["id"])
+        return cls(symbols, names)
+
+    def save(self, filepath):
+        os.makedirs(os.path.dirname(filepath) or ".", exist_ok=True)
+        write_atomic(filepath, lambda path: json.dump({"symbols": self.symbols, "names": self.names}, open(path, "w")))
+
+    @classmethod
+    def load(cls, filepath):
+        index = json.load(open(filepath))
+        return cls(index["symbols"], index["names"])
+
+    def candidates(self, symbol):
+        return self.symbols.get(symbol.lower(), [])
+
+    def match(self, name, symbol):
+        # the only coin with the symbol, else the only one whose name is part of the token name, else the only one
+        # with the same normalized name. None if there is no match or it stays ambiguous
+        candidates = self.candidates(symbol)
+        if len(candidates) == 1:
+            return candidates[0][0]
+
+        contained = [cg_id for cg_id, cg_name in candidates if cg_name.lower() in name.lower()]
+        if len(contained) == 1:
+            return contained[0]
+
+        same_name = set(self.names.get(normalize_name(name), [])) & {cg_id for cg_id, _ in candidates}
+        if len(same_name) == 1:
+            return same_name.pop()
+        return None
+
+coin_index = None
+coin_index_lock = threading.Lock()
+
+def get_coin_index():
+    # compiles the coin list when the index is missing or older than it, once for all threads
+    global coin_index
+    with coin_index_lock:
+        if coin_index is None:
+            if not os.path.exists(COMPILED_INDEX) or (os.path.exists(COIN_LIST) and os.path.getmtime(COMPILED_INDEX) < os.path.getmtime(COIN_LIST)):
+                if os.path.exists(COIN_LIST):
+                    coin_list = pickle.load(open(COIN_LIST, "rb"))
+                else:
+                    coin_list = CoinGeckoAPI().get_coins_list()
+                CoinIndex.from_coin_list(coin_list).save(COMPILED_INDEX)
+            coin_index = CoinIndex.load(COMPILED_INDEX)
+        return coin_index
+
+def load_overrides():
+    overrides = dict(DEFAULT_OVERRIDES)
+    if os.path.exists(USER_OVERRIDES):
+        df = pd.read_csv(USER_OVERRIDES, dtype=str, keep_default_na=False)
+        for symbol, name, cg_id in zip(df["TokenSymbol"], df["TokenName"], df["cg_id"]):
+            overrides[(symbol, name or None)] = cg_id or None
+    return overrides
+
+def resolve_token(name, symbol, index, overrides):
+    # returns (cg_id, overridden)
+    for key in [(symbol, name), (symbol, None)]:
+        if key in overrides:
+            return overrides[key], True
+    return index.match(name, symbol), False
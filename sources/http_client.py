@@ -0,0 +1,112 @@
+import time
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import urlparse
+import requests
+from requests.adapters import HTTPAdapter
+from sources import instrumentation
+
+# requests per second allowed by each api (free tiers)
+RATE_LIMITS = {
+    "api.etherscan.io": 5,
+    "api.arbiscan.io": 5,
+    "api.coingecko.com": 0.5,
+}
+DEFAULT_RATE_LIMIT = 5
+
+class RateLimiter:
+    # token bucket: rate tokens per second, at most capacity tokens saved up
+    def __init__(self, rate, capacity=1):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.last = time.monotonic()
+        self.lock = threading.Lock()
+
+    def acquire(self):
+        while True:
+            with self.lock:
+                now = time.monotonic()
+                self.tokens = min(self.capacity, self.tokens + (now - self.last) * self.rate)
+                self.last = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                wait = (1 - self.tokens) / self.rate
+            time.sleep(wait)
+
+class HttpClient:
+    # thread pool sharing one pooled session, requests are rate limited, retried with exponential backoff,
+    # and concurrent requests for the same url share one response
+    def __init__(self, rate=DEFAULT_RATE_LIMIT, max_workers=8, retries=4, backoff=0.5, timeout=30):
+        self.limiter = RateLimiter(rate)
+        self.retries = retries
+        self.backoff = backoff
+        self.timeout = timeout
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=max_workers)
+        self.session.mount("http://", adapter)
+        self.session.mount("https://", adapter)
+        self.executor = ThreadPoolExecutor(max_workers)
+        self.in_flight = {}
+        self.lock = threading.Lock()
+        self.num_requests = 0
+
+    def submit(self, url):
+        with self.lock:
+            future = self.in_flight.get(url)
+            if future is None:
+                future = self.executor.submit(self._get_json, url)
+                self.in_flight[url] = future
+                future.add_done_callback(lambda _: self._done(url))
+            return future
+
+    def _done(self, url):
+        with self.lock:
+            self.in_flight.pop(url, None)
+
+    def get_json(self, url):
+        return self.submit(url).result()
+
+    def _get_json(self, url):
+        for attempt in range(self.retries + 1):
+            self.limiter.acquire()
+            error = None
+            try:
+                with self.lock:
+                    self.num_requests += 1
+                instrumentation.count(f"api_calls/{urlparse(url).netloc}")
+                if attempt > 0:
+                    instrumentation.count("api_retries")
+                r = self.session.get(url, timeout=self.timeout)
+                if r.status_code == 200:
+                    output = r.json()
+                    # explorers answer 200 with an error message when the quota is exceeded
+                    if not (type(output) == dict and type(output.get("result")) == str and "rate limit" in output["result"].lower()):
+                        return output
+                    error = output["result"]
+                elif r.status_code == 429 or r.status_code >= 500:
+                    error = f"status {r.status_code}"
+                else:
+                    raise Exception(f"request error {r.status_code} {url}")
+            except (requests.ConnectionError, requests.Timeout) as e:
+                error = e
+
+            if attempt < self.retries:
+                time.sleep(self.backoff * 2 ** attempt)
+
+        raise Exception(f"request failed after {self.retries + 1} attempts: {error} {url}")
+
+clients = {}
+clients_lock = threading.Lock()
+
+def get_client(url):
+    # one client per host, so that each api has its own quota
+    host = urlparse(url).netloc
+    with clients_lock:
+        if host not in clients:
+            clients[host] = HttpClient(RATE_LIMITS.get(host, DEFAULT_RATE_LIMIT))
+        return clients[host]
+
+def get_json(url):
+    return get_client(url).get_json(url)
@@ -0,0 +1,84 @@
+import time
+import json
+import threading
+import functools
+from contextlib import contextmanager, nullcontext
+
+# Opt-in timers and counters for the pipeline. Disabled by default: every hook is then a single check of `enabled`.
+#
+#   instrumentation.enable(callback=None)      # callback(event) is called with each stage timing and counter update
+#   ... get_or_load_etherscan_dfs, combine_etherscan_dfs, merge_tx_df_with_prices, compute_portfolio_and_gains ...
+#   instrumentation.report()                   # {"stages": {name: {"seconds", "calls"}}, "counters": {name: value}}
+#   instrumentation.save_report("report.json")
+#
+# Stages are named after the function, the time of each transaction type is recorded as stage "tx/<TxType>".
+
+enabled = False
+stages = {}
+counters = {}
+callbacks = []
+lock = threading.Lock()
+
+def enable(callback=None):
+    global enabled
+    reset()
+    if callback is not None:
+        callbacks.append(callback)
+    enabled = True
+
+def disable():
+    global enabled
+    enabled = False
+    callbacks.clear()
+
+def reset():
+    with lock:
+        stages.clear()
+        counters.clear()
+
+def add_time(name, seconds):
+    with lock:
+        entry = stages.setdefault(name, {"seconds": 0., "calls": 0})
+        entry["seconds"] += seconds
+        entry["calls"] += 1
+    for callback in callbacks:
+        callback({"type": "stage", "name": name, "seconds": seconds})
+
+def count(name, value=1):
+    if not enabled:
+        return
+    with lock:
+        counters[name] = counters.get(name, 0) + value
+    for callback in callbacks:
+        callback({"type": "counter", "name": name, "value": value})
+
+@contextmanager
+def _stage(name):
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        add_time(name, time.perf_counter() - start)
+
+def stage(name):
+    return _stage(name) if enabled else nullcontext()
+
+def timed(name=None):
+    # decorator, records every call of the function as a stage
+    def decorator(f):
+        stage_name = name or f.__name__
+        @functools.wraps(f)
+        def wrapper(*args, **kwargs):
+            if not enabled:
+                return f(*args, **kwargs)
+            with _stage(stage_name):
+                return f(*args, **kwargs)
+        return wrapper
+    return decorator
+
+def report():
+    with lock:
+        return {"stages": {name: dict(entry) for name, entry in stages.items()}, "counters": dict(counters)}
+
+def save_report(filepath):
+    json.dump(report(), open(filepath, "w"), indent=2)
@@ -1,106 +1,149 @@
 import os
 import pandas as pd
-from etherscan import Etherscan
-import requests
 import time
+import threading
 from datetime import datetime
 from eth_utils.abi import function_abi_to_4byte_selector
-from web3_input_decoder.utils import (
-    hex_to_bytes,
-)
 import pickle
 import json
-import urllib.request
 from pycoingecko import CoinGeckoAPI
 import numpy as np
 from .utils import get_today_string, capitalize
+from .store import ColumnarStore, KeyValueStore
+from .http_client import get_json
+from .signatures import get_signature_table
+from .coins import get_coin_index, load_overrides, resolve_token
+from . import instrumentation
+from .prices import PriceMatrix, PriceArchive, LONG_PRICE_COLUMNS, dates_to_day_ordinals, pivot_daily_prices
+from concurrent.futures import ThreadPoolExecutor
 
 ARBISCAN_TOKEN = "to_set"
 ETHERSCAN_TOKEN = "to_set"
 
-def get_or_load_etherscan_dfs(time_start, time_end, data_dir, eth_address, explorer="etherscan"):
-    today_string = get_today_string(time_end)
+EXPLORER_URLS = {
+    "etherscan": "https://api.etherscan.io/api",
+    "arbiscan": "https://api.arbiscan.io/api",
+}
 
-    eth = None
+ETHERSCAN_ACTIONS = {
+    "normal": "txlist",
+    "erc20": "tokentx",
+    "internal": "txlistinternal",
+    "erc721": "tokennfttx",
+}
 
-    etherscan_types = ("normal", "erc20", "internal", "erc721")
-    etherscan_dfs = {}
+# explorers return at most this many rows per query
+MAX_RESULTS = 10000
 
-    if not os.path.exists(data_dir + today_string):
-        os.mkdir(data_dir + today_string)
+def get_explorer_token(explorer):
+    if explorer == "etherscan":
+        return ETHERSCAN_TOKEN
+    elif explorer == "arbiscan":
+        return ARBISCAN_TOKEN
+    else:
+        raise Exception(f"unknown explorer type")
+
+@instrumentation.timed()
+def get_or_load_etherscan_dfs(time_start, time_end, data_dir, eth_address, explorer="etherscan", sync=False):
+    # tables are cached in a columnar store keyed by explorer/address/type, with the covered range in their metadata.
+    # a table is reused if it covers time_start and was fetched up to the day of time_end.
+    # with sync=True only blocks newer than the stored ones are fetched, and rows are filtered to [time_start, time_end]
+    if sync:
+        etherscan_dfs = sync_etherscan_dfs(data_dir, eth_address, explorer)
+        for key, df in etherscan_dfs.items():
+            if len(df) > 0:
+                timestamps = pd.to_numeric(df["timeStamp"])
+                etherscan_dfs[key] = df[(timestamps >= time_start.timestamp()) & (timestamps <= time_end.timestamp())].reset_index(drop=True)
+        return etherscan_dfs
+
+    store = ColumnarStore(data_dir + "store")
+    today_string = get_today_string(time_end)
 
-    if not os.path.exists(data_dir + today_string + "/" + explorer):
-        os.mkdir(data_dir + today_string + "/" + explorer)
+    etherscan_types = ("normal", "erc20", "internal", "erc721")
+    etherscan_dfs = {}
 
     block_start = None
     block_end = None
 
     for etherscan_type in etherscan_types:
-        filepath = data_dir + today_string + f"/{explorer}/{etherscan_type}_{eth_address}_df.pickle"
-        if not os.path.exists(filepath):
+        key = (explorer, eth_address.lower(), etherscan_type)
+        meta = store.meta(key)
+        if meta is None or meta["time_start"] > int(time_start.timestamp()) or meta["fetched_until"] < today_string:
             print(f"fetching {etherscan_type} transactions from {explorer}")
-            time.sleep(0.5)
-
-            if explorer == "etherscan":
-                if eth is None:
-                    eth = Etherscan(ETHERSCAN_TOKEN)
-                if block_start is None:
-                    block_start = eth.get_block_number_by_timestamp(timestamp=int(time_start.timestamp()), closest='after')     
-                if block_end is None:
-                    block_end = eth.get_block_number_by_timestamp(timestamp=int(time_end.timestamp()), closest='after')
-
-                if etherscan_type == "normal":
-                    output = eth.get_normal_txs_by_address(address=eth_address, startblock=block_start, endblock=block_end, sort="asc") 
-                elif etherscan_type == "erc20":
-                    output = eth.get_erc20_token_transfer_events_by_address(address=eth_address, startblock=block_start, endblock=block_end, sort="asc") 
-                elif etherscan_type == "internal":
-                    output = eth.get_internal_txs_by_address(address=eth_address, startblock=block_start, endblock=block_end, sort="asc") 
-                elif etherscan_type == "erc721":
-                    output = eth.get_erc721_token_transfer_events_by_address(address=eth_address, startblock=block_start, endblock=block_end, sort="asc") 
-
-            elif explorer == "arbiscan":
-                if block_start is None:
-                    block_start = get_arbitrum_block_from_timestamp(int(time_start.timestamp()))   
-                if block_end is None:
-                    block_end = get_arbitrum_block_from_timestamp(int(time_end.timestamp()))   
-
-                if etherscan_type == "normal":
-                    request= f"https://api.arbiscan.io/api?module=account&action=txlist&address={eth_address}&startblock={block_start}&endblock={block_end}&sort=asc&apikey={ARBISCAN_TOKEN}"
-                elif etherscan_type == "erc20":
-                    request= f"https://api.arbiscan.io/api?module=account&action=tokentx&address={eth_address}&startblock={block_start}&endblock={block_end}&sort=asc&apikey={ARBISCAN_TOKEN}"
-                elif etherscan_type == "internal":
-                    request= f"https://api.arbiscan.io/api?module=account&action=txlistinternal&address={eth_address}&startblock={block_start}&endblock={block_end}&sort=asc&apikey={ARBISCAN_TOKEN}"
-                elif etherscan_type == "erc721":
-                    request= f"https://api.arbiscan.io/api?module=account&action=tokennfttx&address={eth_address}&startblock={block_start}&endblock={block_end}&sort=asc&apikey={ARBISCAN_TOKEN}"
-
-                r = requests.get(request)
-                if r.status_code == 200:
-                    output = r.json()["result"] 
-                else:
-                    raise Exception(f"request error {request}")
-
-            else:
-                raise Exception(f"unknown explorer type")
+            instrumentation.count("etherscan_cache_misses")
 
+            if block_start is None:
+                block_start = get_block_from_timestamp(int(time_start.timestamp()), explorer, closest="after")
+            if block_end is None:
+                block_end = get_block_from_timestamp(int(time_end.timestamp()), explorer, closest="before")
+
+            output = fetch_account_list(eth_address, etherscan_type, block_start, block_end, explorer)
             output_df = pd.DataFrame.from_dict(output)
-            output_df.to_pickle(filepath)
+            store.write(key, output_df, block_start=int(block_start), block_end=int(block_end),
+                        time_start=int(time_start.timestamp()), fetched_until=today_string)
 
             etherscan_dfs[etherscan_type] = output_df
                 
         else:
-            etherscan_dfs[etherscan_type] = pd.read_pickle(filepath)
+            instrumentation.count("etherscan_cache_hits")
+            etherscan_dfs[etherscan_type] = store.load(key)
 
     return etherscan_dfs
 
+@instrumentation.timed()
+def sync_etherscan_dfs(data_dir, eth_address, explorer="etherscan", page_size=MAX_RESULTS):
+    # brings the stored lists up to date: only blocks after the highest block stored for (explorer, address, type) are requested.
+    # synced tables always start at block 0 and are kept apart from the tables of get_or_load_etherscan_dfs, which
+    # start at the block of time_start and are rewritten when stale
+    store = ColumnarStore(data_dir + "store")
+    today_string = get_today_string(datetime.now())
+
+    etherscan_dfs = {}
+    for etherscan_type in ETHERSCAN_ACTIONS.keys():
+        key = ("synced", explorer, eth_address.lower(), etherscan_type)
+        meta = store.meta(key)
+        block_start = 0 if meta is None else meta["block_end"] + 1
+
+        output = fetch_account_list(eth_address, etherscan_type, block_start, None, explorer, page_size)
+        print(f"synced {len(output)} new {etherscan_type} transactions from {explorer}")
+
+        new_df = pd.DataFrame.from_dict(output)
+        block_end = int(new_df["blockNumber"].astype(int).max()) if len(new_df) > 0 else block_start - 1
+        if meta is None:
+            store.write(key, new_df, block_start=0, block_end=block_end, time_start=0, fetched_until=today_string)
+        else:
+            store.append(key, new_df, block_end=block_end, fetched_until=today_string)
+
+        etherscan_dfs[etherscan_type] = store.load(key)
+
+    return etherscan_dfs
 
+def fetch_account_list(eth_address, etherscan_type, block_start, block_end=None, explorer="etherscan", page_size=MAX_RESULTS):
+    # a query returns at most page_size rows sorted by block. When a page is full, the next query restarts from
+    # the last block of the page (whose rows may be incomplete) and that block's rows are dropped from the page
+    rows = []
+    while True:
+        request = f"{EXPLORER_URLS[explorer]}?module=account&action={ETHERSCAN_ACTIONS[etherscan_type]}&address={eth_address}" \
+                  f"&startblock={block_start}&endblock={block_end if block_end is not None else 999999999}&page=1&offset={page_size}&sort=asc&apikey={get_explorer_token(explorer)}"
+        result = get_json(request)["result"]
+        if type(result) != list:
+            raise Exception(f"{explorer} error: {result}")
+
+        if len(result) < page_size:
+            return rows + result
+
+        last_block = int(result[-1]["blockNumber"])
+        if int(result[0]["blockNumber"]) == last_block:
+            raise Exception(f"more than {page_size} transactions in block {last_block}")
+        rows += [row for row in result if int(row["blockNumber"]) < last_block]
+        block_start = last_block
+
+def get_block_from_timestamp(timestamp, explorer="etherscan", closest="before"):
+    request = f"{EXPLORER_URLS[explorer]}?module=block&action=getblocknobytime&timestamp={timestamp}&closest={closest}&apikey={get_explorer_token(explorer)}"
+    return int(get_json(request)["result"])
 
 def get_arbitrum_block_from_timestamp(timestamp):
-    request=f"https://api.arbiscan.io/api?module=block&action=getblocknobytime&timestamp={timestamp}&closest=before&apikey={ARBISCAN_TOKEN}"
-    r = requests.get(request)
-    if r.status_code == 200:
-        return r.json()["result"]
-    else:
-        print("ERROR")
+    return get_block_from_timestamp(timestamp, "arbiscan")
 
 
 
@@ -111,57 +154,119 @@ manual_proxies = {
 }
 
 
-def get_ethereum_contract_method(contract_address, tx_input, platform="ethereum"):
+def get_ethereum_contract_method(contract_address, tx_input, platform="ethereum", offline=False):
 
     if tx_input == '0x' or contract_address == "0x000000000000000000000000000000000000006E".lower():
         return 'transfer'
 
+    return resolve_method(contract_address, get_selector(tx_input), platform, offline)
+
+def get_selector(tx_input):
+    # first 4 bytes of the call data, as hex without 0x
+    return tx_input[2:10].lower()
+
+# contract -> {"selectors": {selector: method name}, "implementation": selector of implementation() or None}.
+# Persisted per platform and kept in memory once loaded. Contracts whose abi could not be read are only remembered
+# for the process (unreadable_contracts), the failure may be transient (network, rate limit)
+selector_indexes = {}
+selector_indexes_lock = threading.Lock()
+proxy_implementations = {}
+unreadable_contracts = set()
+
+def get_selector_index(platform="ethereum"):
+    # one store per platform, shared by the threads of batch.load_wallet_tx_dfs
+    with selector_indexes_lock:
+        if platform not in selector_indexes:
+            selector_indexes[platform] = KeyValueStore(f"./data/contracts_{platform}/selector_index.jsonl")
+        return selector_indexes[platform]
+
+def is_indexed(contract_address, platform="ethereum"):
+    # None entries were written by older versions for unreadable abis, they are retried
+    return get_selector_index(platform).get(contract_address) is not None or (platform, contract_address) in unreadable_contracts
+
+def get_contract_selectors(contract_address, platform="ethereum"):
+    index = get_selector_index(platform)
+    if not is_indexed(contract_address, platform):
+        instrumentation.count("selector_index_misses")
+        abi = get_contract_abi(contract_address, platform)
+        if abi is None:
+            unreadable_contracts.add((platform, contract_address))
+        else:
+            selectors = {}
+            implementation = None
+            for type_def in abi:
+                if type_def["type"] == "function":
+                    selector = function_abi_to_4byte_selector(type_def).hex()
+                    selectors[selector] = type_def["name"]
+                    if type_def["name"] == "implementation":
+                        implementation = selector
+            index.put(contract_address, {"selectors": selectors, "implementation": implementation})
+    return index.get(contract_address)
+
+def get_proxy_implementation(contract_address, implementation, platform="ethereum"):
+    key = (platform, contract_address)
+    if key not in proxy_implementations:
+        filepath = f"./data/contracts_{platform}/proxy_eth_call_{contract_address}_{implementation}.pickle"
+        request = f"{EXPLORER_URLS[get_explorer(platform)]}?module=proxy&action=eth_call&to={contract_address}&data=0x{implementation}&apikey={get_explorer_token(get_explorer(platform))}"
+        result = cached_request(filepath, request)
+        proxy_implementations[key] = "0x" + result[-40:] if result is not None else None
+    return proxy_implementations[key]
+
+def resolve_method(contract_address, selector, platform="ethereum", offline=False):
+    # the local signature table is consulted first, the contract's abi (network) only for unknown selectors
+
+    method_name = get_signature_table().method_name(selector)
+    if method_name is not None:
+        return method_name
+    elif offline:
+        return "not_found_error"
+
     contract_address = manual_proxies.get(contract_address, contract_address)
 
-    abi = get_contract_abi(contract_address, platform)
-    if abi is None:
+    contract = get_contract_selectors(contract_address, platform)
+    if contract is None:
         return "read_abi_error"
-    implementation = None
-
-    selector_to_type_def = {}
-    for type_def in abi:
-        if type_def["type"] == "function":
-            selector = function_abi_to_4byte_selector(type_def)
-            selector_to_type_def[selector] = type_def
-
-            if type_def["name"] == "implementation":
-                implementation = selector.hex()
-
-    tx_input = hex_to_bytes(tx_input)
-    selector, args = tx_input[:4], tx_input[4:]
-
-    if selector not in selector_to_type_def:
-        if implementation is not None:
-
-            filepath = f"./data/contracts_{platform}/proxy_eth_call_{contract_address}_{implementation}.pickle"
-            if platform == "ethereum":
-                request = f"https://api.etherscan.io/api?module=proxy&action=eth_call&to={contract_address}&data=0x{implementation}&apikey={ETHERSCAN_TOKEN}"
-            elif platform == "arbitrum":
-                request = f"https://api.arbiscan.io/api?module=proxy&action=eth_call&to={contract_address}&data=0x{implementation}&apikey={ARBISCAN_TOKEN}"
-
-            result = cached_request(filepath, request)
-            if result is not None:
-                impl_address = "0x" + result[-40:]
-                return get_ethereum_contract_method(impl_address, tx_input)
-            else:
-                return "read_implementation_error"
-        else:
-            return "not_found_error"
 
-    method_name = selector_to_type_def[selector]['name']
-    return method_name
+    if selector in contract["selectors"]:
+        return contract["selectors"][selector]
+    elif contract["implementation"] is not None:
+        impl_address = get_proxy_implementation(contract_address, contract["implementation"], platform)
+        if impl_address is None:
+            return "read_implementation_error"
+        return resolve_method(impl_address, selector, platform)
+    else:
+        return "not_found_error"
+
+@instrumentation.timed()
+def decode_methods(df, platform="ethereum", offline=False):
+    # resolves each distinct (contract, selector) pair once, plain transfers are never looked up
+    is_transfer = ((df["Input"] == "0x") | (df["To"] == "0x000000000000000000000000000000000000006E".lower())).to_numpy()
+    methods = np.full(len(df), "transfer", dtype=object)
+    if is_transfer.all():
+        return methods
+    calls = df[~is_transfer]
+    selectors = calls["Input"].fillna("").str.slice(2, 10).str.lower()
+
+    codes, pairs = pd.MultiIndex.from_arrays([calls["To"].fillna(""), selectors]).factorize()
+    if not offline:
+        table = get_signature_table()
+        prefetch_contract_abis({to for to, selector in pairs if table.method_name(selector) is None}, platform)
+    methods[~is_transfer] = np.array([resolve_method(to, selector, platform, offline) for to, selector in pairs], dtype=object)[codes]
+    return methods
+
+def get_explorer(platform):
+    if platform == "ethereum":
+        return "etherscan"
+    elif platform == "arbitrum":
+        return "arbiscan"
+    else:
+        raise NotImplementedError
 
 def get_contract_abi(contract_address, platform="ethereum"):
 
     folder_path = "./data/contracts_" + platform
 
-    if not os.path.exists(folder_path):
-            os.mkdir(folder_path)
+    os.makedirs(folder_path, exist_ok=True)
 
     filepath = folder_path + f"/abi_" + contract_address + ".pickle"        
     if platform == "ethereum":
@@ -176,54 +281,133 @@ def get_contract_abi(contract_address, platform="ethereum"):
     else:
         return None
 
-def cached_request(filepath, request, sleep=0.25):
-
-    if os.path.exists(filepath):
-        return pickle.load(open(filepath, 'rb'))
+request_store = KeyValueStore("./data/request_cache.jsonl")
 
-    else:
+def cached_request(filepath, request):
+    # results are kept in request_store under filepath, pickles written by older versions are still read
 
-        response = urllib.request.urlopen(request)
-        time.sleep(sleep)
+    if filepath in request_store:
+        instrumentation.count("request_cache_hits")
+        return request_store.get(filepath)
 
-        if response.status == 200:
-            output = json.load(response)
-            if "result" in output.keys():
-                output = output["result"]
-                pickle.dump(output, open(filepath, 'wb'))
-                return output
+    elif os.path.exists(filepath):
+        instrumentation.count("request_cache_hits")
+        output = pickle.load(open(filepath, 'rb'))
+        request_store.put(filepath, output)
+        return output
 
-def combine_etherscan_dfs(etherscan_dfs, eth_address, platform="ethereum"):
+    else:
+        instrumentation.count("request_cache_misses")
+        output = get_json(request)
+        if "result" in output.keys():
+            output = output["result"]
+            request_store.put(filepath, output)
+            return output
+
+def prefetch_contract_abis(contract_addresses, platform="ethereum", max_workers=8):
+    # fills the selector index concurrently, the http client keeps the requests within the explorer's quota
+    contract_addresses = {manual_proxies.get(x, x) for x in contract_addresses}
+    contract_addresses = [x for x in contract_addresses if not is_indexed(x, platform)]
+    with ThreadPoolExecutor(max_workers) as executor:
+        list(executor.map(lambda x: get_contract_selectors(x, platform), contract_addresses))
+
+# wei values are parsed to int64 where they fit, the others (e.g. token values with 18 decimals) to python ints
+INT64_DIGITS = 18
+# float division by 10**d is exact for d <= 22 and rounds once, like python's int / int, for values below 2**53
+POWERS_OF_TEN = np.array([float(10**i) for i in range(23)])
+
+def parse_int_strings(strings):
+    # int64 of decimal strings and the mask of the values that fit, the others are left as 0
+    fits = np.fromiter(map(len, strings), np.int64, len(strings)) <= INT64_DIGITS
+    ints = np.zeros(len(strings), dtype=np.int64)
+    ints[fits] = strings[fits].astype(np.int64)
+    return ints, fits
+
+def wei_to_eth(values):
+    # int(x) / 1e18 of each value
+    strings = np.asarray(values, dtype=object)
+    ints, fits = parse_int_strings(strings)
+    amounts = ints.astype(np.float64)
+    amounts[~fits] = [float(int(x)) for x in strings[~fits]]
+    return amounts / 1e18
+
+def gas_fees(gas_prices, gas_used):
+    # int(gas_price) * int(gas_used) in wei, as decimal strings, and / 1e18. the product is taken in int64 where it
+    # cannot overflow
+    gas_prices, gas_used = np.asarray(gas_prices, dtype=object), np.asarray(gas_used, dtype=object)
+    prices, prices_fit = parse_int_strings(gas_prices)
+    used, used_fit = parse_int_strings(gas_used)
+    fits = prices_fit & used_fit & (np.abs(prices) <= np.iinfo(np.int64).max // np.maximum(np.abs(used), 1))
+    products = np.where(fits, prices, 0) * used
+    big_products = [int(x) * int(y) for x, y in zip(gas_prices[~fits], gas_used[~fits])]
+
+    wei = products.astype(str).astype(object)
+    wei[~fits] = [str(x) for x in big_products]
+    fees = products.astype(np.float64)
+    fees[~fits] = [float(x) for x in big_products]
+    return wei, fees / 1e18
+
+def token_amounts(values, decimals):
+    # int(value) / 10**int(decimal) of each row, rows that float division would round differently are divided in python
+    values, decimals = np.asarray(values, dtype=object), np.asarray(decimals, dtype=object)
+    ints, values_fit = parse_int_strings(values)
+    exponents, exponents_fit = parse_int_strings(decimals)
+    exact = values_fit & exponents_fit & (np.abs(ints) < 2**53) & (exponents >= 0) & (exponents < len(POWERS_OF_TEN))
+    amounts = ints.astype(np.float64) / POWERS_OF_TEN[np.where(exact, exponents, 0)]
+    amounts[~exact] = [int(x) / 10**int(y) for x, y in zip(values[~exact], decimals[~exact])]
+    return amounts
+
+def map_values(series, mapping):
+    # values in mapping are replaced, the others kept
+    mapped = series.map(mapping)
+    return mapped.where(mapped.notnull(), series)
+
+def normalize_etherscan_df(df, key, platform="ethereum", offline=False):
+    # columns of an etherscan list in the tx_df format, amounts and fees in units of the token. Units, Decimals and
+    # TxnFee(Wei) keep them exactly, in integer base units (for compute_portfolio_and_gains with exact=True)
+    df.rename(columns={x:capitalize(x) for x in df.columns}, inplace=True)
+
+    df["Platform"] = platform
+    df["ExportType"] = key
+
+    if key == "normal":
+        df["TxnFee(Wei)"], df["TxnFee(ETH)"] = gas_fees(df["GasPrice"], df["GasUsed"])
+
+        df["Method"] = decode_methods(df, platform, offline)
+
+        errors = df[df["Method"].apply(lambda x: "error" in x)]
+        if len(errors)>0:
+            print(f"method errors:" + errors["To"].unique())
+
+    if key == "erc20":
+        df["Amount"] = token_amounts(df["Value"], df["TokenDecimal"])
+        df["Units"] = df["Value"]
+        df["Decimals"] = df["TokenDecimal"].astype(np.int64)
+
+    if key in ["normal", "internal"] :
+        df["Amount"] = wei_to_eth(df["Value"])
+        df["Units"] = df["Value"]
+        df["Decimals"] = 18
+        df["TokenName"] = "Ethereum"
+        df["TokenSymbol"] = "ETH"
+
+    if key == "erc721":
+        df["Decimals"] = 0
+
+    return df
+
+@instrumentation.timed()
+def combine_etherscan_dfs(etherscan_dfs, eth_address, platform="ethereum", offline=False):
 
     for key in etherscan_dfs.keys():
-        df = etherscan_dfs[key]
-        df.rename(columns={x:capitalize(x) for x in df.columns}, inplace=True)
-
-        df["Platform"] = platform
-        df["ExportType"] = key
-        
-        if key == "normal":
-            df["TxnFee(ETH)"] = df.apply(lambda x: int(x.GasPrice) * int(x.GasUsed) / 1e18, axis=1)
-
-            df["Method"] = None
-            for i, row in df.iterrows():
-                method = get_ethereum_contract_method(row.To, row.Input, platform)
-                df.at[i, "Method"] = method
-
-            errors = df[df["Method"].apply(lambda x: "error" in x)]
-            if len(errors)>0:
-                print(f"method errors:" + errors["To"].unique())
-
-        if key == "erc20":
-            df["Amount"] = df.apply(lambda row: int(row.Value) / 10**(int(row.TokenDecimal)), axis=1)
-
-        if key in ["normal", "internal"] :
-            df["Amount"] = df["Value"].apply(lambda x: int(x) / 1e18)
-            df["TokenName"] = "Ethereum"
-            df["TokenSymbol"] = "ETH"
-
-        etherscan_dfs[key] = df
-        
+        etherscan_dfs[key] = normalize_etherscan_df(etherscan_dfs[key], key, platform, offline)
+
+    tx_df = pd.concat(list(etherscan_dfs.values()), ignore_index=True)
+    tx_df = normalize_tx_df(tx_df, eth_address, platform)
+    instrumentation.count("rows_combined", len(tx_df))
+    return tx_df
+
+def normalize_tx_df(tx_df, eth_address, platform="ethereum"):
     name_replacements = {
     "stETH": "Lido Staked Ether"
     }
@@ -243,117 +427,163 @@ def combine_etherscan_dfs(etherscan_dfs, eth_address, platform="ethereum"):
     }   
     unused_columns = ["Nonce", "BlockHash", "TransactionIndex", "Gas", "GasPrice", "Input", "ContractAddress", "CumulativeGasUsed", "GasUsed", "Confirmations", "Value", "TokenDecimal", "TraceId", "IsError", "Txreceipt_status", "Type", "ErrCode", "TokenID", "BlockNumber"]
 
-    tx_df = pd.concat(list(etherscan_dfs.values()), ignore_index=True)
-    tx_df["TokenName"] = tx_df["TokenName"].apply(lambda x: name_replacements[x] if x in name_replacements.keys() else x)
-    tx_df = tx_df[tx_df["TokenSymbol"] != "CNV"]
-    tx_df["Amount"] = tx_df["Amount"].apply(lambda x: float(x.replace(",","")) if type(x)==str else x )
-    tx_df.drop(columns=tx_df.columns.intersection(unused_columns), inplace=True)
-    tx_df.sort_values("TimeStamp", inplace=True)
-    tx_df.reset_index(inplace=True, drop=True)
+    tx_df = tx_df.drop(columns=tx_df.columns.intersection(unused_columns))
+    # the rows are filtered and sorted by a single take, in the order sort_values("TimeStamp") gives
+    timestamps = tx_df["TimeStamp"][(tx_df["TokenSymbol"] != "CNV").to_numpy()]
+    tx_df = tx_df.take(timestamps.sort_values().index).reset_index(drop=True)
+    tx_df["TokenName"] = map_values(tx_df["TokenName"], name_replacements)
+    if tx_df["Amount"].dtype == object: # amounts of csv exports
+        tx_df["Amount"] = tx_df["Amount"].map(lambda x: float(x.replace(",","")) if type(x)==str else x)
 
     if platform == "arbitrum": # bridge deposits are marked as "to" instead of "from" (?)
-        indices = tx_df[tx_df["To"] == "0x000000000000000000000000000000000000006e"].index
-        for i in indices:
-            tx_df.at[i, "To"] = tx_df.loc[i]["From"]
-            tx_df.at[i, "From"] = "0x000000000000000000000000000000000000006e"
+        is_bridge = tx_df["To"] == "0x000000000000000000000000000000000000006e"
+        tx_df.loc[is_bridge, "To"] = tx_df.loc[is_bridge, "From"]
+        tx_df.loc[is_bridge, "From"] = "0x000000000000000000000000000000000000006e"
 
-    tx_df["From"] = tx_df["From"].apply(lambda x: address_dict.get(x, x))
-    tx_df["To"] = tx_df["To"].apply(lambda x: address_dict.get(x, x))   
+    tx_df["From"] = map_values(tx_df["From"], address_dict)
+    tx_df["To"] = map_values(tx_df["To"], address_dict)
     return tx_df
 
 
-def fetch_historical_prices(cg_ids, date_start, date_end):
-
-    #fetch historical prices for each token
-    cg_outputs = {}
-    for cg_id in cg_ids:
-        cg_outputs[cg_id] = cached_prices(cg_id, date_start, date_end)
-
-    # combine prices into 1 dataframe
-    prices_df = None
-    for token_id in cg_ids:
-        token_df = pd.DataFrame()
-        token_df["timestamp"] = np.array(cg_outputs[token_id]["prices"])[:-1,0]
-        token_df[token_id] = np.array(cg_outputs[token_id]["prices"])[:-1,1]
-        if prices_df is None:
-            prices_df = token_df
-        else:
-            prices_df = prices_df.merge(token_df, on="timestamp", how="outer")
-
-    prices_df["date"] = prices_df["timestamp"].apply(lambda x: pd.to_datetime(x, unit="ms"))
-    prices_df["DateString"] = prices_df["date"].apply(lambda x: x.strftime("%Y-%m-%d"))
-    return prices_df
+PRICE_ARCHIVE = "./data/price_archive.parquet"
+
+def get_price_sources(offline=False):
+    # the local archive first, the CoinGecko api for the tokens it does not have
+    return [PriceArchive(PRICE_ARCHIVE)] + ([] if offline else [CoinGeckoPrices()])
+
+PRICE_LAG_DAYS = 1 # the last day may not have a closing price yet
+
+def uncovered_tokens(cg_ids, first_days, last_days, first_day, last_day):
+    return [cg_id for cg_id in cg_ids
+            if first_days.get(cg_id, last_day + 1) > first_day or last_days.get(cg_id, first_day - 1) < last_day - PRICE_LAG_DAYS]
+
+@instrumentation.timed()
+def fetch_historical_prices(cg_ids, date_start, date_end, sources=None):
+    # daily prices of each token in a single pivot. a source has load(cg_ids, date_start, date_end) -> long
+    # (timestamp in ms, cg_id, price) rows, later sources are asked for the tokens whose prices start after
+    # date_start or end before date_end (a stale archive) and only fill the days outside of the earlier ones
+    sources = get_price_sources() if sources is None else sources
+    cg_ids = list(cg_ids)
+    first_day, last_day = dates_to_day_ordinals([date_start, date_end])
+    first_days, last_days = {}, {} # day range of the prices found so far
+    loaded = []
+    for source in sources:
+        missing = uncovered_tokens(cg_ids, first_days, last_days, first_day, last_day)
+        if len(missing) == 0:
+            break
+        prices = source.load(missing, date_start, date_end)
+        days = pd.to_numeric(prices["timestamp"]).to_numpy(dtype="int64") // 86400000
+        known_first = prices["cg_id"].map(first_days).to_numpy(dtype=float)
+        known_last = prices["cg_id"].map(last_days).to_numpy(dtype=float)
+        keep = prices["price"].notnull().to_numpy() & (days >= first_day) & (days <= last_day) & ~((days >= known_first) & (days <= known_last))
+        prices, days = prices[keep], days[keep]
+        loaded.append(prices)
+
+        ranges = pd.Series(days, index=prices["cg_id"].to_numpy()).groupby(level=0).agg(["min", "max"])
+        for cg_id, first, last in zip(ranges.index, ranges["min"], ranges["max"]):
+            first_days[cg_id] = min(first_days.get(cg_id, first), first)
+            last_days[cg_id] = max(last_days.get(cg_id, last), last)
+        instrumentation.count(f"prices_from_{type(source).__name__}", len(ranges))
+
+    missing = [cg_id for cg_id in cg_ids if cg_id not in first_days]
+    if len(missing) > 0:
+        print("No historical prices for: " + "; ".join(missing))
+    stale = [cg_id for cg_id in cg_ids if cg_id in last_days and last_days[cg_id] < last_day - PRICE_LAG_DAYS]
+    if len(stale) > 0:
+        print(f"Historical prices end before {pd.Timestamp(date_end):%Y-%m-%d} for: " + "; ".join(stale))
+    prices = pd.concat([pd.DataFrame(columns=LONG_PRICE_COLUMNS)] + loaded, ignore_index=True)
+    return pivot_daily_prices(prices, cg_ids, date_start, date_end)
+
+PRICE_MATRIX_PREFIX = "./data/store/price_matrix"
+
+def get_price_matrix(cg_ids, date_start, date_end, prefix=PRICE_MATRIX_PREFIX, sources=None):
+    # price matrix of fetch_historical_prices, kept as a memory-mapped file and rebuilt when it misses tokens or days.
+    # a matrix with prices ending early is not kept, so that the sources are asked again for those days
+    first_day, last_day = dates_to_day_ordinals([date_start, date_end])
+    if os.path.exists(f"{prefix}_meta.json"):
+        price_matrix = PriceMatrix.load(prefix)
+        if price_matrix.covers(cg_ids, first_day, last_day):
+            return price_matrix
+
+    price_matrix = PriceMatrix.from_prices_df(fetch_historical_prices(cg_ids, date_start, date_end, sources))
+    if len(price_matrix.stale_tokens(PRICE_LAG_DAYS)) > 0:
+        return price_matrix
+    price_matrix.save(prefix)
+    return PriceMatrix.load(prefix)
+
+price_store = ColumnarStore("./data/store/token_prices")
 
 def cached_prices(cg_id, date_start, date_end):
+    # daily (timestamp in ms, price) rows of cg_id, only the days missing from the store are queried
 
     today_string = get_today_string(date_end)
+    meta = price_store.meta((cg_id,))
 
-    folder_path = f"./data/token_prices"
-    if not os.path.isdir(folder_path):
-        os.mkdir(folder_path)
-
-    folder_path = f"./data/token_prices/{today_string}"
-    if not os.path.isdir(folder_path):
-        os.mkdir(folder_path)
-
-    filepath = f"{folder_path}/{cg_id}.pickle"
-    
-    if os.path.exists(filepath):
-        return pickle.load(open(filepath, 'rb'))
+    if meta is not None and meta["date_start"] <= get_today_string(date_start) and meta["fetched_until"] >= today_string:
+        instrumentation.count("price_cache_hits")
+        return price_store.load((cg_id,))
 
     else:
         print(f"querying historical prices for {cg_id}")
+        instrumentation.count("price_cache_misses")
+        if meta is not None and meta["date_start"] <= get_today_string(date_start):
+            query_start = datetime.fromtimestamp(meta["last_timestamp"] / 1000)
+        else:
+            query_start = date_start
+            price_store.clear((cg_id,))
+            meta = None
+
         cg = CoinGeckoAPI()
-        ytd_days = (datetime.now() - date_start).days + 1
+        ytd_days = (datetime.now() - query_start).days + 1
         response = cg.get_coin_market_chart_by_id(cg_id, "eur", ytd_days, interval="daily")
-        
+
+        # the last point is the current price, not a daily close
+        prices = np.array(response["prices"]).reshape(-1, 2)[:-1]
+        new_df = pd.DataFrame({"timestamp": prices[:, 0], "price": prices[:, 1]})
+        if meta is not None:
+            new_df = new_df[new_df["timestamp"] > meta["last_timestamp"]]
+        elif len(new_df) == 0:
+            # no prices at all yet, nothing to store
+            time.sleep(1)
+            return new_df
+        last_timestamp = new_df["timestamp"].max() if len(new_df) > 0 else meta["last_timestamp"]
+
         # todo remove results after date_end ?
-        pickle.dump(response, open(filepath, 'wb'))
+        price_store.append((cg_id,), new_df, date_start=get_today_string(date_start) if meta is None else meta["date_start"],
+                           fetched_until=today_string, last_timestamp=float(last_timestamp))
         time.sleep(1)
-        return response
+        return price_store.load((cg_id,))
+
+class CoinGeckoPrices:
+    # price source of fetch_historical_prices, one api query per token for the days missing from price_store
 
-def match_tokens_to_coingecko(tokens):
+    def load(self, cg_ids, date_start, date_end):
+        # tokens without any price in the store come back without columns
+        prices = [cached_prices(cg_id, date_start, date_end).assign(cg_id=cg_id) for cg_id in cg_ids]
+        return pd.concat([pd.DataFrame(columns=LONG_PRICE_COLUMNS)] + prices, ignore_index=True)[LONG_PRICE_COLUMNS]
+
+@instrumentation.timed()
+def match_tokens_to_coingecko(tokens, overrides=None):
+    # each distinct (name, symbol) is resolved once, by the override table or the coin index. overrides
+    # ({(symbol, name or None): cg_id}) take precedence over both
     tokens = tokens.copy()
-    
-    filepath = f"./data/cg_tokens.pickle"
-    if os.path.exists(filepath):
-        cg_coin_list = pickle.load(open(filepath, 'rb'))
-    else:
-        cg = CoinGeckoAPI()
-        cg_coin_list = cg.get_coins_list()
-    cg_coin_df = pd.DataFrame.from_dict(cg_coin_list)
+    index = get_coin_index()
+    token_overrides = load_overrides()
+    token_overrides.update(overrides or {})
 
-    not_found = []
-    
-    tokens["cg_id"] = None
-    for i, row in tokens.iterrows():
-        name = row["TokenName"]
-        symbol = row["TokenSymbol"]
-
-        if symbol == "SLP":
-            token_id = None
-        else:
-            matches = cg_coin_df[cg_coin_df["symbol"].apply(lambda x: x.lower()) == symbol.lower()]
-            matches = matches[["Wormhole" not in name for name in matches["name"]]]
-
-            if len(matches) == 0:            
-                token_id = None
-            elif len(matches) == 1:
-                token_id = matches["id"].values[0]
-            else:
-                name_matches = matches[[cg_name.lower() in name.lower() for cg_name in matches["name"]]]
-                if len(name_matches) == 1:
-                    token_id = name_matches["id"].values[0]
-                else:
-                    print("MULTIPLE POSSIBLE MATCHES")
-                    print(name, symbol)
-                    print(matches)
-                    token_id = None
-            if token_id == None:
-                not_found.append((name, symbol))
-        
-        row["cg_id"] = token_id
+    pairs = list(zip(tokens["TokenName"], tokens["TokenSymbol"]))
+    resolved = {(name, symbol): resolve_token(name, symbol, index, token_overrides) for name, symbol in dict.fromkeys(pairs)}
 
+    not_found = []
+    for (name, symbol), (token_id, overridden) in resolved.items():
+        if token_id is None and not overridden:
+            if len(index.candidates(symbol)) > 1:
+                print("MULTIPLE POSSIBLE MATCHES")
+                print(name, symbol)
+                print(index.candidates(symbol))
+            not_found.append((name, symbol))
+
+    tokens["cg_id"] = [resolved[pair][0] for pair in pairs]
     print("Tokens not found on CoinGecko: " + "; ".join([symbol + ":" + name for name, symbol in not_found]))
     tokens.sort_values("TokenSymbol", inplace=True)
     return tokens
\ No newline at end of file
@@ -0,0 +1,254 @@
+import os
+import sys
+import json
+from multiprocessing import shared_memory, resource_tracker
+import numpy as np
+import pandas as pd
+from sources.store import write_atomic, save_npy
+
+PRICE_DF_COLUMNS = ["timestamp", "date", "DateString"]
+LONG_PRICE_COLUMNS = ["timestamp", "cg_id", "price"]
+
+def to_day_ordinals(timestamps):
+    # unix seconds -> days since epoch
+    return np.asarray(timestamps, dtype="int64") // 86400
+
+def day_ordinals_to_strings(day_ordinals):
+    # format each distinct day once
+    days, inverse = np.unique(np.asarray(day_ordinals, dtype="int64"), return_inverse=True)
+    return days.astype("datetime64[D]").astype(str).astype(object)[inverse]
+
+def date_strings_to_day_ordinals(date_strings):
+    return np.asarray(date_strings, dtype="datetime64[D]").astype("int64")
+
+def dates_to_day_ordinals(dates):
+    # datetimes or "YYYY-MM-DD" strings, by calendar date like get_today_string
+    return date_strings_to_day_ordinals([pd.Timestamp(x).strftime("%Y-%m-%d") for x in dates])
+
+def day_range(date_start, date_end):
+    first_day, last_day = dates_to_day_ordinals([date_start, date_end])
+    return np.arange(first_day, last_day + 1)
+
+def to_long_prices(df):
+    # long format (timestamp, cg_id, price) or wide format (timestamp and one price column per cg_id, e.g. a prices_df)
+    # -> long format without missing prices
+    if "cg_id" not in df.columns:
+        df = df.drop(columns=["date", "DateString"], errors="ignore").melt(id_vars="timestamp", var_name="cg_id", value_name="price")
+    return df[df["price"].notnull()]
+
+def pivot_daily_prices(prices, cg_ids, date_start, date_end, max_gap_days=None):
+    # long (timestamp in ms, cg_id, price) rows -> prices_df with one row per day from date_start to date_end and one
+    # column per cg_id, in a single pivot. the first sample of each day is kept, like PriceMatrix.from_prices_df.
+    # gaps between two prices of a token are forward filled (at most max_gap_days), days before the first or after
+    # the last price stay NaN
+    cg_ids = list(cg_ids)
+    days = day_range(date_start, date_end)
+    prices = to_long_prices(prices).sort_values("timestamp", kind="stable")
+    prices = prices.assign(day=prices["timestamp"].to_numpy(dtype="int64") // 86400000)
+    prices = prices[(prices["day"] >= days[0]) & (prices["day"] <= days[-1])].drop_duplicates(["day", "cg_id"])
+
+    wide = prices.pivot(index="day", columns="cg_id", values="price").reindex(index=days, columns=cg_ids)
+    wide = wide.ffill(limit=max_gap_days).where(wide.bfill().notnull())
+
+    prices_df = pd.DataFrame(wide.to_numpy(dtype=float), columns=cg_ids)
+    prices_df.insert(0, "timestamp", days * 86400000)
+    prices_df["date"] = pd.to_datetime(prices_df["timestamp"], unit="ms")
+    prices_df["DateString"] = day_ordinals_to_strings(days)
+    return prices_df
+
+class PriceArchive:
+    # local archive of daily EUR prices of many tokens (csv or parquet), read once. long format (timestamp, cg_id,
+    # price) or wide format (timestamp and one price column per cg_id), timestamps in ms or a date column instead.
+    # a missing file is an empty archive
+
+    def __init__(self, filepath):
+        self.filepath = filepath
+        self.df = None
+
+    def read(self):
+        if self.df is None:
+            if not os.path.exists(self.filepath):
+                df = pd.DataFrame(columns=LONG_PRICE_COLUMNS)
+            elif self.filepath.endswith(".parquet"):
+                df = pd.read_parquet(self.filepath)
+            else:
+                df = pd.read_csv(self.filepath)
+            if "timestamp" not in df.columns:
+                df.insert(0, "timestamp", pd.to_datetime(df.pop("date")).astype("int64") // 10**6)
+            self.df = to_long_prices(df)
+        return self.df
+
+    def load(self, cg_ids, date_start, date_end):
+        # long rows of cg_ids within the days from date_start to date_end
+        df = self.read()
+        days = df["timestamp"].to_numpy(dtype="int64") // 86400000
+        first_day, last_day = dates_to_day_ordinals([date_start, date_end])
+        return df[df["cg_id"].isin(list(cg_ids)).to_numpy() & (days >= first_day) & (days <= last_day)]
+
+def attach_shared_memory(name):
+    # only the creator of the block tracks (and unlinks) it. before python 3.13 attaching registers the block with
+    # the resource tracker too, which warns about a leak or unlinks it early when a worker has its own tracker.
+    # unregistering afterwards is not an option: pool workers share the creator's tracker, it would drop the
+    # creator's entry. so the registration is skipped
+    if sys.version_info >= (3, 13):
+        return shared_memory.SharedMemory(name=name, track=False)
+    register = resource_tracker.register
+    resource_tracker.register = lambda name, rtype: None
+    try:
+        return shared_memory.SharedMemory(name=name)
+    finally:
+        resource_tracker.register = register
+
+class PriceMatrix:
+    # dense (day x token) matrix of EUR prices, row i is day first_day + i, missing prices are NaN
+
+    def __init__(self, values, first_day, cg_ids):
+        assert values.shape[1] == len(cg_ids)
+        self.values = values
+        self.first_day = int(first_day)
+        self.cg_ids = list(cg_ids)
+        self.cg_id_index = pd.Index(self.cg_ids)
+
+    @classmethod
+    def from_prices_df(cls, prices_df):
+        cg_ids = [column for column in prices_df.columns if column not in PRICE_DF_COLUMNS]
+        days = date_strings_to_day_ordinals(prices_df["DateString"])
+        # keep the first row of each day, like a lookup on DateString would
+        days, first_rows = np.unique(days, return_index=True)
+        first_day = days[0]
+
+        values = np.full((days[-1] - first_day + 1, len(cg_ids)), np.nan)
+        values[days - first_day] = prices_df[cg_ids].to_numpy(dtype=float)[first_rows]
+        return cls(values, first_day, cg_ids)
+
+    def save(self, prefix):
+        # both files are replaced atomically, values first: a matrix loaded before (memory-mapped, also by batch
+        # workers) keeps reading the old file
+        os.makedirs(os.path.dirname(prefix) or ".", exist_ok=True)
+        write_atomic(f"{prefix}_values.npy", lambda path: save_npy(path, self.values))
+        write_atomic(f"{prefix}_meta.json", lambda path: json.dump({"first_day": self.first_day, "cg_ids": self.cg_ids}, open(path, "w")))
+
+    @classmethod
+    def load(cls, prefix, mmap_mode="r"):
+        meta = json.load(open(f"{prefix}_meta.json"))
+        return cls(np.load(f"{prefix}_values.npy", mmap_mode=mmap_mode), meta["first_day"], meta["cg_ids"])
+
+    def covers(self, cg_ids, first_day, last_day):
+        return set(cg_ids) <= set(self.cg_ids) and self.first_day <= first_day and last_day < self.first_day + self.num_days()
+
+    def stale_tokens(self, max_lag_days=0):
+        # tokens whose prices end more than max_lag_days before the last day, tokens without any price are not stale
+        has_price = ~np.isnan(self.values)
+        last_rows = self.num_days() - 1 - np.argmax(has_price[::-1], axis=0)
+        stale = has_price.any(axis=0) & (last_rows < self.num_days() - 1 - max_lag_days)
+        return [cg_id for cg_id, is_stale in zip(self.cg_ids, stale) if is_stale]
+
+    def to_shared_memory(self):
+        # copies the values into a new shared memory block, the caller closes and unlinks it.
+        # the returned spec is small and picklable, from_shared_memory(spec) maps the block without copying
+        shm = shared_memory.SharedMemory(create=True, size=max(self.values.nbytes, 1))
+        np.ndarray(self.values.shape, dtype=self.values.dtype, buffer=shm.buf)[:] = self.values
+        return shm, (shm.name, self.values.shape, self.values.dtype.str, self.first_day, self.cg_ids)
+
+    @classmethod
+    def from_shared_memory(cls, spec):
+        name, shape, dtype, first_day, cg_ids = spec
+        shm = attach_shared_memory(name)
+        values = np.ndarray(shape, dtype=dtype, buffer=shm.buf)
+        values.flags.writeable = False
+        price_matrix = cls(values, first_day, cg_ids)
+        price_matrix.shm = shm # the mapping must outlive values
+        return price_matrix
+
+    def num_days(self):
+        return self.values.shape[0]
+
+    def day_rows(self, day_ordinals):
+        rows = np.asarray(day_ordinals, dtype="int64") - self.first_day
+        return np.where((rows >= 0) & (rows < self.num_days()), rows, -1)
+
+    def token_columns(self, cg_ids):
+        return self.cg_id_index.get_indexer(pd.Index(cg_ids, dtype=object))
+
+    def prices_at(self, day_ordinals):
+        # (days x tokens) block, NaN rows for days outside the matrix
+        rows = self.day_rows(day_ordinals)
+        prices = np.full((len(rows), len(self.cg_ids)), np.nan)
+        prices[rows >= 0] = self.values[rows[rows >= 0]]
+        return prices
+
+    def value(self, amounts, day_ordinals):
+        # amounts: one per column. value at each day in one dot product, missing prices count as 0
+        return np.nan_to_num(self.prices_at(day_ordinals)) @ amounts
+
+    def lookup(self, day_ordinals, cg_ids):
+        rows = self.day_rows(day_ordinals)
+        columns = self.token_columns(cg_ids)
+        found = (rows >= 0) & (columns >= 0)
+
+        prices = np.full(len(rows), np.nan)
+        prices[found] = self.values[rows[found], columns[found]]
+        return prices
+
+TIMESTAMP_BITS = 34 # unix seconds fit until year 2514
+
+class IntradayPrices:
+    # EUR price samples of several tokens at arbitrary timestamps (unix seconds), stored as one array
+    # sorted by (token, timestamp) so that a single searchsorted resolves a whole transaction frame
+
+    def __init__(self, cg_ids, timestamps, prices):
+        cg_ids = pd.Index(cg_ids, dtype=object)
+        codes, uniques = pd.factorize(cg_ids)
+        timestamps = np.asarray(timestamps, dtype="int64")
+        keys = (codes.astype("int64") << TIMESTAMP_BITS) | timestamps
+        order = np.argsort(keys, kind="stable")
+
+        self.cg_id_index = pd.Index(uniques, dtype=object)
+        self.keys = keys[order]
+        self.timestamps = timestamps[order]
+        self.prices = np.asarray(prices, dtype=float)[order]
+
+    @classmethod
+    def from_df(cls, df, unit="s"):
+        # long format (timestamp, cg_id, price) or wide format (timestamp and one price column per cg_id)
+        df = to_long_prices(df)
+        timestamps = df["timestamp"].to_numpy(dtype="int64")
+        if unit == "ms":
+            timestamps = timestamps // 1000
+        return cls(df["cg_id"].to_numpy(), timestamps, df["price"].to_numpy())
+
+    @classmethod
+    def load(cls, filepath, unit="s"):
+        if filepath.endswith(".parquet"):
+            df = pd.read_parquet(filepath)
+        else:
+            df = pd.read_csv(filepath)
+        return cls.from_df(df, unit)
+
+    def lookup(self, timestamps, cg_ids, interpolate=False, max_age=None):
+        # as-of price: last sample at or before each timestamp, optionally interpolated linearly
+        # with the next sample of the same token. NaN before the first sample or if older than max_age
+        timestamps = np.asarray(timestamps, dtype="int64")
+        codes = self.cg_id_index.get_indexer(pd.Index(cg_ids, dtype=object)).astype("int64")
+        keys = (codes << TIMESTAMP_BITS) | timestamps
+
+        before = np.searchsorted(self.keys, keys, side="right") - 1
+        found = (codes >= 0) & (before >= 0)
+        found[found] = (self.keys[before[found]] >> TIMESTAMP_BITS) == codes[found]
+        if max_age is not None:
+            found[found] = timestamps[found] - self.timestamps[before[found]] <= max_age
+
+        prices = np.full(len(timestamps), np.nan)
+        prices[found] = self.prices[before[found]]
+
+        if interpolate:
+            after = before + 1
+            between = found & (after < len(self.keys))
+            between[between] = (self.keys[after[between]] >> TIMESTAMP_BITS) == codes[between]
+            t0 = self.timestamps[before[between]]
+            t1 = self.timestamps[after[between]]
+            p0 = self.prices[before[between]]
+            p1 = self.prices[after[between]]
+            prices[between] = p0 + (p1 - p0) * (timestamps[between] - t0) / (t1 - t0)
+
+        return prices
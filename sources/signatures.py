@@ -0,0 +1,96 @@
+import os
+import threading
+import numpy as np
+from sources.store import write_atomic, save_npy
+
+# Local 4-byte signature table: selector -> canonical signature, e.g. a9059cbb -> transfer(address,uint256).
+# The bundled tsv lists common methods, a larger dump (e.g. from 4byte.directory, same "selector<tab>signature"
+# format) can be placed at USER_SIGNATURES. Both are compiled once into sorted numpy arrays that are memory-mapped.
+
+BUNDLED_SIGNATURES = os.path.join(os.path.dirname(os.path.abspath(__file__)), "signatures.tsv")
+USER_SIGNATURES = "./data/4byte_signatures.tsv"
+COMPILED_PREFIX = "./data/4byte"
+
+class SignatureTable:
+    # selectors: sorted uint32, signature i is blob[offsets[i]:offsets[i + 1]]
+    def __init__(self, selectors, offsets, blob):
+        self.selectors = selectors
+        self.offsets = offsets
+        self.blob = blob
+
+    @classmethod
+    def from_tsv(cls, filepaths):
+        signatures = {}
+        for filepath in filepaths:
+            for line in open(filepath):
+                parts = line.strip().split("\t")
+                if len(parts) != 2:
+                    continue
+                selector = int(parts[0].lower().replace("0x", ""), 16)
+                # the first signature listed for a selector wins
+                signatures.setdefault(selector, parts[1])
+
+        selectors = np.array(sorted(signatures.keys()), dtype="uint32")
+        encoded = [signatures[int(x)].encode() for x in selectors]
+        offsets = np.zeros(len(encoded) + 1, dtype="int64")
+        offsets[1:] = np.cumsum([len(x) for x in encoded])
+        blob = np.frombuffer(b"".join(encoded), dtype="uint8")
+        return cls(selectors, offsets, blob)
+
+    def save(self, prefix):
+        # each file is replaced atomically, blob (whose mtime get_signature_table checks) last
+        os.makedirs(os.path.dirname(prefix) or ".", exist_ok=True)
+        for name in ["selectors", "offsets", "blob"]:
+            write_atomic(f"{prefix}_{name}.npy", lambda path: save_npy(path, getattr(self, name)))
+
+    @classmethod
+    def load(cls, prefix):
+        return cls(*[np.load(f"{prefix}_{name}.npy", mmap_mode="r") for name in ["selectors", "offsets", "blob"]])
+
+    def __len__(self):
+        return len(self.selectors)
+
+    def positions(self, selectors):
+        # binary search, -1 where the selector is unknown
+        selectors = np.asarray(selectors, dtype="uint32")
+        if len(self.selectors) == 0:
+            return np.full(len(selectors), -1)
+        positions = np.minimum(np.searchsorted(self.selectors, selectors), len(self.selectors) - 1)
+        return np.where(self.selectors[positions] == selectors, positions, -1)
+
+    def signature(self, selector_hex):
+        selector = parse_selector(selector_hex)
+        if selector is None:
+            return None
+        position = self.positions([selector])[0]
+        if position < 0:
+            return None
+        return bytes(self.blob[self.offsets[position]:self.offsets[position + 1]]).decode()
+
+    def method_name(self, selector_hex):
+        signature = self.signature(selector_hex)
+        return signature.split("(")[0] if signature is not None else None
+
+def parse_selector(selector_hex):
+    selector_hex = selector_hex.lower().replace("0x", "")
+    if len(selector_hex) != 8:
+        return None
+    try:
+        return int(selector_hex, 16)
+    except ValueError:
+        return None
+
+signature_table = None
+signature_table_lock = threading.Lock()
+
+def get_signature_table():
+    # compiles the tsv files when the arrays are missing or older than them, once for all threads
+    global signature_table
+    with signature_table_lock:
+        if signature_table is None:
+            sources = [x for x in [BUNDLED_SIGNATURES, USER_SIGNATURES] if os.path.exists(x)]
+            compiled = f"{COMPILED_PREFIX}_blob.npy"
+            if not os.path.exists(compiled) or os.path.getmtime(compiled) < max([os.path.getmtime(x) for x in sources]):
+                SignatureTable.from_tsv(sources).save(COMPILED_PREFIX)
+            signature_table = SignatureTable.load(COMPILED_PREFIX)
+        return signature_table
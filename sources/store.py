@@ -0,0 +1,103 @@
+import os
+import json
+import threading
+import numpy as np
+import pandas as pd
+
+# Columnar on-disk cache. A table is a directory of parquet parts plus a small json file with metadata
+# (e.g. the block range it covers). Appending writes a new part, loading reads all parts at once.
+
+class ColumnarStore:
+    def __init__(self, root):
+        self.root = root
+
+    def table_dir(self, key):
+        return os.path.join(self.root, *[str(x) for x in key])
+
+    def meta_path(self, key):
+        return os.path.join(self.table_dir(key), "_meta.json")
+
+    def meta(self, key):
+        if os.path.exists(self.meta_path(key)):
+            return json.load(open(self.meta_path(key)))
+        else:
+            return None
+
+    def parts(self, key):
+        table_dir = self.table_dir(key)
+        if not os.path.isdir(table_dir):
+            return []
+        return sorted([os.path.join(table_dir, x) for x in os.listdir(table_dir) if x.endswith(".parquet")])
+
+    def load(self, key, columns=None):
+        if self.meta(key) is None:
+            return None
+        parts = self.parts(key)
+        if len(parts) == 0:
+            return pd.DataFrame(columns=columns)
+        return pd.concat([pd.read_parquet(part, columns=columns) for part in parts], ignore_index=True)
+
+    def append(self, key, df, **meta):
+        # meta values are merged into the existing metadata
+        table_dir = self.table_dir(key)
+        os.makedirs(table_dir, exist_ok=True)
+
+        if len(df) > 0 and len(df.columns) > 0:
+            part_path = os.path.join(table_dir, f"part-{len(self.parts(key)):05d}.parquet")
+            write_atomic(part_path, lambda path: df.to_parquet(path, index=False))
+
+        new_meta = self.meta(key) or {}
+        new_meta.update(meta)
+        write_atomic(self.meta_path(key), lambda path: json.dump(new_meta, open(path, "w")))
+        return new_meta
+
+    def write(self, key, df, **meta):
+        # replaces the table
+        self.clear(key)
+        return self.append(key, df, **meta)
+
+    def clear(self, key):
+        for part in self.parts(key):
+            os.remove(part)
+        if os.path.exists(self.meta_path(key)):
+            os.remove(self.meta_path(key))
+
+def write_atomic(path, write):
+    tmp_path = path + ".tmp"
+    write(tmp_path)
+    os.replace(tmp_path, path)
+
+def save_npy(path, values):
+    # np.save appends .npy to paths without it
+    with open(path, "wb") as f:
+        np.save(f, values)
+
+class KeyValueStore:
+    # append-only json lines file for small results (ABIs, eth_call results), read once per process
+    def __init__(self, path):
+        self.path = path
+        self.values = None
+        self.lock = threading.Lock()
+
+    def _load(self):
+        if self.values is None:
+            self.values = {}
+            if os.path.exists(self.path):
+                for line in open(self.path):
+                    if line.strip():
+                        entry = json.loads(line)
+                        self.values[entry["key"]] = entry["value"]
+        return self.values
+
+    def __contains__(self, key):
+        return key in self._load()
+
+    def get(self, key, default=None):
+        return self._load().get(key, default)
+
+    def put(self, key, value):
+        with self.lock:
+            self._load()[key] = value
+            os.makedirs(os.path.dirname(self.path) or ".", exist_ok=True)
+            with open(self.path, "a") as f:
+                f.write(json.dumps({"key": key, "value": value}) + "\n")
@@ -1,6 +1,9 @@
 import pandas as pd
 import numpy as np
+from decimal import Decimal
 from pycoingecko import CoinGeckoAPI
+from sources import instrumentation
+from sources.prices import PriceMatrix, to_day_ordinals, day_ordinals_to_strings, dates_to_day_ordinals
 cg = CoinGeckoAPI()
 
 pd.set_option('display.max_columns', None)
@@ -61,6 +64,37 @@ def is_nft_in(row):
 def is_nft_out(row):
     return is_nft(row) & is_out(row)
 
+ROW_FLAGS = ["IsIn", "IsOut", "IsPriced", "IsUnpriced", "IsNft"]
+
+def are_my_wallet(addresses, platforms):
+    # column-wise version of is_my_wallet
+    unknown = set(platforms.unique()) - {"ethereum", "arbitrum"}
+    if len(unknown) > 0:
+        raise NotImplementedError
+    return (addresses == "my_wallet").to_numpy()
+
+def compute_row_flags(tx_df):
+    # same predicates as is_in, is_out, is_priced, is_unpriced and is_nft, computed once for the whole frame
+    amount = tx_df["Amount"].astype(float)
+    return {
+        "IsIn": are_my_wallet(tx_df["To"], tx_df["Platform"]),
+        "IsOut": are_my_wallet(tx_df["From"], tx_df["Platform"]),
+        "IsPriced": (tx_df["ValueEuro"] > 0).to_numpy(),
+        "IsUnpriced": ((amount > 0) & tx_df["cg_id"].isna()).to_numpy(),
+        "IsNft": (amount.isna() & (tx_df["ExportType"] == "erc721")).to_numpy(),
+    }
+
+def add_row_flags(tx_df):
+    for flag, values in compute_row_flags(tx_df).items():
+        tx_df[flag] = values
+    return tx_df
+
+def get_row_flags(tx_rows):
+    if all(flag in tx_rows.columns for flag in ROW_FLAGS):
+        return {flag: tx_rows[flag].to_numpy() for flag in ROW_FLAGS}
+    else:
+        return compute_row_flags(tx_rows)
+
 def show(tx_df, column, value):
     return tx_df[tx_df[column] == value]
 
@@ -111,24 +145,80 @@ def get_contract_id(tx_rows):
         raise Exception(f"multiple possible contract_ids for transaction")
 
 def get_token_id2current_price(prices_df, tokens, time_end):
-    current_prices = prices_df[prices_df["DateString"] == get_today_string(time_end)].iloc[0].reset_index()
-    current_prices.columns = ["cg_id", "current_price"]
-    current_prices = current_prices[~current_prices["cg_id"].isin(["timestamp", "date", "DateString"]) ]
-    tokens_df = tokens.merge(current_prices, on="cg_id", how="left")
-    tokens_df["token_id"] = tokens_df.apply(get_token_id, axis=1)
-    token_id2current_price = {row.token_id: row.current_price for i, row in tokens_df[tokens_df["current_price"].notnull()].iterrows()}
+    price_matrix = prices_df if type(prices_df) == PriceMatrix else PriceMatrix.from_prices_df(prices_df)
+    token_ids = tokens.apply(get_token_id, axis=1)
+    current_prices = price_matrix.lookup(np.repeat(dates_to_day_ordinals([time_end]), len(tokens)), tokens["cg_id"])
+    token_id2current_price = {token_id: price for token_id, price in zip(token_ids, current_prices) if not np.isnan(price)}
     token_id2current_price["EUR"] = 1
     return token_id2current_price
 
-def merge_tx_df_with_prices(tx_df, tokens, prices_df):
+def get_token_id2cg_id(tokens):
+    tokens = tokens[tokens["cg_id"].notnull()]
+    return dict(zip(tokens.apply(get_token_id, axis=1), tokens["cg_id"]))
+
+def parse_timestamps(timestamps):
+    # unix seconds as int64. explorer exports have them as strings, which astype parses several times faster
+    # than pd.to_numeric, the latter is kept for other formats (e.g. "1514766911.0")
+    try:
+        return timestamps.to_numpy().astype("int64")
+    except (ValueError, TypeError):
+        return pd.to_numeric(timestamps).to_numpy().astype("int64")
+
+def token_positions(tx_df, tokens):
+    # position in tokens of the (TokenName, TokenSymbol) of each row, -1 where it is missing. a left merge on the
+    # distinct pairs only, tokens has one row per pair
+    name_codes, names = pd.factorize(tx_df["TokenName"], use_na_sentinel=False)
+    symbol_codes, symbols = pd.factorize(tx_df["TokenSymbol"], use_na_sentinel=False)
+    pair_codes, pairs = pd.factorize(name_codes.astype("int64") * len(symbols) + symbol_codes)
+    pair_keys = pd.MultiIndex.from_arrays([names[pairs // len(symbols)], symbols[pairs % len(symbols)]])
+    return pd.MultiIndex.from_frame(tokens[["TokenName", "TokenSymbol"]]).get_indexer(pair_keys)[pair_codes]
+
+@instrumentation.timed()
+def merge_tx_df_with_prices(tx_df, tokens, prices_df, intraday_prices=None, interpolate=False):
+
+    timestamps = parse_timestamps(tx_df["TimeStamp"])
+    if (timestamps[1:] >= timestamps[:-1]).all():
+        tx_df = tx_df.reset_index(drop=True)
+    else:
+        order = np.argsort(timestamps, kind="stable")
+        timestamps = timestamps[order]
+        tx_df = tx_df.iloc[order].reset_index(drop=True)
+    positions = token_positions(tx_df, tokens)
+    for column in tokens.columns.drop(["TokenName", "TokenSymbol"]):
+        tx_df[column] = pd.api.extensions.take(tokens[column].to_numpy(), positions, allow_fill=True)
+
+    price_matrix = prices_df if type(prices_df) == PriceMatrix else PriceMatrix.from_prices_df(prices_df)
+    day_ordinals = to_day_ordinals(timestamps)
+    tx_df["DateString"] = day_ordinals_to_strings(day_ordinals)
+
+    prices = price_matrix.lookup(day_ordinals, tx_df["cg_id"])
+    if intraday_prices is not None:
+        # intraday as-of price where available, daily price otherwise
+        intraday = intraday_prices.lookup(timestamps, tx_df["cg_id"], interpolate=interpolate, max_age=86400)
+        prices = np.where(np.isnan(intraday), prices, intraday)
+    prices[(tx_df["TokenSymbol"] == "EUR").to_numpy()] = 1
+    tx_df["TokenPriceEuro"] = prices
+    tx_df["ValueEuro"] = prices * tx_df["Amount"].to_numpy(dtype=float)
+
+    # same as get_tx_fee for every row
+    fees = tx_df["TxnFee(ETH)"].to_numpy(dtype=float) if "TxnFee(ETH)" in tx_df.columns else np.zeros(len(tx_df))
+    has_fee = fees > 0
+    assert (tx_df["TokenName"].to_numpy()[has_fee] == "Ethereum").all()
+    tx_df["TxnFee(Euro)"] = np.where(has_fee, fees * prices, np.nan)
+    instrumentation.count("rows_priced", len(tx_df))
+    return tx_df
 
-    tx_df = tx_df.merge(tokens, on=["TokenName", "TokenSymbol"], how="left")
-    tx_df.sort_values("TimeStamp", inplace=True)
-    tx_df.reset_index(drop="True", inplace=True)
-    tx_df["DateString"] = tx_df.TimeStamp.apply(lambda x:pd.to_datetime(x, unit="s").strftime("%Y-%m-%d"))
-    tx_df["TokenPriceEuro"] = tx_df.apply(lambda row: match_price(row, prices_df), axis=1)
-    tx_df["ValueEuro"] = tx_df.apply(lambda x: x["TokenPriceEuro"]*x["Amount"], axis=1)
-    tx_df["TxnFee(Euro)"] = tx_df.apply(get_tx_fee, axis=1)
+def to_base_units(amount, decimals):
+    # the shortest decimal of amount in units of 10**-decimals, exact for amounts of up to 15 significant digits
+    return None if np.isnan(amount) else str(round(Decimal(repr(float(amount))).scaleb(int(decimals))))
+
+def add_base_units(tx_df, token_decimals, default_decimals=18):
+    # Units, Decimals and TxnFee(Wei) for ledgers that only have float amounts (e.g. csv exports), combine_etherscan_dfs
+    # keeps them from the raw values. token_decimals: {TokenSymbol: decimals}
+    decimals = tx_df["TokenSymbol"].map(token_decimals).fillna(default_decimals).astype(np.int64)
+    tx_df["Units"] = [to_base_units(amount, x) for amount, x in zip(tx_df["Amount"], decimals)]
+    tx_df["Decimals"] = decimals
+    tx_df["TxnFee(Wei)"] = [to_base_units(fee, 18) for fee in tx_df["TxnFee(ETH)"]]
     return tx_df
 
 def get_token_id(row):
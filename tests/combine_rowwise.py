@@ -0,0 +1,76 @@
+# the row-wise preprocessing combine_etherscan_dfs used before it was vectorized, reference for its tests and benchmark
+import pandas as pd
+import sources.io_utils as io_utils
+from sources.utils import capitalize
+
+ADDRESS = "0x" + "ab" * 20
+
+def combine_etherscan_dfs_rowwise(etherscan_dfs, eth_address, platform="ethereum", offline=False):
+
+    for key in etherscan_dfs.keys():
+        df = etherscan_dfs[key]
+        df.rename(columns={x:capitalize(x) for x in df.columns}, inplace=True)
+
+        df["Platform"] = platform
+        df["ExportType"] = key
+        
+        if key == "normal":
+            df["TxnFee(ETH)"] = df.apply(lambda x: int(x.GasPrice) * int(x.GasUsed) / 1e18, axis=1)
+
+            df["Method"] = io_utils.decode_methods(df, platform, offline)
+
+            errors = df[df["Method"].apply(lambda x: "error" in x)]
+            if len(errors)>0:
+                print(f"method errors:" + errors["To"].unique())
+
+        if key == "erc20":
+            df["Amount"] = df.apply(lambda row: int(row.Value) / 10**(int(row.TokenDecimal)), axis=1)
+
+        if key in ["normal", "internal"] :
+            df["Amount"] = df["Value"].apply(lambda x: int(x) / 1e18)
+            df["TokenName"] = "Ethereum"
+            df["TokenSymbol"] = "ETH"
+
+        etherscan_dfs[key] = df
+        
+    name_replacements = {
+    "stETH": "Lido Staked Ether"
+    }
+    # todo fetch automatically contract names
+    address_dict = {
+    eth_address.lower(): "my_wallet",
+    "0xd18140b4b819b895a3dba5442f959fa44994af50": "CVX Locker",
+    "0x3fe65692bfcd0e6cf84cb1e7d24108e434a7587e": "cvxCRV Locker",
+    "0x4dbd4fc535ac27206064b68ffcf827b0a60bab3f": "arbitrum_bridge_l1",
+    "0x72a19342e8f1838460ebfccef09f6585e32db86e": "vlCVX",
+    "0x9e3382ca57f4404ac7bf435475eae37e87d1c453": "Eden Network: Proxy",
+    "0xf403c135812408bfbe8713b5a23a04b3d48aae31": "Convex Finance: Booster",
+    "0xc36442b4a4522e871399cd717abdd847ab11fe88": "Uniswap V3: Positions NFT",
+    "0x9008d19f58aabd9ed0d60971565aa8510560ab41": "CoW Protocol: GPv2Settlement",
+    "0x000000000000000000000000000000000000006e": "arbitrum_bridge_l2",
+    "0x2c9c1e9b4bdf6bf9cb59c77e0e8c0892ce3a9d5f": "Dopex: ETH SSOV"
+    }   
+    unused_columns = ["Nonce", "BlockHash", "TransactionIndex", "Gas", "GasPrice", "Input", "ContractAddress", "CumulativeGasUsed", "GasUsed", "Confirmations", "Value", "TokenDecimal", "TraceId", "IsError", "Txreceipt_status", "Type", "ErrCode", "TokenID", "BlockNumber"]
+
+    tx_df = pd.concat(list(etherscan_dfs.values()), ignore_index=True)
+    tx_df["TokenName"] = tx_df["TokenName"].apply(lambda x: name_replacements[x] if x in name_replacements.keys() else x)
+    tx_df = tx_df[tx_df["TokenSymbol"] != "CNV"]
+    tx_df["Amount"] = tx_df["Amount"].apply(lambda x: float(x.replace(",","")) if type(x)==str else x )
+    tx_df.drop(columns=tx_df.columns.intersection(unused_columns), inplace=True)
+    tx_df.sort_values("TimeStamp", inplace=True)
+    tx_df.reset_index(inplace=True, drop=True)
+
+    if platform == "arbitrum": # bridge deposits are marked as "to" instead of "from" (?)
+        indices = tx_df[tx_df["To"] == "0x000000000000000000000000000000000000006e"].index
+        for i in indices:
+            tx_df.at[i, "To"] = tx_df.loc[i]["From"]
+            tx_df.at[i, "From"] = "0x000000000000000000000000000000000000006e"
+
+    tx_df["From"] = tx_df["From"].apply(lambda x: address_dict.get(x, x))
+    tx_df["To"] = tx_df["To"].apply(lambda x: address_dict.get(x, x))   
+    return tx_df
+
+
+def copy_dfs(etherscan_dfs):
+    # combine_etherscan_dfs renames the columns of its input in place
+    return {key: df.copy() for key, df in etherscan_dfs.items()}
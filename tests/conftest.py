@@ -0,0 +1,9 @@
+import pytest
+import sources.signatures as signatures
+
+@pytest.fixture(autouse=True)
+def signature_table_in_tmp_path(monkeypatch, tmp_path):
+    # get_signature_table compiles into COMPILED_PREFIX on first use, keep that out of ./data
+    monkeypatch.setattr(signatures, "COMPILED_PREFIX", str(tmp_path / "4byte"))
+    monkeypatch.setattr(signatures, "USER_SIGNATURES", str(tmp_path / "4byte_signatures.tsv"))
+    monkeypatch.setattr(signatures, "signature_table", None)
@@ -0,0 +1,223 @@
+# synthetic wallet histories for tests and benchmarks, in the schema of combine_etherscan_dfs (before pricing, with base units):
+# swaps both ways, fee-paying transfers and approvals, payments in, contract deposits/withdrawals,
+# liquid deposits/withdrawals and NFTs. balances are tracked so that the history never spends more than it holds
+import numpy as np
+import pandas as pd
+from sources.accounting import INITIAL_DEPOSIT_WALLET
+from sources.utils import merge_tx_df_with_prices, add_base_units
+
+COLUMNS = ["Hash", "TimeStamp", "From", "To", "Platform", "ExportType", "Method", "TokenName", "TokenSymbol", "Amount", "TxnFee(ETH)"]
+
+# symbol: (name, cg_id, start price in EUR)
+TOKENS = {
+    "ETH": ("Ethereum", "ethereum", 1000.),
+    "USDC": ("USD Coin", "usd-coin", 1.),
+    "DAI": ("Dai Stablecoin", "dai", 1.),
+    "CRV": ("Curve DAO Token", "curve-dao-token", 2.),
+    "CVX": ("Convex Token", "convex-finance", 5.),
+    "UNI-V2": ("Uniswap V2", None, None),
+    "NFT": ("Some NFT", None, None),
+}
+# symbol: decimals, others have 18
+DECIMALS = {"USDC": 6, "NFT": 0}
+ERC20 = ["USDC", "DAI", "CRV", "CVX"]
+POOLS = ["pool0", "pool1", "pool2"]
+
+EVENTS = ["swap_in", "swap_out", "transfer_out", "approve", "payment_in", "deposit", "withdraw",
+          "liquid_deposit", "liquid_withdraw", "nft_in"]
+EVENT_WEIGHTS = [0.2, 0.15, 0.1, 0.1, 0.1, 0.1, 0.08, 0.07, 0.06, 0.04]
+
+class LedgerBuilder:
+    def __init__(self, rng):
+        self.rng = rng
+        self.rows = []
+        self.num_txs = 0
+        self.eth = 0.
+        self.spot = {symbol: 0. for symbol in ERC20}
+        self.deposits = {(pool, symbol): 0. for pool in POOLS for symbol in ERC20}
+        self.lp = {"amount": 0., "ETH": 0., "USDC": 0.}
+
+    def row(self, sender, receiver, export_type, method, symbol, amount, fee=np.nan):
+        # TimeStamp holds the transaction number until make_tx_df spreads the transactions over time
+        self.rows.append([f"0x{self.num_txs:064x}", self.num_txs, sender, receiver, "ethereum", export_type, method,
+                          TOKENS[symbol][0], symbol, amount, fee])
+
+    def fee(self):
+        fee = float(self.rng.uniform(0.0005, 0.005))
+        self.eth -= fee
+        return fee
+
+    def normal(self, receiver, method, amount=0.):
+        self.row("my_wallet", receiver, "normal", method, "ETH", amount, self.fee())
+
+    def tx(self, event):
+        rng = self.rng
+        if self.eth < 1:
+            self.row(INITIAL_DEPOSIT_WALLET, "my_wallet", "normal", "transfer", "ETH", 100.)
+            self.eth += 100.
+
+        elif event == "swap_in":
+            symbol = rng.choice(ERC20)
+            amount = round(float(rng.uniform(0.01, 0.1) * self.eth), 6)
+            self.normal("router", "swapExactETHForTokens", amount)
+            self.eth -= amount
+            received = amount * 1000 / TOKENS[symbol][2]
+            self.row("router", "my_wallet", "erc20", None, symbol, received)
+            self.spot[symbol] += received
+
+        elif event == "swap_out" and max(self.spot.values()) > 1:
+            symbol = max(self.spot, key=self.spot.get)
+            amount = self.spot[symbol] * float(rng.uniform(0.1, 0.5))
+            self.normal("router", "swapExactTokensForETH")
+            self.row("my_wallet", "router", "erc20", None, symbol, amount)
+            self.spot[symbol] -= amount
+            received = amount * TOKENS[symbol][2] / 1000
+            self.row("router", "my_wallet", "internal", None, "ETH", received)
+            self.eth += received
+
+        elif event == "transfer_out":
+            amount = round(float(rng.uniform(0.001, 0.05) * self.eth), 6)
+            self.normal("shop", "transfer", amount)
+            self.eth -= amount
+
+        elif event == "payment_in":
+            symbol = rng.choice(ERC20)
+            amount = float(rng.uniform(10, 1000))
+            self.row("friend", "my_wallet", "erc20", None, symbol, amount)
+            self.spot[symbol] += amount
+
+        elif event == "deposit" and max(self.spot.values()) > 1:
+            symbol = max(self.spot, key=self.spot.get)
+            pool = rng.choice(POOLS)
+            amount = self.spot[symbol] * float(rng.uniform(0.1, 0.5))
+            self.normal(pool, "deposit")
+            self.row("my_wallet", pool, "erc20", None, symbol, amount)
+            self.spot[symbol] -= amount
+            self.deposits[(pool, symbol)] += amount
+
+        elif event == "withdraw" and max(self.deposits.values()) > 1:
+            pool, symbol = max(self.deposits, key=self.deposits.get)
+            amount = self.deposits[(pool, symbol)] * float(rng.uniform(0.2, 1))
+            self.normal(pool, "withdraw")
+            self.row(pool, "my_wallet", "erc20", None, symbol, amount)
+            self.deposits[(pool, symbol)] -= amount
+            self.spot[symbol] += amount
+
+        elif event == "liquid_deposit" and self.spot["USDC"] > 10:
+            eth_amount = round(float(rng.uniform(0.01, 0.05) * self.eth), 6)
+            usdc_amount = min(eth_amount * 1000, self.spot["USDC"] * 0.9)
+            lp_amount = float(rng.uniform(1, 10))
+            self.normal("lp", "addLiquidity", eth_amount)
+            self.row("my_wallet", "lp", "erc20", None, "USDC", usdc_amount)
+            self.row("lp", "my_wallet", "erc20", None, "UNI-V2", lp_amount)
+            self.eth -= eth_amount
+            self.spot["USDC"] -= usdc_amount
+            self.lp = {"amount": self.lp["amount"] + lp_amount, "ETH": self.lp["ETH"] + eth_amount, "USDC": self.lp["USDC"] + usdc_amount}
+
+        elif event == "liquid_withdraw" and self.lp["amount"] > 0.1:
+            ratio = float(rng.uniform(0.1, 0.6))
+            removed = {key: value * ratio for key, value in self.lp.items()}
+            self.normal("lp", "removeLiquidity")
+            self.row("my_wallet", "lp", "erc20", None, "UNI-V2", removed["amount"])
+            self.row("lp", "my_wallet", "erc20", None, "USDC", removed["USDC"])
+            self.row("lp", "my_wallet", "internal", None, "ETH", removed["ETH"])
+            self.lp = {key: value - removed[key] for key, value in self.lp.items()}
+            self.eth += removed["ETH"]
+            self.spot["USDC"] += removed["USDC"]
+
+        elif event == "nft_in":
+            self.row("seller", "my_wallet", "erc721", None, "NFT", np.nan)
+
+        else:
+            self.normal("token", "approve")
+
+        self.num_txs += 1
+
+def make_tx_df(num_rows, seed=0, start=1514764800, span_days=5 * 365):
+    # about num_rows rows (transactions have 1 to 4 rows)
+    rng = np.random.default_rng(seed)
+    builder = LedgerBuilder(rng)
+    for event in rng.choice(EVENTS, size=num_rows, p=EVENT_WEIGHTS):
+        if len(builder.rows) >= num_rows:
+            break
+        builder.tx(event)
+
+    tx_df = pd.DataFrame(builder.rows, columns=COLUMNS)
+    timestamps = np.sort(rng.integers(start, start + span_days * 86400, builder.num_txs))
+    tx_df["TimeStamp"] = timestamps[tx_df["TimeStamp"].to_numpy()].astype(str)
+    return add_base_units(tx_df, DECIMALS)
+
+def make_tokens():
+    return pd.DataFrame([(name, symbol, cg_id) for symbol, (name, cg_id, _) in TOKENS.items()],
+                        columns=["TokenName", "TokenSymbol", "cg_id"])
+
+def make_prices_df(seed=0, start=1514764800, span_days=5 * 365):
+    # daily EUR prices as returned by fetch_historical_prices, a random walk per token
+    rng = np.random.default_rng(seed)
+    days = np.arange(span_days + 1)
+    prices_df = pd.DataFrame({"timestamp": (start + days * 86400) * 1000})
+    for name, cg_id, price in TOKENS.values():
+        if cg_id is not None:
+            prices_df[cg_id] = price * np.exp(np.cumsum(rng.normal(0, 0.02, len(days))))
+    prices_df["date"] = pd.to_datetime(prices_df["timestamp"], unit="ms")
+    prices_df["DateString"] = prices_df["date"].dt.strftime("%Y-%m-%d")
+    return prices_df
+
+def make_priced_tx_df(num_rows, seed=0):
+    return merge_tx_df_with_prices(make_tx_df(num_rows, seed), make_tokens(), make_prices_df(seed))
+
+# raw explorer lists as returned by get_or_load_etherscan_dfs, for the preprocessing in combine_etherscan_dfs.
+# values span 1 to 10**22 wei, so that many of them exceed int64, and some gas fees overflow int64 too
+ETHERSCAN_COLUMNS = {
+    "normal": ["blockNumber", "timeStamp", "hash", "nonce", "blockHash", "transactionIndex", "from", "to", "value", "gas",
+               "gasPrice", "isError", "txreceipt_status", "input", "contractAddress", "cumulativeGasUsed", "gasUsed", "confirmations"],
+    "erc20": ["blockNumber", "timeStamp", "hash", "nonce", "blockHash", "from", "contractAddress", "to", "value", "tokenName",
+              "tokenSymbol", "tokenDecimal", "transactionIndex", "gas", "gasPrice", "gasUsed", "cumulativeGasUsed", "input", "confirmations"],
+    "internal": ["blockNumber", "timeStamp", "hash", "from", "to", "value", "contractAddress", "input", "type", "gas", "gasUsed",
+                 "traceId", "isError", "errCode"],
+    "erc721": ["blockNumber", "timeStamp", "hash", "nonce", "blockHash", "from", "contractAddress", "to", "tokenID", "tokenName",
+               "tokenSymbol", "tokenDecimal", "transactionIndex", "gas", "gasPrice", "gasUsed", "cumulativeGasUsed", "input", "confirmations"],
+}
+ETHERSCAN_SHARES = {"normal": 0.4, "erc20": 0.35, "internal": 0.15, "erc721": 0.1}
+COUNTERPARTIES = ["0xd18140b4b819b895a3dba5442f959fa44994af50", "0xf403c135812408bfbe8713b5a23a04b3d48aae31",
+                  "0x000000000000000000000000000000000000006e"] + ["0x%040x" % i for i in range(1, 30)]
+INPUTS = ["0x", "0xa9059cbb" + "00" * 64, "0x7ff36ab5" + "00" * 128, "0x095ea7b3" + "00" * 64]
+ERC20_TOKENS = [("USD Coin", "USDC", "6"), ("Dai Stablecoin", "DAI", "18"), ("stETH", "stETH", "18"),
+                ("Concave", "CNV", "18"), ("Gemini dollar", "GUSD", "2"), ("Zero decimals", "ZERO", "0")]
+
+def random_int_strings(rng, num_rows, max_digits):
+    # decimal strings with 1 to max_digits digits
+    head = rng.integers(1, 10, num_rows).astype(str)
+    tail_digits = rng.integers(0, max_digits, num_rows)
+    tail = np.char.zfill(rng.integers(0, 10**15, num_rows).astype(str), 15)
+    tail = np.char.add(tail, np.char.zfill(rng.integers(0, 10**15, num_rows).astype(str), 15))
+    return np.array([h + t[:n] for h, t, n in zip(head, tail, tail_digits)])
+
+def make_etherscan_dfs(num_rows, address="0x" + "ab" * 20, seed=0, start=1514764800):
+    rng = np.random.default_rng(seed)
+    parties = np.array(COUNTERPARTIES + [address])
+    etherscan_dfs = {}
+    for key, share in ETHERSCAN_SHARES.items():
+        n = int(num_rows * share)
+        timestamps = np.sort(rng.integers(start, start + 5 * 365 * 86400, n))
+        incoming = rng.random(n) < 0.5
+        others = rng.choice(parties[:-1], n)
+        columns = {
+            "blockNumber": (timestamps // 13).astype(str),
+            "timeStamp": timestamps.astype(str),
+            "hash": np.char.add("0x", np.char.zfill(rng.integers(0, 2**62, n).astype(str), 64)),
+            "from": np.where(incoming, others, address),
+            "to": np.where(incoming, address, others),
+            "value": random_int_strings(rng, n, 22),
+            "gasPrice": random_int_strings(rng, n, 13),
+            "gasUsed": rng.integers(21000, 3_000_000, n).astype(str),
+            "input": rng.choice(INPUTS, n),
+            "tokenID": rng.integers(0, 10000, n).astype(str),
+        }
+        if key == "erc20":
+            tokens = np.array(ERC20_TOKENS)[rng.integers(0, len(ERC20_TOKENS), n)]
+            columns.update(tokenName=tokens[:, 0], tokenSymbol=tokens[:, 1], tokenDecimal=tokens[:, 2])
+        else:
+            columns.update(tokenName="Some NFT", tokenSymbol="NFT", tokenDecimal="0")
+        etherscan_dfs[key] = pd.DataFrame({column: columns.get(column, "0") for column in ETHERSCAN_COLUMNS[key]})
+    return etherscan_dfs
@@ -0,0 +1,214 @@
+import pytest
+import numpy as np
+import pandas as pd
+import sources.accounting as accounting
+from sources.accounting import compute_portfolio_and_gains, compute_portfolio_and_gains_by_method, compute_portfolio_and_gains_chunked, read_tx_chunks
+from sources.accounting import make_checkpoint, Checkpoint, HoldingsHistory, value_portfolio, approx_holdings, INITIAL_DEPOSIT_WALLET
+from sources.prices import PriceMatrix
+from tests.synthetic import make_priced_tx_df
+from sources.classes import CostBasisMethod, TxType
+from sources.utils import compute_row_flags, add_row_flags, is_in, is_out, is_priced, is_unpriced, is_nft, add_base_units, get_method, get_contract_id
+
+COLUMNS = ["Hash", "TimeStamp", "From", "To", "Platform", "ExportType", "Method", "TokenName", "TokenSymbol", "Amount", "cg_id", "TokenPriceEuro", "TxnFee(ETH)"]
+
+PRICES = {"ETH": 2000., "USDC": 1.}
+NAMES = {"ETH": "Ethereum", "USDC": "USD Coin", "UNI-V2": "Uniswap V2", "NFT": "Some NFT"}
+CG_IDS = {"ETH": "ethereum", "USDC": "usd-coin"}
+
+def row(txhash, timestamp, sender, receiver, export_type, method, symbol, amount, fee=np.nan):
+    price = PRICES.get(symbol, np.nan)
+    return [txhash, timestamp, sender, receiver, "ethereum", export_type, method, NAMES[symbol], symbol, amount, CG_IDS.get(symbol), price, fee]
+
+def make_tx_df():
+    rows = [
+        row("h1", 1, INITIAL_DEPOSIT_WALLET, "my_wallet", "normal", "transfer", "ETH", 10., 0.001),
+        # swap, rows of the same hash are not contiguous
+        row("h2", 2, "my_wallet", "router", "normal", "swapExactETHForTokens", "ETH", 1., 0.01),
+        row("h3", 2, "my_wallet", "pool", "normal", "deposit", "ETH", 0., 0.005),
+        row("h2", 2, "router", "my_wallet", "erc20", None, "USDC", 2000.),
+        row("h3", 2, "my_wallet", "pool", "erc20", None, "USDC", 500.),
+        row("h4", 3, "my_wallet", "pool", "normal", "withdraw", "ETH", 0., 0.005),
+        row("h4", 3, "pool", "my_wallet", "erc20", None, "USDC", 200.),
+        row("h5", 4, "my_wallet", "lp", "normal", "addLiquidity", "ETH", 0.5, 0.01),
+        row("h5", 4, "my_wallet", "lp", "erc20", None, "USDC", 1000.),
+        row("h5", 4, "lp", "my_wallet", "erc20", None, "UNI-V2", 10.),
+        row("h6", 5, "my_wallet", "lp", "normal", "removeLiquidity", "ETH", 0., 0.01),
+        row("h6", 5, "my_wallet", "lp", "erc20", None, "UNI-V2", 4.),
+        row("h6", 5, "lp", "my_wallet", "erc20", None, "USDC", 450.),
+        row("h6", 5, "lp", "my_wallet", "internal", None, "ETH", 0.2),
+        row("h7", 6, "my_wallet", "shop", "normal", "transfer", "ETH", 0.1, 0.002),
+        row("h8", 7, "my_wallet", "token", "normal", "approve", "ETH", 0., 0.001),
+        row("h9", 8, "seller", "my_wallet", "erc721", None, "NFT", np.nan),
+    ]
+    tx_df = pd.DataFrame(rows, columns=COLUMNS)
+    tx_df["ValueEuro"] = tx_df["TokenPriceEuro"] * tx_df["Amount"]
+    tx_df["TxnFee(Euro)"] = tx_df["TxnFee(ETH)"] * tx_df["TokenPriceEuro"]
+    return tx_df
+
+def test_grouped_engine_matches_hash_filter():
+    tx_df = make_tx_df()
+
+    portfolio_ref, tx_df_ref = compute_portfolio_and_gains(tx_df, engine="hash_filter")
+    portfolio, tx_df_grouped = compute_portfolio_and_gains(tx_df, engine="grouped")
+
+    for column in ["Cost", "Gain/Loss", "RowCategory", "TxCategory", "TxnFee(Cost)", "TxnFee(Gain/Loss)"]:
+        assert tx_df_grouped[column].equals(tx_df_ref[column])
+
+    assert portfolio.cost() == portfolio_ref.cost()
+    assert tx_df_grouped["TxCategory"].tolist() == ["TRANSFER_IN", "SWAP", "CONTRACT_DEPOSIT", "SWAP", "CONTRACT_DEPOSIT",
+                                                    "CONTRACT_WITHDRAW", "CONTRACT_WITHDRAW", "LIQUID_DEPOSIT", "LIQUID_DEPOSIT", "LIQUID_DEPOSIT",
+                                                    "LIQUID_WITHDRAW", "LIQUID_WITHDRAW", "LIQUID_WITHDRAW", "LIQUID_WITHDRAW",
+                                                    "TRANSFER_OUT", "FEE_ONLY", "FEE_ONLY"]
+
+def test_row_flags_match_row_predicates():
+    tx_df = make_tx_df()
+    flags = compute_row_flags(tx_df)
+
+    assert flags["IsIn"].tolist() == tx_df.apply(is_in, axis=1).tolist()
+    assert flags["IsOut"].tolist() == tx_df.apply(is_out, axis=1).tolist()
+    assert flags["IsPriced"].tolist() == tx_df.apply(is_priced, axis=1).tolist()
+    assert flags["IsUnpriced"].tolist() == tx_df.apply(is_unpriced, axis=1).tolist()
+    assert flags["IsNft"].tolist() == tx_df.apply(is_nft, axis=1).tolist()
+
+def test_classify_frame_matches_replay():
+    tx_df = make_tx_df()
+    tx_categories, row_categories = accounting.classify_frame(add_row_flags(tx_df.copy()))
+    _, tx_df_gains = compute_portfolio_and_gains(tx_df)
+
+    assert tx_categories.tolist() == tx_df_gains["TxCategory"].tolist()
+    # withdrawals depend on the deposits in the portfolio
+    assert row_categories.tolist() == [x if x != "CONTRACT_WITHDRAW_IN" else None for x in tx_df_gains["RowCategory"]]
+
+    tx_df_synthetic = make_priced_tx_df(2000)
+    tx_categories, row_categories = accounting.classify_frame(add_row_flags(tx_df_synthetic.copy()))
+    _, tx_df_gains = compute_portfolio_and_gains(tx_df_synthetic, engine="hash_filter")
+    decided = (tx_categories != None) & (row_categories != None)
+    assert decided.mean() > 0.9
+    assert (tx_categories[decided] == tx_df_gains["TxCategory"].to_numpy()[decided]).all()
+    assert (row_categories[decided] == tx_df_gains["RowCategory"].to_numpy()[decided]).all()
+
+def test_tx_columns_match_tx_rows():
+    tx_df = accounting.init_output_columns(make_priced_tx_df(500))
+    for tx_rows in accounting.iter_tx_rows(tx_df):
+        tx = tx_rows.iloc[0]
+        assert tx["TxMethod"] == get_method(tx_rows) and tx["TxContract"] == get_contract_id(tx_rows)
+        assert tx["NumPricedIn"] == np.count_nonzero(tx_rows["IsPriced"] & tx_rows["IsIn"])
+        assert tx["NumUnpricedOut"] == np.count_nonzero(tx_rows["IsUnpriced"] & tx_rows["IsOut"])
+
+    tx_df = make_tx_df()
+    tx_df.loc[tx_df["Hash"] == "h2", "Method"] = "swap"
+    with pytest.raises(Exception, match="multiple methods for transaction h2"):
+        accounting.init_output_columns(tx_df)
+
+def test_protocol_specific_rule(monkeypatch):
+    # deposits into "pool" are payments
+    monkeypatch.setattr(accounting, "TX_RULES", [(TxType.TRANSFER_OUT, lambda tx: tx.method == "deposit")] + accounting.TX_RULES)
+    _, tx_df_gains = compute_portfolio_and_gains(make_tx_df())
+
+    h3 = tx_df_gains[tx_df_gains["Hash"] == "h3"]
+    assert h3["TxCategory"].tolist() == ["TRANSFER_OUT", "TRANSFER_OUT"]
+    assert h3["RowCategory"].tolist() == ["NO_TRANSFER", "TRANSFER_PAYMENT_OUT"]
+    assert h3["Gain/Loss"].iloc[1] == 0
+
+def test_all_cost_basis_methods_in_one_pass():
+    tx_df = make_tx_df()
+    results = compute_portfolio_and_gains_by_method(tx_df)
+
+    assert set(results.keys()) == set(CostBasisMethod)
+    for method, (portfolio, method_df) in results.items():
+        portfolio_ref, tx_df_ref = compute_portfolio_and_gains(tx_df, method=method)
+        assert portfolio.cost() == portfolio_ref.cost()
+        for column in ["Cost", "Gain/Loss", "RowCategory", "TxCategory", "TxnFee(Cost)", "TxnFee(Gain/Loss)"]:
+            assert method_df[column].equals(tx_df_ref[column])
+
+def test_resume_from_checkpoint(tmp_path):
+    tx_df = make_tx_df()
+    portfolio_ref, tx_df_ref = compute_portfolio_and_gains(tx_df)
+
+    # first run only saw the rows up to the liquid deposit
+    portfolio, first_df = compute_portfolio_and_gains(tx_df[tx_df["TimeStamp"] <= 4])
+    make_checkpoint(portfolio, first_df).save(str(tmp_path / "checkpoint.pickle"))
+
+    checkpoint = Checkpoint.load(str(tmp_path / "checkpoint.pickle"))
+    portfolio, second_df = compute_portfolio_and_gains(tx_df, checkpoint=checkpoint)
+
+    assert second_df["Hash"].tolist() == ["h6", "h6", "h6", "h6", "h7", "h8", "h9"]
+    assert str(portfolio) == str(portfolio_ref)
+    assert portfolio.cost() == portfolio_ref.cost()
+    resumed_df = pd.concat([first_df, second_df])
+    for column in ["Cost", "Gain/Loss", "RowCategory", "TxCategory", "TxnFee(Cost)", "TxnFee(Gain/Loss)"]:
+        assert resumed_df[column].tolist() == tx_df_ref[column].tolist()
+
+    # nothing new to process
+    _, empty_df = compute_portfolio_and_gains(tx_df, checkpoint=make_checkpoint(portfolio, second_df, checkpoint))
+    assert len(empty_df) == 0
+
+def test_chunked_matches_full_run(tmp_path):
+    tx_df = make_tx_df()
+    portfolio_ref, tx_df_ref = compute_portfolio_and_gains(tx_df)
+
+    for chunksize in [1, 2, 5, 100]:
+        chunks = [tx_df.iloc[i:i + chunksize] for i in range(0, len(tx_df), chunksize)]
+        written = []
+        portfolio = compute_portfolio_and_gains_chunked(chunks, written.append)
+
+        assert max(len(x) for x in written) <= chunksize + 3
+        result_df = pd.concat(written)
+        assert str(portfolio) == str(portfolio_ref)
+        for column in ["Hash", "Cost", "Gain/Loss", "RowCategory", "TxCategory", "TxnFee(Cost)", "TxnFee(Gain/Loss)"]:
+            assert result_df[column].tolist() == tx_df_ref[column].tolist()
+
+    filepath = str(tmp_path / "tx.parquet")
+    tx_df.to_parquet(filepath)
+    written = []
+    portfolio = compute_portfolio_and_gains_chunked(read_tx_chunks(filepath, chunksize=4), written.append)
+    assert pd.concat(written)["Gain/Loss"].tolist() == tx_df_ref["Gain/Loss"].tolist()
+
+def test_holdings_history_matches_replay_per_day():
+    tx_df = make_tx_df()
+    tx_df["TimeStamp"] = tx_df["TimeStamp"] * 86400 + 3600 # one day per timestamp, h2 and h3 on the same day
+    tokens = pd.DataFrame({"TokenName": list(NAMES.values()), "TokenSymbol": list(NAMES.keys()),
+                           "cg_id": [CG_IDS.get(symbol) for symbol in NAMES.keys()]})
+    price_matrix = PriceMatrix(np.array([[1000. + 100 * day, 1. + day / 100] for day in range(12)]), 0, ["ethereum", "usd-coin"])
+
+    history = HoldingsHistory()
+    compute_portfolio_and_gains(tx_df, history=history)
+    days = np.arange(0, 11)
+    series = history.daily_series(tokens, price_matrix, days)
+
+    assert history.daily_series(tokens, price_matrix).index.tolist() == series.index[1:9].tolist()
+    for day in days:
+        portfolio, _ = compute_portfolio_and_gains(tx_df[tx_df["TimeStamp"] < (day + 1) * 86400])
+        expected = value_portfolio(portfolio, tokens, price_matrix, [day]).iloc[0]
+        assert np.isclose(series["Value"].iloc[day], expected)
+        assert np.isclose(series["CostBasis"].iloc[day], portfolio.cost())
+    assert series["Value"].iloc[0] == 0
+
+def test_synthetic_history_replays():
+    tx_df = make_priced_tx_df(2000, seed=1)
+    portfolio, tx_df_gains = compute_portfolio_and_gains(tx_df)
+
+    assert 2000 <= len(tx_df) <= 2003
+    assert set(tx_df_gains["TxCategory"]) == {"TRANSFER_IN", "TRANSFER_OUT", "SWAP", "FEE_ONLY", "CONTRACT_DEPOSIT",
+                                              "CONTRACT_WITHDRAW", "LIQUID_DEPOSIT", "LIQUID_WITHDRAW"}
+    assert "ERROR" not in set(tx_df_gains["RowCategory"])
+    assert "TRANSFER_NFT_IN" in set(tx_df_gains["RowCategory"])
+
+def test_exact_replay_in_base_units(tmp_path):
+    tx_df = add_base_units(make_tx_df(), {"USDC": 6, "NFT": 0})
+    portfolio_ref, tx_df_ref = compute_portfolio_and_gains(tx_df)
+    portfolio, tx_df_gains = compute_portfolio_and_gains(tx_df, exact=True)
+
+    # 10 ETH in, 1 swapped, 0.5 into and 0.2 out of the pool, 0.1 spent and 0.043 of fees
+    assert portfolio.spot["ETH"].amount() == 8_557 * 10**15
+    assert portfolio.spot["USDC"].amount() == 1150 * 10**6
+    assert approx_holdings(portfolio) == pytest.approx(approx_holdings(portfolio_ref))
+    assert np.allclose(tx_df_gains["Gain/Loss"], tx_df_ref["Gain/Loss"])
+    assert np.allclose(tx_df_gains["TxnFee(Cost)"], tx_df_ref["TxnFee(Cost)"])
+
+    # base units survive a csv round trip
+    filepath = str(tmp_path / "tx.csv")
+    tx_df.to_csv(filepath, index=False)
+    written = []
+    portfolio = compute_portfolio_and_gains_chunked(read_tx_chunks(filepath, chunksize=4), written.append, exact=True)
+    assert portfolio.spot["ETH"].amount() == 8_557 * 10**15
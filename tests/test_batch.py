@@ -0,0 +1,63 @@
+import os
+import sys
+import subprocess
+from multiprocessing import shared_memory
+import numpy as np
+import pandas as pd
+from sources.batch import account_wallets, get_tokens, summarize
+from sources.prices import PriceMatrix
+from sources.utils import merge_tx_df_with_prices
+from sources.accounting import compute_portfolio_and_gains
+from tests.test_accounting import make_tx_df, NAMES, CG_IDS
+
+def make_unpriced_tx_df():
+    # combined export as returned by combine_etherscan_dfs, timestamps fall on day 0
+    return make_tx_df().drop(columns=["cg_id", "TokenPriceEuro", "ValueEuro", "TxnFee(Euro)"])
+
+def make_tokens():
+    return pd.DataFrame({"TokenName": list(NAMES.values()), "TokenSymbol": list(NAMES.keys()),
+                         "cg_id": [CG_IDS.get(symbol) for symbol in NAMES.keys()]})
+
+def test_account_wallets_matches_serial_run():
+    tokens = make_tokens()
+    price_matrix = PriceMatrix(np.array([[2000., 1.], [2100., 1.01]]), 0, ["ethereum", "usd-coin"])
+    tx_dfs = {"0xa": make_unpriced_tx_df(), "0xb": make_unpriced_tx_df().iloc[:7].copy()}
+    broken = make_unpriced_tx_df()
+    broken.loc[3, "TxnFee(ETH)"] = 0.1 # fee on a USDC row
+    tx_dfs["0xc"] = broken
+
+    results = account_wallets(tx_dfs, tokens, price_matrix, processes=2)
+
+    assert list(results.keys()) == ["0xa", "0xb", "0xc"]
+    for address in ["0xa", "0xb"]:
+        portfolio, tx_df_gains = compute_portfolio_and_gains(merge_tx_df_with_prices(tx_dfs[address], tokens, price_matrix))
+        assert results[address].error is None
+        assert results[address].portfolio.cost() == portfolio.cost()
+        assert results[address].tx_df["Gain/Loss"].equals(tx_df_gains["Gain/Loss"])
+        assert set(results[address].timings.keys()) == {"prices", "accounting"}
+
+    assert results["0xc"].portfolio is None
+    assert "AssertionError" in results["0xc"].error
+
+    summary = summarize(results)
+    assert summary["rows"].tolist() == [17, 7, 0]
+    assert summary["error"].notnull().tolist() == [False, False, True]
+
+def test_get_tokens():
+    tokens = get_tokens([make_unpriced_tx_df(), make_unpriced_tx_df().iloc[:2]])
+    assert sorted(tokens["TokenSymbol"]) == ["ETH", "NFT", "UNI-V2", "USDC"]
+
+def test_attached_shared_memory_outlives_other_processes():
+    # a process with its own resource tracker maps the matrix and exits, the block stays with its creator
+    price_matrix = PriceMatrix(np.array([[2000., 1.], [2100., 1.01]]), 0, ["ethereum", "usd-coin"])
+    shm, spec = price_matrix.to_shared_memory()
+    try:
+        code = f"from sources.prices import PriceMatrix; shared = PriceMatrix.from_shared_memory({spec!r}); print(shared.values.sum())"
+        result = subprocess.run([sys.executable, "-c", code], capture_output=True, text=True,
+                                cwd=os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+        assert float(result.stdout) == price_matrix.values.sum()
+        assert "leaked" not in result.stderr and "Traceback" not in result.stderr
+        shared_memory.SharedMemory(name=spec[0]).close()
+    finally:
+        shm.close()
+        shm.unlink()
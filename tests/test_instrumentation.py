@@ -0,0 +1,43 @@
+import json
+import pytest
+import sources.instrumentation as instrumentation
+from sources.accounting import compute_portfolio_and_gains
+from sources.http_client import HttpClient
+from tests.test_accounting import make_tx_df
+from tests.test_io_utils import SlowFlakyServer
+
+@pytest.fixture
+def events():
+    events = []
+    instrumentation.enable(callback=events.append)
+    yield events
+    instrumentation.disable()
+
+def test_stages_and_counters(events, tmp_path):
+    compute_portfolio_and_gains(make_tx_df())
+    report = instrumentation.report()
+
+    assert report["stages"]["compute_portfolio_and_gains"]["calls"] == 1
+    tx_stages = {name: entry["calls"] for name, entry in report["stages"].items() if name.startswith("tx/")}
+    assert tx_stages == {"tx/TRANSFER_IN": 1, "tx/SWAP": 1, "tx/CONTRACT_DEPOSIT": 1, "tx/CONTRACT_WITHDRAW": 1,
+                         "tx/LIQUID_DEPOSIT": 1, "tx/LIQUID_WITHDRAW": 1, "tx/TRANSFER_OUT": 1, "tx/FEE_ONLY": 2}
+    assert report["counters"]["rows_processed"] == 17
+    assert report["counters"]["lots_created"] > 0
+    assert {"type": "counter", "name": "rows_processed", "value": 17} in events
+
+    instrumentation.save_report(str(tmp_path / "report.json"))
+    assert json.load(open(tmp_path / "report.json")) == report
+
+def test_api_call_counters(events):
+    server = SlowFlakyServer(delay=0)
+    client = HttpClient(rate=100, backoff=0.01)
+    client.get_json(f"{server.url}/abi")
+    server.server.shutdown()
+
+    host = server.url.replace("http://", "")
+    assert instrumentation.report()["counters"] == {f"api_calls/{host}": 2, "api_retries": 1}
+
+def test_disabled_records_nothing():
+    instrumentation.reset()
+    compute_portfolio_and_gains(make_tx_df())
+    assert instrumentation.report() == {"stages": {}, "counters": {}}
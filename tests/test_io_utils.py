@@ -0,0 +1,306 @@
+import json
+import pickle
+import time
+import threading
+from datetime import datetime
+from http.server import BaseHTTPRequestHandler, HTTPServer, ThreadingHTTPServer
+from urllib.parse import urlparse, parse_qs
+import pytest
+import pandas as pd
+import sources.io_utils as io_utils
+import sources.http_client as http_client
+import sources.coins as coins
+from sources.http_client import HttpClient, RateLimiter
+from sources.signatures import SignatureTable, BUNDLED_SIGNATURES, get_signature_table
+from tests.synthetic import make_etherscan_dfs
+from tests.combine_rowwise import combine_etherscan_dfs_rowwise, copy_dfs, ADDRESS
+
+class FakeExplorer:
+    # serves account lists like the etherscan api: rows between startblock and endblock, at most offset of them
+    def __init__(self):
+        self.rows = {action: [] for action in io_utils.ETHERSCAN_ACTIONS.values()}
+        self.requests = []
+
+        explorer = self
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                params = {k: v[0] for k, v in parse_qs(urlparse(self.path).query).items()}
+                explorer.requests.append(params)
+                start, end, offset = int(params["startblock"]), int(params["endblock"]), int(params["offset"])
+                result = [row for row in explorer.rows[params["action"]] if start <= int(row["blockNumber"]) <= end][:offset]
+                body = json.dumps({"status": "1", "message": "OK", "result": result}).encode()
+                self.send_response(200)
+                self.send_header("Content-Type", "application/json")
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, *args):
+                pass
+
+        self.server = HTTPServer(("127.0.0.1", 0), Handler)
+        self.url = f"http://127.0.0.1:{self.server.server_port}/api"
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+
+    def add(self, action, block, timestamp):
+        self.rows[action].append({"blockNumber": str(block), "timeStamp": str(timestamp), "hash": f"0x{block:x}{len(self.rows[action])}"})
+
+@pytest.fixture
+def explorer(monkeypatch):
+    explorer = FakeExplorer()
+    monkeypatch.setitem(io_utils.EXPLORER_URLS, "etherscan", explorer.url)
+    monkeypatch.setattr(http_client, "DEFAULT_RATE_LIMIT", 100)
+    yield explorer
+    explorer.server.shutdown()
+
+def test_sync_fetches_only_new_blocks(explorer, tmp_path):
+    data_dir = str(tmp_path) + "/"
+    for block in [1, 2, 2, 3, 5, 6, 6, 7]:
+        explorer.add("txlist", block, 1000 + block)
+    # a table of get_or_load_etherscan_dfs that starts later, sync must not resume from it
+    non_synced = pd.DataFrame({"blockNumber": ["5"], "timeStamp": ["1005"], "hash": ["0x5"]})
+    io_utils.ColumnarStore(data_dir + "store").write(("etherscan", "0xabc", "normal"), non_synced, block_start=5, block_end=5,
+                                                     time_start=1005, fetched_until="2100-01-01")
+
+    etherscan_dfs = io_utils.sync_etherscan_dfs(data_dir, "0xABC", page_size=3)
+
+    assert etherscan_dfs["normal"]["blockNumber"].tolist() == ["1", "2", "2", "3", "5", "6", "6", "7"]
+    assert len(etherscan_dfs["erc20"]) == 0
+
+    explorer.add("txlist", 9, 1009)
+    explorer.add("tokentx", 10, 1010)
+    explorer.requests.clear()
+
+    etherscan_dfs = io_utils.sync_etherscan_dfs(data_dir, "0xABC", page_size=3)
+
+    starts = {params["action"]: params["startblock"] for params in explorer.requests}
+    assert starts == {"txlist": "8", "tokentx": "0", "txlistinternal": "0", "tokennfttx": "0"}
+    assert etherscan_dfs["normal"]["blockNumber"].tolist() == ["1", "2", "2", "3", "5", "6", "6", "7", "9"]
+    assert etherscan_dfs["erc20"]["blockNumber"].tolist() == ["10"]
+    assert io_utils.ColumnarStore(data_dir + "store").load(("etherscan", "0xabc", "normal")).equals(non_synced)
+
+def test_fetch_account_list_block_over_page_size(explorer):
+    for i in range(3):
+        explorer.add("txlist", 4, 1004)
+
+    with pytest.raises(Exception):
+        io_utils.fetch_account_list("0xabc", "normal", 0, page_size=3)
+
+class SlowFlakyServer:
+    # answers after a delay, the first answer for each path is a 503
+    def __init__(self, delay):
+        self.counts = {}
+        server = self
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                server.counts[self.path] = server.counts.get(self.path, 0) + 1
+                time.sleep(delay)
+                if server.counts[self.path] == 1:
+                    self.send_response(503)
+                    self.end_headers()
+                    return
+                self.send_response(200)
+                self.end_headers()
+                self.wfile.write(json.dumps({"status": "1", "result": self.path}).encode())
+
+            def log_message(self, *args):
+                pass
+
+        self.server = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+        self.url = f"http://127.0.0.1:{self.server.server_port}"
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+
+def test_http_client_coalesces_and_retries():
+    server = SlowFlakyServer(delay=0.2)
+    client = HttpClient(rate=100, max_workers=4, backoff=0.01)
+
+    futures = [client.submit(f"{server.url}/abi{i % 2}") for i in range(6)]
+    results = [future.result() for future in futures]
+    server.server.shutdown()
+
+    assert [x["result"] for x in results] == ["/abi0", "/abi1"] * 3
+    # one failed and one successful request per distinct url
+    assert server.counts == {"/abi0": 2, "/abi1": 2}
+    assert client.num_requests == 4
+
+def test_rate_limiter():
+    limiter = RateLimiter(rate=20)
+    start = time.monotonic()
+    for i in range(6):
+        limiter.acquire()
+    assert time.monotonic() - start >= 0.24
+
+def test_decode_methods_resolves_each_contract_selector_once(monkeypatch, tmp_path):
+    abis = {
+        "0xrouter": [{"type": "function", "name": "swapExactETHForTokens", "inputs": [{"name": "amountOutMin", "type": "uint256"}, {"name": "path", "type": "address[]"}, {"name": "to", "type": "address"}, {"name": "deadline", "type": "uint256"}]},
+                     {"type": "event", "name": "Swap", "inputs": []}],
+        "0xproxy": [{"type": "function", "name": "implementation", "inputs": []}],
+        "0x" + "ab" * 20: [{"type": "function", "name": "deposit", "inputs": [{"name": "amount", "type": "uint256"}]}],
+    }
+    abi_calls = []
+    def get_contract_abi(contract_address, platform="ethereum"):
+        abi_calls.append(contract_address)
+        return abis.get(contract_address)
+
+    monkeypatch.setattr(io_utils, "get_contract_abi", get_contract_abi)
+    monkeypatch.setattr(io_utils, "cached_request", lambda filepath, request: "0x" + "0" * 24 + "ab" * 20)
+    monkeypatch.setattr(io_utils, "selector_indexes", {"ethereum": io_utils.KeyValueStore(str(tmp_path / "index.jsonl"))})
+    monkeypatch.setattr(io_utils, "proxy_implementations", {})
+    monkeypatch.setattr(io_utils, "unreadable_contracts", set())
+    monkeypatch.setattr(io_utils, "get_signature_table", lambda: SignatureTable.from_tsv([]))
+
+    df = pd.DataFrame({
+        "To": ["0xrouter", "0xrouter", "0xproxy", "0xproxy", "0xunknown", "0xrouter", "0xrouter", "0xfriend", "0x000000000000000000000000000000000000006e"],
+        "Input": ["0x7ff36ab5aaaa", "0x7ff36ab5bbbb", "0xb6b55f25cccc", "0xb6b55f25dddd", "0x12345678", "0x", "0xdeadbeef", "0x", "0x12345678"],
+    })
+    methods = io_utils.decode_methods(df)
+
+    assert methods.tolist() == ["swapExactETHForTokens", "swapExactETHForTokens", "deposit", "deposit", "read_abi_error", "transfer", "not_found_error", "transfer", "transfer"]
+    # no abi for the receivers of plain transfers
+    assert sorted(abi_calls) == sorted(["0xproxy", "0xrouter", "0x" + "ab" * 20, "0xunknown"])
+    assert io_utils.decode_methods(df[df["Input"] == "0x"]).tolist() == ["transfer", "transfer"]
+
+    # the index is persisted, abi failures only for this process
+    index = io_utils.KeyValueStore(str(tmp_path / "index.jsonl"))
+    assert index.get("0xrouter")["selectors"] == {"7ff36ab5": "swapExactETHForTokens"}
+    assert "0xunknown" not in index
+
+    abi_calls.clear()
+    io_utils.decode_methods(df)
+    assert abi_calls == []
+
+    # in a new process the unreadable contract is asked again, the others come from the index
+    monkeypatch.setattr(io_utils, "selector_indexes", {"ethereum": io_utils.KeyValueStore(str(tmp_path / "index.jsonl"))})
+    monkeypatch.setattr(io_utils, "unreadable_contracts", set())
+    abis["0xunknown"] = [{"type": "function", "name": "claim", "inputs": []}]
+    methods = io_utils.decode_methods(df)
+    assert abi_calls == ["0xunknown"]
+    assert methods.tolist()[4] == "not_found_error"
+
+def test_signature_table(tmp_path):
+    table = SignatureTable.from_tsv([BUNDLED_SIGNATURES])
+    table.save(str(tmp_path / "4byte"))
+    table = SignatureTable.load(str(tmp_path / "4byte"))
+
+    assert table.signature("0xa9059cbb") == "transfer(address,uint256)"
+    assert table.method_name("7ff36ab5") == "swapExactETHForTokens"
+    assert table.method_name("00000000") is None
+    assert table.method_name("ffffffff") is None
+    assert table.method_name("") is None
+    assert SignatureTable.from_tsv([]).method_name("a9059cbb") is None
+
+    # compiled into COMPILED_PREFIX, tmp_path in the tests (conftest)
+    assert get_signature_table().method_name("a9059cbb") == "transfer"
+    assert (tmp_path / "4byte_blob.npy").exists()
+
+def test_signature_table_compiled_once_across_threads(monkeypatch, tmp_path):
+    compiled = []
+    from_tsv = SignatureTable.from_tsv
+    def slow_from_tsv(paths):
+        compiled.append(paths)
+        time.sleep(0.05)
+        return from_tsv(paths)
+    monkeypatch.setattr(SignatureTable, "from_tsv", staticmethod(slow_from_tsv))
+
+    tables = []
+    threads = [threading.Thread(target=lambda: tables.append(get_signature_table())) for i in range(8)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    assert len(compiled) == 1 and len(tables) == 8 and all(table is tables[0] for table in tables)
+    assert sorted(x.name for x in tmp_path.iterdir()) == ["4byte_blob.npy", "4byte_offsets.npy", "4byte_selectors.npy"]
+
+def test_decode_methods_offline(monkeypatch):
+    monkeypatch.setattr(io_utils, "get_signature_table", lambda: SignatureTable.from_tsv([BUNDLED_SIGNATURES]))
+    monkeypatch.setattr(io_utils, "get_contract_abi", lambda *args: pytest.fail("no network call expected"))
+
+    df = pd.DataFrame({
+        "To": ["0xtoken", "0xrouter", "0xvault", "0xfriend"],
+        "Input": ["0xa9059cbb0000", "0x7ff36ab50000", "0xdeadbeef", "0x"],
+    })
+
+    assert io_utils.decode_methods(df, offline=True).tolist() == ["transfer", "swapExactETHForTokens", "not_found_error", "transfer"]
+
+@pytest.mark.parametrize("platform", ["ethereum", "arbitrum"])
+def test_combine_etherscan_dfs_matches_rowwise(monkeypatch, platform):
+    monkeypatch.setattr(io_utils, "get_signature_table", lambda: SignatureTable.from_tsv([BUNDLED_SIGNATURES]))
+    etherscan_dfs = make_etherscan_dfs(5000, ADDRESS)
+
+    tx_df = io_utils.combine_etherscan_dfs(copy_dfs(etherscan_dfs), ADDRESS, platform, offline=True)
+    expected = combine_etherscan_dfs_rowwise(copy_dfs(etherscan_dfs), ADDRESS, platform, offline=True)
+
+    # the row-wise version has no base unit columns
+    pd.testing.assert_frame_equal(tx_df.drop(columns=["TxnFee(Wei)", "Units", "Decimals"]), expected, check_exact=True)
+    assert (tx_df["From"] == "my_wallet").any() and not (tx_df["TokenSymbol"] == "CNV").any()
+
+def test_wei_conversions_beyond_int64():
+    values = ["0", "1", "9007199254740993", "9223372036854775807", "9223372036854775808", "123456789012345678901234567"]
+    assert io_utils.wei_to_eth(values).tolist() == [int(x) / 1e18 for x in values]
+    assert io_utils.token_amounts(values, ["18", "6", "0", "30", "18", "2"]).tolist() == \
+        [int(values[0]) / 10**18, int(values[1]) / 10**6, int(values[2]) / 1, int(values[3]) / 10**30, int(values[4]) / 10**18, int(values[5]) / 10**2]
+    wei, fees = io_utils.gas_fees(["100000000000000", "3037000500", "1"], ["3000000", "3037000500", values[-1]])
+    assert wei.tolist() == [str(100000000000000 * 3000000), str(3037000500 * 3037000500), values[-1]]
+    assert fees.tolist() == [100000000000000 * 3000000 / 1e18, 3037000500 * 3037000500 / 1e18, int(values[-1]) / 1e18]
+
+COIN_LIST = [
+    {"id": "ethereum", "symbol": "eth", "name": "Ethereum"},
+    {"id": "ethereum-wormhole", "symbol": "eth", "name": "Ethereum (Wormhole)"},
+    {"id": "usd-coin", "symbol": "usdc", "name": "USD Coin"},
+    {"id": "usd-coin-pos", "symbol": "usdc", "name": "USD Coin (PoS)"},
+    {"id": "curve-dao-token", "symbol": "crv", "name": "Curve DAO Token"},
+    {"id": "crv-bridged", "symbol": "crv", "name": "Curve"},
+    {"id": "convex-crv", "symbol": "cvxcrv", "name": "Convex CRV"},
+    {"id": "convex-crv-old", "symbol": "cvxcrv", "name": "Convex CRV Old"},
+    {"id": "sushi-lp", "symbol": "slp", "name": "SushiSwap LP Token"},
+]
+
+def test_match_tokens_to_coingecko(monkeypatch, tmp_path):
+    pickle.dump(COIN_LIST, open(tmp_path / "coins.pickle", "wb"))
+    pd.DataFrame({"TokenSymbol": ["cvxCRV"], "TokenName": [""], "cg_id": ["convex-crv"]}).to_csv(tmp_path / "overrides.csv", index=False)
+    monkeypatch.setattr(coins, "COIN_LIST", str(tmp_path / "coins.pickle"))
+    monkeypatch.setattr(coins, "COMPILED_INDEX", str(tmp_path / "index.json"))
+    monkeypatch.setattr(coins, "USER_OVERRIDES", str(tmp_path / "overrides.csv"))
+    monkeypatch.setattr(coins, "coin_index", None)
+
+    tokens = pd.DataFrame({
+        "TokenName": ["Ethereum", "USD Coin", "Curve DAO Token", "Convex CRV", "SushiSwap LP Token", "Unknown", "USD Coin", "Wrapped Ether"],
+        "TokenSymbol": ["ETH", "USDC", "CRV", "cvxCRV", "SLP", "UNK", "USDC", "WETH"],
+    })
+    matched = io_utils.match_tokens_to_coingecko(tokens, overrides={("WETH", "Wrapped Ether"): "weth"})
+
+    assert dict(zip(matched["TokenSymbol"], matched["cg_id"])) == {
+        "ETH": "ethereum",         # the wormhole copy is not a candidate
+        "USDC": "usd-coin",        # the only candidate whose name is part of the token name
+        "CRV": "curve-dao-token",  # both names are part of it, the normalized name decides
+        "cvxCRV": "convex-crv",    # override table
+        "SLP": None,               # not priced by default
+        "UNK": None,
+        "WETH": "weth",            # overrides argument
+    }
+    # the compiled index is reused
+    assert coins.CoinIndex.load(str(tmp_path / "index.json")).candidates("USDC") == [["usd-coin", "USD Coin"], ["usd-coin-pos", "USD Coin (PoS)"]]
+
+class FakeCoinGecko:
+    # market chart responses in call order, the last point of each is the current price
+    responses = []
+
+    def get_coin_market_chart_by_id(self, cg_id, currency, days, interval):
+        return {"prices": FakeCoinGecko.responses.pop(0)}
+
+def test_cached_prices_first_fetch_without_prices(monkeypatch, tmp_path):
+    monkeypatch.setattr(io_utils, "CoinGeckoAPI", FakeCoinGecko)
+    monkeypatch.setattr(io_utils, "price_store", io_utils.ColumnarStore(str(tmp_path / "prices")))
+    monkeypatch.setattr(io_utils.time, "sleep", lambda seconds: None)
+    day = 86400000
+    FakeCoinGecko.responses = [[], [[day, 2.]], [[day, 2.], [2 * day, 3.], [3 * day, 4.]]]
+
+    prices = io_utils.cached_prices("new-token", datetime(2022, 1, 1), datetime(2022, 1, 3))
+    assert len(prices) == 0 and io_utils.price_store.meta(("new-token",)) is None
+
+    # only the current price: still nothing stored
+    assert len(io_utils.cached_prices("new-token", datetime(2022, 1, 1), datetime(2022, 1, 3))) == 0
+
+    prices = io_utils.cached_prices("new-token", datetime(2022, 1, 1), datetime(2022, 1, 3))
+    assert prices["timestamp"].tolist() == [day, 2 * day] and prices["price"].tolist() == [2., 3.]
+    assert io_utils.price_store.meta(("new-token",))["last_timestamp"] == 2 * day
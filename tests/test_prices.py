@@ -0,0 +1,222 @@
+from datetime import datetime
+import numpy as np
+import pandas as pd
+from sources.prices import PriceMatrix, IntradayPrices, PriceArchive, date_strings_to_day_ordinals, day_range, pivot_daily_prices
+from sources.io_utils import fetch_historical_prices, get_price_matrix
+from sources.utils import merge_tx_df_with_prices, match_price, get_tx_fee, get_token_id2current_price
+from sources.accounting import value_portfolio
+from sources.classes import Portfolio
+
+def make_prices_df():
+    dates = pd.date_range("2022-01-01", periods=4, freq="D")
+    prices_df = pd.DataFrame({
+        "timestamp": dates.astype("int64") // 10**6,
+        "ethereum": [3000., 3100., np.nan, 3300.],
+        "usd-coin": [0.9, 0.91, 0.92, 0.93],
+    })
+    prices_df["date"] = pd.to_datetime(prices_df["timestamp"], unit="ms")
+    prices_df["DateString"] = prices_df["date"].apply(lambda x: x.strftime("%Y-%m-%d"))
+    return prices_df
+
+def make_tokens():
+    return pd.DataFrame({
+        "TokenName": ["Ethereum", "USD Coin", "Uniswap V2", "Euro"],
+        "TokenSymbol": ["ETH", "USDC", "UNI-V2", "EUR"],
+        "cg_id": ["ethereum", "usd-coin", None, None],
+    })
+
+def test_merge_tx_df_with_prices_matches_row_lookup():
+    day = 86400
+    start = 1640995200 # 2022-01-01
+    tx_df = pd.DataFrame({
+        "Hash": ["h1", "h1", "h2", "h3", "h4", "h5"],
+        "TimeStamp": [str(start + 3 * day + 5), str(start + 3 * day + 5), str(start + 10), str(start + day), str(start + 2 * day), str(start + day + 7)],
+        "TokenName": ["Ethereum", "USD Coin", "Uniswap V2", "Ethereum", "Ethereum", "Euro"],
+        "TokenSymbol": ["ETH", "USDC", "UNI-V2", "ETH", "ETH", "EUR"],
+        "Amount": [1., 100., 3., 0., 0.5, 20.],
+        "TxnFee(ETH)": [0.01, np.nan, np.nan, 0.002, np.nan, np.nan],
+    })
+    prices_df = make_prices_df()
+    merged = merge_tx_df_with_prices(tx_df, make_tokens(), prices_df)
+
+    expected_prices = merged.apply(lambda row: match_price(row, prices_df), axis=1).astype(float)
+    assert merged["DateString"].tolist() == ["2022-01-01", "2022-01-02", "2022-01-02", "2022-01-03", "2022-01-04", "2022-01-04"]
+    assert np.allclose(merged["TokenPriceEuro"], expected_prices, equal_nan=True)
+    assert np.allclose(merged["ValueEuro"], expected_prices * merged["Amount"], equal_nan=True)
+    assert np.allclose(merged["TxnFee(Euro)"], merged.apply(get_tx_fee, axis=1).astype(float), equal_nan=True)
+
+    # the token columns of a left merge, rows already in time order keep their order
+    tx_df.loc[4, "TokenName"] = "Unknown"
+    in_order = tx_df.sort_values("TimeStamp", kind="stable").reset_index(drop=True)
+    merged = merge_tx_df_with_prices(in_order, make_tokens(), prices_df)
+    expected = in_order.merge(make_tokens(), on=["TokenName", "TokenSymbol"], how="left")
+    assert merged["Hash"].tolist() == in_order["Hash"].tolist()
+    assert merged["cg_id"].fillna("-").tolist() == expected["cg_id"].fillna("-").tolist()
+    assert np.isnan(merged.loc[merged["Hash"] == "h4", "TokenPriceEuro"]).all()
+
+def test_price_matrix_lookup_outside_range():
+    price_matrix = PriceMatrix.from_prices_df(make_prices_df())
+    first_day = price_matrix.first_day
+
+    prices = price_matrix.lookup([first_day - 1, first_day, first_day + 3, first_day + 4], ["ethereum", "ethereum", "unknown", "usd-coin"])
+
+    assert np.isnan(prices[0]) and np.isnan(prices[2]) and np.isnan(prices[3])
+    assert prices[1] == 3000.
+
+def test_intraday_prices_as_of_lookup(tmp_path):
+    filepath = str(tmp_path / "prices.csv")
+    pd.DataFrame({
+        "timestamp": [100, 200, 400, 100, 300],
+        "cg_id": ["ethereum", "ethereum", "ethereum", "usd-coin", "usd-coin"],
+        "price": [10., 20., 40., 1., 3.],
+    }).sample(frac=1, random_state=0).to_csv(filepath, index=False)
+    intraday_prices = IntradayPrices.load(filepath)
+
+    timestamps = [50, 100, 150, 300, 500, 200, 200]
+    cg_ids = ["ethereum", "ethereum", "ethereum", "ethereum", "ethereum", "usd-coin", None]
+
+    as_of = intraday_prices.lookup(timestamps, cg_ids)
+    interpolated = intraday_prices.lookup(timestamps, cg_ids, interpolate=True)
+    recent = intraday_prices.lookup(timestamps, cg_ids, max_age=60)
+
+    assert np.allclose(as_of, [np.nan, 10, 10, 20, 40, 1, np.nan], equal_nan=True)
+    assert np.allclose(interpolated, [np.nan, 10, 15, 30, 40, 2, np.nan], equal_nan=True)
+    assert np.allclose(recent, [np.nan, 10, 10, np.nan, np.nan, np.nan, np.nan], equal_nan=True)
+
+def test_price_matrix_shared_memory():
+    price_matrix = PriceMatrix.from_prices_df(make_prices_df())
+    shm, spec = price_matrix.to_shared_memory()
+    try:
+        shared = PriceMatrix.from_shared_memory(spec)
+        assert np.array_equal(shared.values, price_matrix.values, equal_nan=True)
+        assert shared.cg_ids == price_matrix.cg_ids and shared.first_day == price_matrix.first_day
+        assert not shared.values.flags.writeable
+        del shared
+    finally:
+        shm.close()
+        shm.unlink()
+
+def test_price_matrix_save_load(tmp_path):
+    price_matrix = PriceMatrix.from_prices_df(make_prices_df())
+    price_matrix.save(str(tmp_path / "matrix"))
+    loaded = PriceMatrix.load(str(tmp_path / "matrix"))
+
+    assert isinstance(loaded.values, np.memmap)
+    assert np.array_equal(loaded.values, price_matrix.values, equal_nan=True)
+    assert loaded.cg_ids == ["ethereum", "usd-coin"]
+    first_day = date_strings_to_day_ordinals(["2022-01-01"])[0]
+    assert loaded.covers(["ethereum"], first_day, first_day + 3)
+    assert not loaded.covers(["ethereum"], first_day, first_day + 4)
+    assert not loaded.covers(["bitcoin"], first_day, first_day)
+
+    # saving over a mapped matrix replaces the files, the loaded one keeps its values
+    PriceMatrix(price_matrix.values[:2] * 2, price_matrix.first_day, price_matrix.cg_ids).save(str(tmp_path / "matrix"))
+    assert np.array_equal(loaded.values, price_matrix.values, equal_nan=True)
+    assert np.array_equal(PriceMatrix.load(str(tmp_path / "matrix")).values, price_matrix.values[:2] * 2, equal_nan=True)
+    assert sorted(x.name for x in tmp_path.iterdir()) == ["matrix_meta.json", "matrix_values.npy"]
+
+def test_get_token_id2current_price():
+    prices_df = make_prices_df()
+    for prices in [prices_df, PriceMatrix.from_prices_df(prices_df)]:
+        assert get_token_id2current_price(prices, make_tokens(), datetime(2022, 1, 2, 15)) == {"ETH": 3100., "USDC": 0.91, "EUR": 1}
+        # no ETH price on that day
+        assert get_token_id2current_price(prices, make_tokens(), datetime(2022, 1, 3)) == {"USDC": 0.92, "EUR": 1}
+
+def test_value_portfolio():
+    portfolio = Portfolio()
+    portfolio.add_buy("ETH", 2., 5000.)
+    portfolio.add_buy("USDC", 100., 100.)
+    portfolio.add_buy("UNI-V2", 3., 30.)
+    portfolio.add_buy("EUR", 50., 50.)
+    price_matrix = PriceMatrix.from_prices_df(make_prices_df())
+
+    values = value_portfolio(portfolio, make_tokens(), price_matrix, day_range("2021-12-31", datetime(2022, 1, 4)))
+
+    assert values.index.tolist() == ["2021-12-31", "2022-01-01", "2022-01-02", "2022-01-03", "2022-01-04"]
+    assert np.allclose(values, [50., 2 * 3000 + 90 + 50, 2 * 3100 + 91 + 50, 92 + 50, 2 * 3300 + 93 + 50])
+
+def test_pivot_daily_prices_fills_gaps():
+    day = 86400000
+    start = 1640995200000 # 2022-01-01
+    prices = pd.DataFrame({
+        "timestamp": [start + 4 * day, start, start + 3 * day, start + day + 60000, start + day, start + 2 * day, start - day],
+        "cg_id": ["ethereum", "ethereum", "ethereum", "usd-coin", "usd-coin", "usd-coin", "usd-coin"],
+        "price": [3400., 3000., 3300., 0.95, 0.91, np.nan, 0.89],
+    })
+
+    prices_df = pivot_daily_prices(prices, ["usd-coin", "ethereum", "bitcoin"], "2022-01-01", datetime(2022, 1, 4))
+
+    assert prices_df.columns.tolist() == ["timestamp", "usd-coin", "ethereum", "bitcoin", "date", "DateString"]
+    assert prices_df["DateString"].tolist() == ["2022-01-01", "2022-01-02", "2022-01-03", "2022-01-04"]
+    assert (prices_df["timestamp"] == start + np.arange(4) * day).all()
+    # the first sample of each day, forward filled between prices, NaN outside of them
+    assert np.allclose(prices_df["usd-coin"], [np.nan, 0.91, np.nan, np.nan], equal_nan=True)
+    assert np.allclose(prices_df["ethereum"], [3000., 3000., 3000., 3300.])
+    assert prices_df["bitcoin"].isnull().all()
+
+    limited = pivot_daily_prices(prices, ["ethereum"], "2022-01-01", "2022-01-04", max_gap_days=1)
+    assert np.allclose(limited["ethereum"], [3000., 3000., np.nan, 3300.], equal_nan=True)
+
+class StaticPrices:
+    def __init__(self, prices):
+        self.prices = prices
+        self.requested = []
+
+    def load(self, cg_ids, date_start, date_end):
+        self.requested.append(list(cg_ids))
+        return self.prices[self.prices["cg_id"].isin(cg_ids)]
+
+def test_fetch_historical_prices_from_archive_first(tmp_path):
+    filepath = str(tmp_path / "archive.csv")
+    pd.DataFrame({
+        "date": ["2022-01-01", "2022-01-02", "2022-01-04", "2021-06-01"],
+        "ethereum": [3000., 3100., 3300., np.nan],
+        "bitcoin": [np.nan, np.nan, np.nan, 30000.],
+    }).to_csv(filepath, index=False)
+    api = StaticPrices(pd.DataFrame({
+        "timestamp": [1640995200000., 1640995200000., 1641081600000.],
+        "cg_id": ["ethereum", "usd-coin", "bitcoin"],
+        "price": [1., 0.9, 40000.],
+    }))
+
+    prices_df = fetch_historical_prices(["ethereum", "usd-coin", "bitcoin"], "2022-01-01", "2022-01-04", [PriceArchive(filepath), api])
+
+    # bitcoin is in the archive, but not for the period
+    assert api.requested == [["usd-coin", "bitcoin"]]
+    assert np.allclose(prices_df["ethereum"], [3000., 3100., 3100., 3300.])
+    assert np.allclose(prices_df["usd-coin"], [0.9, np.nan, np.nan, np.nan], equal_nan=True)
+    assert np.allclose(prices_df["bitcoin"], [np.nan, 40000., np.nan, np.nan], equal_nan=True)
+    assert PriceMatrix.from_prices_df(prices_df).covers(["ethereum", "usd-coin", "bitcoin"], *date_strings_to_day_ordinals(["2022-01-01", "2022-01-04"]))
+
+    missing = fetch_historical_prices(["usd-coin"], "2022-01-01", "2022-01-02", [PriceArchive(str(tmp_path / "missing.parquet"))])
+    assert missing["usd-coin"].isnull().all() and len(missing) == 2
+
+def test_fetch_historical_prices_after_stale_archive(tmp_path):
+    filepath = str(tmp_path / "archive.csv")
+    pd.DataFrame({
+        "date": ["2022-01-01", "2022-01-02", "2022-01-03"],
+        "ethereum": [3000., 3100., 3200.],
+        "usd-coin": [0.9, 0.91, 0.92],
+    }).to_csv(filepath, index=False)
+    day = 86400000
+    start = 1640995200000 # 2022-01-01
+    api = StaticPrices(pd.DataFrame({
+        "timestamp": [start, start + 3 * day, start + 4 * day, start + 5 * day, start + 6 * day],
+        "cg_id": ["ethereum", "ethereum", "ethereum", "ethereum", "ethereum"],
+        "price": [1., 3300., 3400., 3500., 1.],
+    }))
+
+    prices_df = fetch_historical_prices(["ethereum", "usd-coin"], "2022-01-01", "2022-01-06", [PriceArchive(filepath), api])
+
+    # the archive ends on 2022-01-03, the api only fills the days after it
+    assert api.requested == [["ethereum", "usd-coin"]]
+    assert np.allclose(prices_df["ethereum"], [3000., 3100., 3200., 3300., 3400., 3500.])
+    assert np.allclose(prices_df["usd-coin"], [0.9, 0.91, 0.92, np.nan, np.nan, np.nan], equal_nan=True)
+
+    # usd-coin prices end early, the matrix is not kept and the next call asks the sources again
+    prefix = str(tmp_path / "matrix")
+    price_matrix = get_price_matrix(["ethereum", "usd-coin"], "2022-01-01", "2022-01-06", prefix, [PriceArchive(filepath), api])
+    assert price_matrix.stale_tokens(1) == ["usd-coin"]
+    assert not (tmp_path / "matrix_meta.json").exists()
+    price_matrix = get_price_matrix(["ethereum"], "2022-01-01", "2022-01-06", prefix, [PriceArchive(filepath), api])
+    assert price_matrix.stale_tokens(1) == [] and (tmp_path / "matrix_meta.json").exists()
@@ -1,4 +1,5 @@
-from sources.classes import BaseToken, Buy
+import numpy as np
+from sources.classes import BaseToken, Buy, CostBasisMethod, LiquidDepositToken, DepositContract
 
 
 def test_basetoken():
@@ -17,3 +18,210 @@ def test_basetoken():
 
     assert cvx.amount() == 90
 
+
+
+def test_basetoken_running_totals():
+
+    eth = BaseToken("ETH")
+    for i in range(1, 5):
+        eth.add_buy(i, 100 * i)
+
+    removed = eth.remove(5.5)
+
+    assert [buy.count for buy in eth.buys] == [1, 2, 1.5]
+    assert eth.amount() == 4.5
+    assert eth.cost() == sum([buy.count * buy.cost_basis for buy in eth.buys])
+    assert removed.cost() == 4 * 400 + 1.5 * 300
+
+    eth.remove(4.5)
+
+    assert eth.is_empty()
+    assert eth.cost() == 0
+
+
+def test_basetoken_cost_basis_methods():
+
+    removed_costs = {}
+    for method in CostBasisMethod:
+        token = BaseToken("cvx", method=method)
+        token.add_buy(10, 5)
+        token.add_buy(10, 20)
+        token.add_buy(10, 10)
+
+        removed = token.remove(15)
+
+        assert token.amount() == 15
+        assert removed.amount() == 15
+        assert abs(token.cost() + removed.cost() - 350) < 1e-9
+        removed_costs[method] = removed.cost()
+
+    assert removed_costs[CostBasisMethod.LIFO] == 10 * 10 + 5 * 20
+    assert removed_costs[CostBasisMethod.FIFO] == 10 * 5 + 5 * 20
+    assert removed_costs[CostBasisMethod.HIFO] == 10 * 20 + 5 * 10
+    assert removed_costs[CostBasisMethod.AVERAGE] == 15 * 35 / 3
+
+
+
+def walk_leaf_amounts(token):
+    # uncached reference
+    if type(token) == BaseToken:
+        return {token.token_id: token.amount()}
+    amounts = {}
+    for deposit in token.deposits.values():
+        for token_id, amount in walk_leaf_amounts(deposit).items():
+            amounts[token_id] = amounts.get(token_id, 0) + (token.window_amount(amount) if type(token) == LiquidDepositToken else amount)
+    return amounts
+
+def assert_leaf_amounts(token):
+    expected = walk_leaf_amounts(token)
+    amounts = token.leaf_base_token_amounts()
+    assert set(amounts) == set(expected)
+    for token_id in expected:
+        assert abs(amounts[token_id] - expected[token_id]) < 1e-9
+
+def test_leaf_amounts_cache_is_invalidated():
+
+    inner = LiquidDepositToken("LP1", {"ETH": BaseToken("ETH", Buy("ETH", 2, 1000)), "USDC": BaseToken("USDC", Buy("USDC", 2000, 1))}, 10)
+    outer = LiquidDepositToken("LP2", {"LP1": inner, "CRV": BaseToken("CRV", Buy("CRV", 50, 2))}, 5)
+    assert_leaf_amounts(outer)
+
+    removed = outer.remove_ratio(0.5)
+    assert_leaf_amounts(outer)
+    assert_leaf_amounts(removed)
+    assert outer.leaf_base_token_amounts()["ETH"] == 1
+
+    outer.withdraw("CRV", 5)
+    assert_leaf_amounts(outer)
+    assert outer.leaf_base_token_amounts()["CRV"] == 20
+
+    outer.add_token(removed)
+    assert_leaf_amounts(outer)
+
+    contract = DepositContract("vault")
+    contract.deposit(outer)
+    contract.deposit(BaseToken("ETH", Buy("ETH", 3, 1500)))
+    assert_leaf_amounts(contract)
+    contract.withdraw("LP2", outer.amount() / 4)
+    assert_leaf_amounts(contract)
+    contract.withdraw("ETH", 3)
+    assert_leaf_amounts(contract)
+    assert "ETH" in contract.leaf_base_token_amounts()
+
+
+
+def test_liquid_token_partial_removals_are_lazy():
+
+    eth = BaseToken("ETH", Buy("ETH", 1, 1000))
+    eth.add_buy(1, 3000)
+    inner = LiquidDepositToken("LP1", {"ETH": eth, "USDC": BaseToken("USDC", Buy("USDC", 4000, 1))}, 10)
+    outer = LiquidDepositToken("LP2", {"LP1": inner}, 100)
+
+    removed_cost = 0
+    for i in range(200):
+        removed = outer.remove(outer.amount() * 0.01)
+        removed_cost += removed.cost()
+    # the shared lots were never touched
+    assert [buy.count for buy in eth.buys] == [1, 1]
+
+    remaining = 0.99 ** 200
+    assert abs(outer.amount() - 100 * remaining) < 1e-9
+    assert abs(outer.leaf_base_token_amounts()["ETH"] - 2 * remaining) < 1e-12
+    # the ETH lot bought last was removed first
+    assert abs(outer.cost() - (2 * 1000 + 4000) * remaining) < 1e-9
+    assert abs(removed_cost + outer.cost() - 8000) < 1e-9
+
+    removed = outer.remove_ratio(0.5)
+    unwrapped = removed.withdraw("LP1", removed.underlying_token_amount("LP1")).withdraw("ETH", remaining)
+    assert abs(unwrapped.amount() - remaining) < 1e-12
+    assert abs(unwrapped.cost() - 1000 * remaining) < 1e-9
+    assert abs(outer.cost() - 3000 * remaining) < 1e-9
+
+def make_deposits(method, scale=1):
+    eth = BaseToken("ETH", Buy("ETH", 1 * scale, 1000), method=method)
+    eth.add_buy(2 * scale, 3000)
+    eth.add_buy(1.5 * scale, 2000)
+    usdc = BaseToken("USDC", Buy("USDC", 3000 * scale, 1), method=method)
+    usdc.add_buy(2000 * scale, 0.9)
+    return {"ETH": eth, "USDC": usdc}
+
+def sell_in_parts(token, price, parts=3):
+    # the gains depend on the order of the lots
+    amount = token.amount()
+    gains = []
+    for i in range(parts):
+        sold = token.remove(amount / parts)
+        gains.append(price * sold.amount() - sold.cost())
+    return gains
+
+def test_liquid_token_lazy_removals_match_eager():
+    prices = {"ETH": 2500, "USDC": 1}
+    for method in CostBasisMethod:
+        lp = LiquidDepositToken("LP", make_deposits(method), 100)
+        eager = make_deposits(method)
+
+        for i, ratio in enumerate([0.3, 0.5, 0.25, 1 / 3, 0.8, 1]):
+            removed = lp.remove_ratio(ratio)
+            eager_removed = {token_id: token.remove_ratio(ratio) for token_id, token in eager.items()}
+            if i == 2:
+                # a part of a removed part
+                removed = removed.remove_ratio(0.5)
+                eager_removed = {token_id: token.remove_ratio(0.5) for token_id, token in eager_removed.items()}
+            if i == 3:
+                lp.add_token(LiquidDepositToken("LP", make_deposits(method, 0.5), 50))
+                for token_id, token in make_deposits(method, 0.5).items():
+                    eager[token_id].add_token(token)
+
+            assert abs(removed.cost() - sum([token.cost() for token in eager_removed.values()])) < 1e-7
+            for token_id, token in eager_removed.items():
+                unwrapped = removed.withdraw(token_id, removed.underlying_token_amount(token_id))
+                eager_unwrapped = token.remove(token.amount())
+                assert abs(unwrapped.amount() - eager_unwrapped.amount()) < 1e-9
+                assert np.allclose(sell_in_parts(unwrapped, prices[token_id]), sell_in_parts(eager_unwrapped, prices[token_id]), rtol=0, atol=1e-7)
+
+        assert lp.amount() == 0 and lp.cost() == 0
+        assert all(token.is_empty() for token in eager.values())
+
+def test_exact_amounts_leave_no_dust_lots():
+    amounts = [1430206.016713, 8489593.995679, 7661368.727868]
+    token = BaseToken("DAI", method=CostBasisMethod.FIFO)
+    exact = BaseToken("DAI", method=CostBasisMethod.FIFO, exact=True)
+    for amount in amounts:
+        token.add_buy(amount, 1)
+        exact.add_buy(round(amount * 10**6), 1e-6)
+
+    token.remove(sum(amounts))
+    removed = exact.remove(sum([round(amount * 10**6) for amount in amounts]))
+
+    # the float sum leaves a lot of a few 1e-9
+    assert len(token.buys) == 1
+    assert len(exact.buys) == 0 and exact.amount() == 0
+    assert removed.amount() == 17581168740260
+
+def test_exact_liquid_token_stays_integer():
+    eth = BaseToken("ETH", Buy("ETH", 10**18, 1000e-18), exact=True)
+    eth.add_buy(10**18, 3000e-18)
+    lp = LiquidDepositToken("LP", {"ETH": eth, "USDC": BaseToken("USDC", Buy("USDC", 4000 * 10**6, 1e-6), exact=True)}, 10**19, exact=True)
+
+    for i in range(100):
+        removed = lp.remove(lp.amount() // 7)
+        assert type(removed.underlying_token_amount("ETH")) == int
+    assert type(lp.amount()) == int
+    assert all(type(amount) == int for amount in lp.leaf_base_token_amounts().values())
+
+    held = lp.underlying_token_amount("ETH")
+    unwrapped = lp.withdraw("ETH", held)
+    assert unwrapped.amount() == held and lp.underlying_token_amount("ETH") == 0
+
+    # removals above 2**53 wei neither create nor lose any
+    total = 10**22 + 7
+    lp = LiquidDepositToken("LP", {"ETH": BaseToken("ETH", Buy("ETH", total, 1000e-18), exact=True)}, 10**21 + 3, exact=True)
+    removed_eth = removed_lp = 0
+    for i in range(50):
+        removed = lp.remove(lp.amount() // 3)
+        removed_lp += removed.amount()
+        removed_eth += removed.withdraw("ETH", removed.underlying_token_amount("ETH")).amount()
+        assert removed_eth + lp.underlying_token_amount("ETH") == total
+        # the share of the liquidity token removed so far, rounded down
+        assert removed_eth == total * removed_lp // (10**21 + 3)
+    assert removed_lp + lp.amount() == 10**21 + 3
+    assert removed_eth + lp.withdraw("ETH", lp.underlying_token_amount("ETH")).amount() == total
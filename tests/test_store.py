@@ -0,0 +1,27 @@
+import pandas as pd
+from sources.store import ColumnarStore, KeyValueStore
+
+def test_columnar_store_append_and_load(tmp_path):
+    store = ColumnarStore(str(tmp_path))
+    key = ("etherscan", "0xabc", "erc20")
+
+    assert store.load(key) is None
+
+    store.append(key, pd.DataFrame({"blockNumber": ["1", "2"], "value": ["10", "20"]}), block_end=2)
+    store.append(key, pd.DataFrame(), block_end=3)
+    store.append(key, pd.DataFrame({"blockNumber": ["4"], "value": ["40"]}), block_end=4)
+
+    assert store.meta(key) == {"block_end": 4}
+    assert store.load(key)["value"].tolist() == ["10", "20", "40"]
+
+    store.write(key, pd.DataFrame({"blockNumber": ["5"], "value": ["50"]}), block_end=5)
+    assert store.load(key)["blockNumber"].tolist() == ["5"]
+
+def test_key_value_store_persists(tmp_path):
+    path = str(tmp_path / "cache.jsonl")
+    KeyValueStore(path).put("abi_0xabc", "[]")
+
+    store = KeyValueStore(path)
+    assert "abi_0xabc" in store
+    assert store.get("abi_0xabc") == "[]"
+    assert store.get("abi_0xdef") is None